@@ -0,0 +1,76 @@
+#/roxrec/asyncmatcher.py
+'''
+## ========================================================================== ##
+- AsyncRecordMatcher serves RecordMatcher matches to asyncio callers, such as
+   an online lookup API.
+- Concurrent match calls are grouped into micro batches. A batch is sent as
+   soon as it holds max_batch_size records, or max_wait seconds after its
+   first record arrived, whichever comes first.
+- Each batch matched with RecordMatcher.match_batch in an executor, off the
+   event loop: one exact match query per batch, and per filter partition one
+   signature pass and one canidate fetch.
+- Default executor is a single thread, so batches never run concurrently
+   against the same matcher. Pass an executor to change that.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+## Package
+import __init__
+from general import *
+
+class AsyncRecordMatcher():
+
+    max_wait = 0.005 #seconds
+    max_batch_size = 64
+
+    def __init__(self, matcher, max_wait = None, max_batch_size = None, executor = None):
+        self.matcher = matcher
+        self.max_wait = max_wait if max_wait is not None else AsyncRecordMatcher.max_wait
+        self.max_batch_size = max_batch_size or AsyncRecordMatcher.max_batch_size
+        self.executor = executor or ThreadPoolExecutor(1)
+        self.__pending__ = []
+        self.__timer__ = None
+        self.__running__ = set()
+
+    async def match(self, record):
+        '''Best match for record as RecordMatcher.match returns it, {} when none found'''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__pending__.append([record, future])
+        if(len(self.__pending__) >= self.max_batch_size):
+            self.__flush__()
+        elif(self.__timer__ is None):
+            self.__timer__ = loop.call_later(self.max_wait, self.__flush__)
+        return await future
+
+    def __flush__(self):
+        if(self.__timer__ is not None):
+            self.__timer__.cancel()
+            self.__timer__ = None
+        batch, self.__pending__ = self.__pending__, []
+        if(batch):
+            task = asyncio.get_running_loop().create_task(self.__run__(batch))
+            self.__running__.add(task)
+            task.add_done_callback(self.__running__.discard)
+
+    async def __run__(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.matcher.match_batch, [record for record, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if(not future.done()): future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if(not future.done()): future.set_result(result)
+
+    async def close(self):
+        '''Match anything still pending, wait for running batches, then shut down the executor'''
+        self.__flush__()
+        if(self.__running__):
+            await asyncio.gather(*self.__running__)
+        self.executor.shutdown()
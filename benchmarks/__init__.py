@@ -0,0 +1,18 @@
+#/roxrec/benchmarks/__init__.py
+'''
+## ========================================================================== ##
+- Benchmark suite for roxrec, see run.py
+- generator.py writes synthetic universe and target files with known
+   ground truth, run.py times each pipeline stage against them
+- parsecheck.py checks FileParser output against line by line parsing
+## ========================================================================== ##
+'''
+
+## Built-in packages
+import os
+import sys
+
+## Package modules imported flat, same as from inside the package
+PATH = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
+if(PATH not in sys.path):
+    sys.path.append(PATH)
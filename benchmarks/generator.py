@@ -0,0 +1,98 @@
+#/roxrec/benchmarks/generator.py
+'''
+## ========================================================================== ##
+- Synthetic fuzzy record generator for benchmarks
+- Universe records get NAME, ADDRESS, STATE and a unique SRCID. Targets are
+   copies of sampled universe records with noise applied to NAME and ADDRESS,
+   TRUEID holding the SRCID they were made from.
+- Noise kinds, each applied with its own rate per field:
+    typo   - one character deleted, inserted, substituted or transposed
+    abbrev - one word replaced with its common abbreviation
+    swap   - two adjacent words swapped
+- Same seed always gives the same files.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import random
+import string
+
+NAME_WORDS = ['SAINT', 'MARY', 'MERCY', 'GENERAL', 'COMMUNITY', 'REGIONAL', 'MEMORIAL', 'VALLEY', 'NORTH',
+              'SOUTH', 'EAST', 'WEST', 'LAKE', 'RIVER', 'MOUNT', 'CHILDRENS', 'FAMILY', 'UNITED', 'GRACE',
+              'HOPE', 'PINE', 'CEDAR', 'OAK', 'MAPLE', 'HARBOR', 'SUMMIT', 'HERITAGE', 'PROVIDENCE', 'TRINITY',
+              'BAPTIST', 'METHODIST', 'LUTHERAN', 'COUNTY', 'CITY', 'UNIVERSITY', 'MEDICAL', 'HEALTH', 'CARE']
+NAME_SUFFIXES = ['HOSPITAL', 'CENTER', 'CLINIC', 'FOUNDATION', 'ASSOCIATION', 'SERVICES', 'INSTITUTE']
+STREET_WORDS = ['MAIN', 'ELM', 'OAK', 'PARK', 'WASHINGTON', 'LINCOLN', 'JEFFERSON', 'MADISON', 'CHURCH',
+                'MILL', 'SPRING', 'RIDGE', 'MEADOW', 'FOREST', 'HILL', 'LAUREL', 'HIGHLAND', 'UNION', 'MARKET']
+STREET_SUFFIXES = ['STREET', 'AVENUE', 'ROAD', 'BOULEVARD', 'DRIVE', 'LANE', 'COURT', 'PLACE']
+STATES = ['NY', 'PA', 'NJ', 'OH', 'CA', 'TX', 'FL', 'IL', 'MA', 'WA']
+
+ABBREVIATIONS = {'SAINT':'ST', 'MOUNT':'MT', 'NORTH':'N', 'SOUTH':'S', 'EAST':'E', 'WEST':'W',
+                 'HOSPITAL':'HOSP', 'CENTER':'CTR', 'MEDICAL':'MED', 'UNIVERSITY':'UNIV',
+                 'ASSOCIATION':'ASSN', 'FOUNDATION':'FDN', 'SERVICES':'SVCS', 'INSTITUTE':'INST',
+                 'STREET':'ST', 'AVENUE':'AVE', 'ROAD':'RD', 'BOULEVARD':'BLVD', 'DRIVE':'DR',
+                 'LANE':'LN', 'COURT':'CT', 'PLACE':'PL'}
+
+NOISE = {'typo':0.5, 'abbrev':0.3, 'swap':0.1}
+
+def typo(value, rng):
+    if(len(value) < 2): return value
+    i = rng.randrange(len(value))
+    kind = rng.randrange(4)
+    if(kind == 0): return value[:i] + value[i+1:]
+    if(kind == 1): return value[:i] + rng.choice(string.ascii_uppercase) + value[i:]
+    if(kind == 2): return value[:i] + rng.choice(string.ascii_uppercase) + value[i+1:]
+    i = min(i, len(value) - 2)
+    return value[:i] + value[i+1] + value[i] + value[i+2:]
+
+def abbrev(value, rng):
+    words = value.split()
+    options = [i for i, word in enumerate(words) if word in ABBREVIATIONS]
+    if(not options): return value
+    i = rng.choice(options)
+    words[i] = ABBREVIATIONS[words[i]]
+    return ' '.join(words)
+
+def swap(value, rng):
+    words = value.split()
+    if(len(words) < 2): return value
+    i = rng.randrange(len(words) - 1)
+    words[i], words[i+1] = words[i+1], words[i]
+    return ' '.join(words)
+
+__noise__ = {'typo':typo, 'abbrev':abbrev, 'swap':swap}
+
+def noisy(value, rng, noise = NOISE):
+    for kind in ('abbrev', 'swap', 'typo'):
+        if(rng.random() < noise.get(kind, 0)):
+            value = __noise__[kind](value, rng)
+    return value
+
+def universe_records(n, rng, states = STATES):
+    seen = set()
+    while(len(seen) < n):
+        name = ' '.join(rng.sample(NAME_WORDS, rng.randint(1, 3)) + [rng.choice(NAME_SUFFIXES)])
+        address = '{} {} {}'.format(rng.randint(1, 9999), rng.choice(STREET_WORDS), rng.choice(STREET_SUFFIXES))
+        key = (name, address)
+        if(key in seen): continue
+        seen.add(key)
+        yield {'NAME':name, 'ADDRESS':address, 'STATE':rng.choice(states), 'SRCID':'U{:08d}'.format(len(seen))}
+
+def generate(universe_path, target_path, universe_size = 20000, target_size = 1000, noise = NOISE, seed = 0, delim = '\t'):
+    '''Write universe and target files, returns list of [target record, TRUEID]'''
+    rng = random.Random(seed)
+    universe = list(universe_records(universe_size, rng))
+    with open(universe_path, mode='w', encoding='UTF-8') as w:
+        w.write(delim.join(['NAME', 'ADDRESS', 'STATE', 'SRCID']) + '\n')
+        for rec in universe:
+            w.write(delim.join([rec['NAME'], rec['ADDRESS'], rec['STATE'], rec['SRCID']]) + '\n')
+
+    targets = []
+    with open(target_path, mode='w', encoding='UTF-8') as w:
+        w.write(delim.join(['NAME', 'ADDRESS', 'STATE', 'TRUEID']) + '\n')
+        for rec in rng.sample(universe, min(target_size, len(universe))):
+            target = {'NAME':noisy(rec['NAME'], rng, noise), 'ADDRESS':noisy(rec['ADDRESS'], rng, noise),
+                      'STATE':rec['STATE'], 'TRUEID':rec['SRCID']}
+            targets.append([target, rec['SRCID']])
+            w.write(delim.join([target['NAME'], target['ADDRESS'], target['STATE'], target['TRUEID']]) + '\n')
+    return targets
@@ -0,0 +1,109 @@
+#/roxrec/benchmarks/parsecheck.py
+'''
+## ========================================================================== ##
+- Checks FileParser against parsing line by line as PreprocessPiper did
+   before it (text mode read, errors='ignore', then clean, split and zip per
+   line), on random files and on the cases that once differed, and times both
+   on a generated universe file
+    python -m benchmarks.parsecheck --trials 1500 --rows 100000
+- Random files mix ASCII, multi byte and invalid UTF-8, tabs, spaces, \r\n
+   and lone \r, every file parsed with several delimiters and chunk sizes
+   from one byte up so chunk edges land everywhere.
+- Exits non zero and prints the first differing inputs when any differ.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+## Package
+import benchmarks
+from benchmarks.generator import generate
+from pipeline import Pipeline
+from fileparser import FileParser
+
+ALPHABET = ['a', 'B', '1', ' ', '\t', '\t', '\n', '\r', '\r\n', ',', '|', '\xe9', '\xa0', '\x85',
+            '\U0001f600', '\x00', '\x1f', '　']
+INVALID = [0xc3, 0xa9, 0xff, 0x80]
+DELIMS = ['\t', ' ', ',', '|']
+CHUNK_BYTES = [1, 7, 1<<20]
+
+#Inputs that differed once, kept so they are always checked
+CASES = [(b'F0\tF1\n\xff', '\t'), (b'F0\n\xff\xfe\n', '\t'),
+         (b'F0\nA\nB\n', ','), (b'F0,F1\nA,B\n', ','), (b'F0|F1\nA|B\n', '|'),
+         (b'F0\tF1\nA\r\xffB\n', '\t'), (b'F0\tF1\nA\tB\n!!', '\t')]
+
+def lines(p, filepath, delim = '\t'):
+    '''Header and records parsed line by line, the reference FileParser must equal'''
+    with open(filepath, encoding = FileParser.encoding, errors = 'ignore') as r:
+        header = p.clean(r.readline()).split(delim)
+        pad = ['']*len(header)
+        return header, [dict(zip(header, p.clean(line).split(delim) + pad)) for line in r.readlines()]
+
+def chunks(p, filepath, delim = '\t', chunk_bytes = None):
+    batches = FileParser(p, delim, chunk_bytes).parse(filepath)
+    header = next(batches)
+    return header, [rec for batch in batches for rec in batch.records()]
+
+def randomfile(rng):
+    raw = ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 300))).encode(FileParser.encoding)
+    if(rng.random() < 0.5): raw = raw.decode(FileParser.encoding).encode('ascii', 'ignore')
+    if(raw and rng.random() < 0.3):
+        i = rng.randrange(len(raw))
+        raw = raw[:i] + bytes([rng.choice(INVALID)]) + raw[i:]
+    return raw
+
+def regularfile(rng):
+    '''Mostly well formed tab separated rows, the one pass split path'''
+    rows = ['\t'.join(''.join(rng.choice('AB 1') for _ in range(rng.randint(0, 4))) for _ in range(rng.choice([3, 3, 3, 2, 4])))
+            for _ in range(rng.randint(1, 20))]
+    return ('\n'.join(rows) + rng.choice(['', '\n', '\n\n'])).encode(FileParser.encoding)
+
+def check(p, filepath, raw, delims, diffs):
+    with open(filepath, 'wb') as w: w.write(raw)
+    for delim in delims:
+        expected = lines(p, filepath, delim)
+        for chunk_bytes in CHUNK_BYTES:
+            if(chunks(p, filepath, delim, chunk_bytes) != expected):
+                diffs.append((raw, delim, chunk_bytes))
+
+def run(args):
+    p = Pipeline('parsecheck')
+    rng = random.Random(args.seed)
+    tmpdir = tempfile.mkdtemp(prefix = 'parsecheck_')
+    filepath = os.path.join(tmpdir, 'fuzz.txt')
+    diffs = []
+
+    for raw, delim in CASES: check(p, filepath, raw, [delim], diffs)
+    for _ in range(args.trials):
+        check(p, filepath, randomfile(rng), DELIMS, diffs)
+        check(p, filepath, regularfile(rng), ['\t'], diffs)
+
+    universe_file = os.path.join(tmpdir, 'universe.txt')
+    generate(universe_file, os.path.join(tmpdir, 'targets.txt'), args.rows, 0, seed = args.seed)
+    start = time.time()
+    expected = lines(p, universe_file)
+    seconds = time.time() - start
+    start = time.time()
+    same = chunks(p, universe_file) == expected
+    print('{} rows: line by line {:.2f}s, FileParser {:.2f}s, same {}'.format(args.rows, seconds, time.time() - start, same))
+    if(not same): diffs.append((universe_file, '\t', FileParser.chunk_bytes))
+
+    for raw, delim, chunk_bytes in diffs[:5]:
+        print('DIFF', repr(raw), repr(delim), chunk_bytes)
+    print('{} differences'.format(len(diffs)))
+    shutil.rmtree(tmpdir, ignore_errors = True)
+    return not diffs
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description = 'FileParser against line by line parsing')
+    parser.add_argument('--trials', type = int, default = 1500, help = 'random files of each kind')
+    parser.add_argument('--rows', type = int, default = 100000, help = 'rows of the generated universe file timed')
+    parser.add_argument('--seed', type = int, default = 0)
+    sys.exit(0 if run(parser.parse_args()) else 1)
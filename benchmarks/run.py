@@ -0,0 +1,230 @@
+#/roxrec/benchmarks/run.py
+'''
+## ========================================================================== ##
+- Runs every stage of the matching pipeline against generated data and saves
+   timings and match quality as JSON, so runs can be compared across versions
+    python -m benchmarks.run --universe 20000 --targets 1000 --out bench.json
+- Stages
+    upload      - PreprocessPiper.upload_universe_file with metadata
+    build       - RecordMatcher construction, one RecordLSH per filter partition, with
+                  LSH parameters tuned per field first when --tune is given
+    match       - RecordMatcher.match on every target, latency and canidates per target
+    match_batch - RecordMatcher.match_batch on the targets in batches of --batch, mismatches
+                  counts targets where it differs from match (the run exits non zero if any)
+    match_file  - RecordMatcher.match_file on the target file with --workers workers
+    quality     - recall and precision against ground truth, and for --brute targets
+                  against brute force scoring of their whole partition
+- Every stage records seconds, resident memory after it and peak resident memory.
+- Counters and stage timings of the whole run (RecordMatcher.stats) saved under metrics.
+- --store is a storage url (see storage.py): memory (default) or
+   sqlite:///path need no server, mongodb://host:port is a local mongod,
+   mongomock runs pymongo's API in memory. Collections of --name are dropped
+   before running.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+## Package
+import benchmarks
+from benchmarks.generator import generate
+from general import *
+from pipeline import Pipeline
+from preprocesspiper import PreprocessPiper
+from storage import connect
+from lshtuner import load_params
+
+## Additional
+import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def __rss__():
+    '''Current resident memory in MB, None where unavailable'''
+    try:
+        with open('/proc/self/statm') as r:
+            return int(r.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1<<20)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def __peakrss__():
+    if(resource is None): return None
+    #ru_maxrss in kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1<<10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1<<20)
+
+class Stage():
+    '''Times a with block and records memory into results[name]'''
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.stats = results.setdefault(name, {})
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.stats
+
+    def __exit__(self, *args):
+        self.stats['seconds'] = time.perf_counter() - self.start
+        self.stats['rss_mb'] = __rss__()
+        self.stats['peak_rss_mb'] = __peakrss__()
+
+def percentiles(values, ps = (50, 95, 99)):
+    if(not values): return {}
+    return dict(('p{}'.format(p), float(np.percentile(values, p))) for p in ps)
+
+def use_store(store):
+    if(store == 'mongomock'):
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        client = mongomock.MongoClient()
+        Pipeline.__connect__ = lambda *args, **kwargs: client
+        return client
+    Pipeline.__storage__ = store
+    return connect(store)
+
+def purge(client, name):
+    db = client[Pipeline.__database__]
+    for table in db.list_collection_names():
+        if(table.split('_')[0] == name or table in ('meta_{}'.format(name), 'fs.chunks', 'fs.files')):
+            db.drop_collection(table)
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = benchmarks.PATH,
+                                       stderr = subprocess.DEVNULL, text = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    from recordmatcher import RecordMatcher
+
+    client = use_store(args.store)
+    purge(client, args.name)
+
+    fields = ['NAME', 'ADDRESS']
+    weights = {'NAME':80, 'ADDRESS':20}
+    workdir = tempfile.mkdtemp(prefix = 'roxrec_bench_')
+    universe_file = os.path.join(workdir, 'universe.txt')
+    target_file = os.path.join(workdir, 'targets.txt')
+    targets = generate(universe_file, target_file, args.universe, args.targets, seed = args.seed)
+
+    results = {'version':version(), 'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'params':vars(args), 'stages':{}}
+    stages = results['stages']
+
+    with Stage(stages, 'upload') as stats:
+        pipeline = Pipeline(args.name)
+        PreprocessPiper(pipeline).upload_universe_file(universe_file, build_meta = True)
+        stats['rows'] = args.universe
+        #Marked as uploaded so RecordMatcher only builds partitions
+        client[Pipeline.__database__]['meta_{}'.format(args.name)].insert_one({'sha1':sha1_file(universe_file), 'source':universe_file})
+    stats['rows_per_sec'] = args.universe / stats['seconds']
+
+    with Stage(stages, 'build') as stats:
+        matcher = RecordMatcher(args.name, fields, universe_file = universe_file, field_weights = weights,
+                                exact = ['STATE'], scoring = args.scoring, tune_lsh = args.tune)
+        stats['partitions'] = len(matcher.filters)
+        stats['lsh_params'] = load_params(pipeline)
+
+    latencies, canidates, found = [], [], []
+    with Stage(stages, 'match') as stats:
+        for target, _ in targets:
+            lsh = matcher.__getfilteredLSH__(target)
+            canidates.append(len(lsh.canidate_keys(target)))
+            start = time.perf_counter()
+            try: found.append(matcher.match(dict(target)))
+            except StopIteration: found.append({})
+            latencies.append(time.perf_counter() - start)
+    stats['matches_per_sec'] = len(targets) / stats['seconds']
+    stats['latency_ms'] = percentiles([1000*x for x in latencies])
+    stats['canidates_per_target'] = dict(percentiles(canidates), mean = float(np.mean(canidates)))
+
+    batched = []
+    with Stage(stages, 'match_batch') as stats:
+        for i in range(0, len(targets), args.batch):
+            batched.extend(matcher.match_batch([dict(target) for target, _ in targets[i:i+args.batch]]))
+    stats['batch_size'] = args.batch
+    stats['matches_per_sec'] = len(targets) / stats['seconds']
+    stats['mismatches'] = sum(1 for single, batch in zip(found, batched) if single != batch)
+
+    with Stage(stages, 'match_file') as stats:
+        outfile = matcher.match_file(target_file, os.path.join(workdir, 'out.txt'), worker_count = args.workers)
+        with open(outfile, encoding = 'UTF-8') as r:
+            rows = list(csv.reader(r, delimiter = '\t'))
+        stats['workers'] = args.workers
+        stats['matches'] = max(len(rows) - 1, 0)
+    stats['matches_per_sec'] = len(targets) / stats['seconds']
+
+    quality = stages['quality'] = {}
+    correct = sum(1 for (_, truth), match in zip(targets, found) if match.get('SRCID') == truth)
+    returned = sum(1 for match in found if match)
+    quality['recall'] = correct / max(len(targets), 1)
+    quality['precision'] = correct / max(returned, 1)
+    if(rows):
+        header = rows[0]
+        split = header.index('===')
+        truth, src = header.index('TRUEID'), split + 1 + header[split+1:].index('SRCID')
+        quality['match_file_recall'] = sum(1 for row in rows[1:] if row[truth] == row[src]) / max(len(targets), 1)
+    quality.update(brute_force(matcher, targets, args.brute, args.seed))
+    results['metrics'] = matcher.stats()
+
+    json.dump(results, open(args.out, mode = 'w'), indent = 2)
+    return results
+
+def brute_force(matcher, targets, n, seed):
+    '''Best scoring record of whole partition against LSH canidates and LSH best, for n sampled targets'''
+    sample = random.Random(seed).sample(targets, min(n, len(targets)))
+    partitions = {}
+    in_canidates, agree, truth = 0, 0, 0
+    for target, true_id in sample:
+        target = dict(target)
+        matcher.__preprocessor__.__buildmetadata__(target, matcher.fields)
+        lsh = matcher.__getfilteredLSH__(target)
+        key = id(lsh)
+        if(key not in partitions):
+            ids = [lsh.keys[i] for i in range(len(lsh.keys)) if i not in getattr(lsh, 'removed', ())]
+            partitions[key] = list(lsh.fetch_records(ids))
+        best = next(lsh.__score__(target, partitions[key], 0.0, 1), None)
+        if(best is None): continue
+        ids = set(lsh.keys[c] for c in lsh.canidate_keys(target))
+        lsh_best = next(lsh.match(target, top_k = 1), None)
+        in_canidates += best[1]['_id'] in ids
+        agree += lsh_best is not None and lsh_best[1]['_id'] == best[1]['_id']
+        src = lsh.p.collection().find_one({'_id':best[1]['_id']}, {'SRCID':1})
+        truth += (src or {}).get('SRCID') == true_id
+    return {'brute_force_targets':len(sample),
+            'lsh_recall':in_canidates / max(len(sample), 1),
+            'top1_agreement':agree / max(len(sample), 1),
+            'brute_force_recall':truth / max(len(sample), 1)}
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description = 'roxrec benchmarks')
+    parser.add_argument('--universe', type = int, default = 20000, help = 'universe records')
+    parser.add_argument('--targets', type = int, default = 1000, help = 'target records')
+    parser.add_argument('--brute', type = int, default = 100, help = 'targets also scored against their whole partition')
+    parser.add_argument('--workers', type = int, default = 2)
+    parser.add_argument('--batch', type = int, default = 64, help = 'targets per match_batch call')
+    parser.add_argument('--scoring', default = 'bow', choices = ['bow', 'tfidf'])
+    parser.add_argument('--store', default = 'memory', help = 'memory, sqlite:///path, mongodb://host:port or mongomock')
+    parser.add_argument('--name', default = 'bench', help = 'table name, its collections are dropped first')
+    parser.add_argument('--tune', action = 'store_true', help = 'tune LSH parameters per field before building')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--out', default = 'bench.json')
+    results = run(parser.parse_args())
+    print(json.dumps(results['stages'], indent = 2))
+    if(results['stages']['match_batch']['mismatches']):
+        sys.exit('match_batch differs from match for {} targets'.format(results['stages']['match_batch']['mismatches']))
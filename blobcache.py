@@ -0,0 +1,76 @@
+#/roxrec/blobcache.py
+'''
+## ========================================================================== ##
+- BlobCache keeps downloaded Broker blobs in a local directory, one file per
+   blob named by the sha1 of its content, so a blob is only fetched from
+   MongoDB/GridFS once per machine no matter how many workers or runs use it.
+- Content addressed files never change once written, a new upload under the
+   same name has a new sha1 and so a new file. Stale files age out.
+- Files written to a temporary file in the cache directory then renamed into
+   place, concurrent writers of the same blob each rename a complete copy.
+- Reads refresh file modification time. Once directory size passes max_size
+   the least recently used files are removed, readers that already opened or
+   mapped a removed file keep their copy until closed.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import os
+import tempfile
+
+## Additional
+import numpy as np
+
+class BlobCache():
+
+    max_size = 4<<30
+    directory = os.environ.get('ROXREC_CACHE', os.path.join(tempfile.gettempdir(), 'roxrec_cache'))
+
+    def __init__(self, directory = None, max_size = None):
+        self.directory = directory or BlobCache.directory
+        self.max_size = max_size or BlobCache.max_size
+        os.makedirs(self.directory, exist_ok = True)
+
+    def path(self, sha1):
+        return os.path.join(self.directory, '{}{ext}blob'.format(sha1, ext = os.path.extsep))
+
+    def get(self, sha1, mmap = False):
+        '''Cached blob as bytes (or read only uint8 memmap), None when not cached'''
+        path = self.path(sha1)
+        try:
+            os.utime(path)
+            if(mmap): return np.memmap(path, dtype=np.uint8, mode='r')
+            with open(path, mode='rb') as r:
+                return r.read()
+        except (FileNotFoundError, ValueError):
+            #ValueError from mapping an empty file
+            return None
+
+    def put(self, sha1, blob):
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '{}tmp'.format(os.path.extsep))
+        try:
+            with os.fdopen(fd, mode='wb') as w:
+                w.write(blob)
+            os.replace(tmp, self.path(sha1))
+        except BaseException:
+            try: os.remove(tmp)
+            except OSError: pass
+            raise
+        self.evict()
+        return self.path(sha1)
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if(not entry.name.endswith('blob')): continue
+            try: files.append([entry.stat().st_mtime, entry.stat().st_size, entry.path])
+            except FileNotFoundError: continue
+        size = sum(f[1] for f in files)
+        for _, fsize, path in sorted(files):
+            if(size <= self.max_size): break
+            try:
+                os.remove(path)
+                size -= fsize
+            except OSError:
+                #Removed by another process, or still mapped on platforms that forbid it
+                continue
@@ -5,19 +5,29 @@
 ##  - serializes and stores python objects either directly in MongoDB
 ##    or on Grid File System on disk
 ## - Metadata about objects include name and storeage location
-## - All objects stored using broker required to have unique name
+## - All objects stored using broker required to have unique name,
+##    uploading under an existing name replaces the stored object
 ## - Name used to identify objects, required for lookup and downloads
 ## - Name set on upload
+## - Raw byte blobs can be stored and fetched as is with upload_blob and
+##    download_blob, for objects that serialize themselves
+## - Every upload stamped with sha1 of its bytes, downloads kept in local
+##    BlobCache by sha1 so MongoDB only asked whether the stamp changed
+## - Objects too large for a record kept in the pipeline's blob store,
+##    GridFS on MongoDB (see Pipeline.blobs)
 ## Author: Michael Pavlak
 ## ========================================================================== ##
 '''
 
+## Built-ins
+import hashlib
+
 ## Package
 import __init__
 from general import *
+from blobcache import BlobCache
 
 ##Additional
-import gridfs
 import dill as pickle
 
 
@@ -25,41 +35,76 @@ class Broker():
 
     def __hash__(self, s): return hashstring(str(s))
 
-    def __init__(self, pipeline):
+    def __init__(self, pipeline, cache = True):
         #pipeline is Pipeline object initialized with valid argument to create MongoDB client connection
         self.p = pipeline 
+        #cache is True for the default local BlobCache, a BlobCache, or False to always download
+        self.cache = BlobCache() if cache is True else (cache or None)
+
+    def __meta__(self):
+        return self.p.collection('{}_meta_broker'.format(self.p.table))
 
-    def __upload_big__(self, serialized_obj, name):
-        fs = gridfs.GridFS(self.p.client()[self.p.database])
-        file_id = fs.put(serialized_obj)
+    def __upload_big__(self, serialized_obj, name, sha1):
+        file_id = self.p.blobs().put(serialized_obj)
         r = {'_id': self.__hash__(name),
              'name':name,
+             'sha1':sha1,
              'file_id':file_id}
-        self.p.client()[self.p.database]['{}_meta_broker'.format(self.p.table)].insert_one(r)
+        self.__meta__().replace_one({'_id':r['_id']}, r, upsert = True)
 
     def upload_obj(self, obj, name):
         try:
             serialized_obj = pickle.dumps(obj, recurse = True)
         except Exception as e:
             serialized_obj = pickle.dumps(obj, recurse = False)
+        self.upload_blob(serialized_obj, name)
+
+    def upload_blob(self, blob, name):
+        #Bytes stored as given, objects with their own format (see packedlsh.py) skip pickling
+        sha1 = hashlib.sha1(blob).hexdigest()
+        #Uploading under an existing name replaces the object
+        previous = self.__meta__().find_one({'_id':self.__hash__(name)}, {'file_id':1})
         try:
             r = {'_id': self.__hash__(name),
                  'name':name,
-                 'obj':serialized_obj}
+                 'sha1':sha1,
+                 'obj':blob}
             
-            self.p.client()[self.p.database]['{}_meta_broker'.format(self.p.table)].insert_one(r)
+            self.__meta__().replace_one({'_id':r['_id']}, r, upsert = True)
         except Exception as e:
-            self.__upload_big__(serialized_obj, name)
+            self.__upload_big__(blob, name, sha1)
+        if(previous and 'file_id' in previous):
+            self.p.blobs().delete(previous['file_id'])
+        if(self.cache): self.cache.put(sha1, blob)
                 
     def __download_big__(self, file_id):
-        fs = gridfs.GridFS(self.p.client()[self.p.database])
-        return pickle.loads(fs.get(file_id).read())
+        return self.p.blobs().get(file_id).read()
 
     def download_obj(self, name):
-        rec = self.p.client()[self.p.database]['{}_meta_broker'.format(self.p.table)].find_one({'_id':self.__hash__(name)})   
+        return self.loads(self.download_blob(name))
+
+    def download_blob(self, name, mmap = False):
+        '''Blob stored under name, from local cache when its sha1 is cached, mmap returns cached blob memory mapped'''
+        #Only the small meta record fetched to check freshness, blob itself fetched on cache miss
+        rec = self.__meta__().find_one({'_id':self.__hash__(name)}, {'obj':0})
         assert rec
-        if('obj' in rec):
-            return pickle.loads(rec['obj'])
-        elif('file_id' in rec):
-            return self.__download_big__(rec['file_id'])
-        else: raise KeyError
+        sha1 = rec.get('sha1')
+        if(self.cache and sha1):
+            blob = self.cache.get(sha1, mmap)
+            if(blob is not None): return blob
+
+        if('file_id' in rec):
+            blob = self.__download_big__(rec['file_id'])
+        else:
+            blob = self.__meta__().find_one({'_id':self.__hash__(name)}, {'obj':1}).get('obj')
+            if(blob is None): raise KeyError
+
+        #Objects uploaded before sha1 stamps were kept are never cached
+        if(self.cache and sha1):
+            self.cache.put(sha1, blob)
+            cached = self.cache.get(sha1, mmap) if mmap else None
+            if(cached is not None): return cached
+        return blob
+
+    def loads(self, blob):
+        return pickle.loads(bytes(blob))
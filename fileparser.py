@@ -0,0 +1,141 @@
+#/roxrec/fileparser.py
+'''
+## ========================================================================== ##
+- FileParser reads universe and target files as raw bytes about chunk_bytes
+   at a time (always ending on a line break) and yields the header, then a
+   ColumnBatch of cleaned values per chunk, one list per header field.
+- Chunks are cleaned whole with bytes.translate, not line by line, using a
+   256 byte table built from the pipeline replacement table. Pure ASCII
+   chunks (the usual case) are never decoded until split. Chunks with other
+   bytes first drop invalid UTF-8 as errors='ignore' always did, characters
+   past ASCII pass through untouched as they do Pipeline.clean.
+- Where every line of an ASCII chunk has exactly one value per field and no
+   leading or trailing whitespace (checked with NumPy over the chunk bytes)
+   the whole chunk is split in one call and sliced into columns. Other
+   chunks are split line by line, stripped, padded and truncated to header
+   length, same as parsing each line with clean, split and zip.
+- Line breaks follow text mode reading, \r\n and lone \r read as \n.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import itertools
+
+## Package
+import __init__
+from general import *
+
+## Additional
+import numpy as np
+
+NEWLINE = 10
+BLANKS = (9, 32) #ASCII whitespace Pipeline.clean keeps, stripped at line ends
+
+def bytetable(replacementtable):
+    '''(table, deletechars) for bytes.translate equal to replacementtable on ASCII, None if it maps outside ASCII'''
+    table, delete = bytearray(range(256)), bytearray()
+    for i in range(128):
+        v = replacementtable.get(i, i)
+        if(isinstance(v, str)):
+            if(len(v) != 1): return None
+            v = ord(v)
+        if(v is None): delete.append(i)
+        elif(v < 128): table[i] = v
+        else: return None
+    if(any(k >= 128 for k in replacementtable)): return None
+    return bytes(table), bytes(delete)
+
+class ColumnBatch():
+    '''Values of one chunk, columns[j] holds header[j] of each row'''
+
+    def __init__(self, header, columns):
+        self.header = header
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def rows(self):
+        return zip(*self.columns)
+
+    def records(self):
+        return list(map(dict, map(zip, itertools.repeat(self.header), self.rows())))
+
+class FileParser():
+
+    chunk_bytes = 1<<24
+    encoding = 'UTF-8'
+
+    def __init__(self, pipeline, delim = '\t', chunk_bytes = None):
+        self.p = pipeline
+        self.delim = delim
+        self.chunk_bytes = chunk_bytes or FileParser.chunk_bytes
+        self.__table__ = bytetable(pipeline.__replacementtable__)
+
+        #Single byte delimiters kept by the table can be counted over a whole chunk
+        d = delim.encode(FileParser.encoding)
+        self.__delimbyte__ = None
+        if(self.__table__ and len(d) == 1 and d[0] < 128 and d[0] not in self.__table__[1]):
+            self.__delimbyte__ = self.__table__[0][d[0]]
+
+    def __blocks__(self, r):
+        for block in iter(lambda: r.read(self.chunk_bytes), b''):
+            block += r.readline()
+            #Invalid bytes dropped first, as decoding in text mode does before line breaks are read
+            if(not block.isascii()): block = block.decode(FileParser.encoding, 'ignore').encode(FileParser.encoding)
+            if(b'\r' in block): block = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            #Block of nothing but invalid bytes holds no line
+            if(not block): continue
+            yield block
+
+    def parse(self, filepath):
+        '''Yields header, then a ColumnBatch per chunk of filepath'''
+        with open(filepath, mode = 'rb') as r:
+            blocks = self.__blocks__(r)
+            first = next(blocks, b'')
+            line, _, first = first.partition(b'\n')
+            header = self.p.clean(line.decode(FileParser.encoding, 'ignore')).split(self.delim)
+            yield header
+
+            if(first): yield self.__batch__(first, header)
+            for block in blocks:
+                yield self.__batch__(block, header)
+
+    def __batch__(self, block, header):
+        #Final line break taken off before cleaning, a last line cleaned to nothing is still a row
+        if(block.endswith(b'\n')): block = block[:-1]
+        if(not self.__table__):
+            text = block.decode(FileParser.encoding).translate(self.p.__replacementtable__)
+        else:
+            #Table only touches ASCII bytes, never part of a multi byte character
+            block = block.translate(*self.__table__)
+            if(block.isascii()):
+                columns = self.__regular__(block, len(header))
+                if(columns is not None): return ColumnBatch(header, columns)
+            text = block.decode(FileParser.encoding)
+        return ColumnBatch(header, self.__split__(text, len(header)))
+
+    def __regular__(self, block, n):
+        '''Columns of block split in one pass, None unless every line holds n values and needs no strip'''
+        if(self.__delimbyte__ is None): return None
+        arr = np.frombuffer(block, dtype = np.uint8)
+        breaks = np.flatnonzero(arr == NEWLINE)
+        delims = np.flatnonzero(arr == self.__delimbyte__)
+        per_line = np.bincount(breaks.searchsorted(delims), minlength = len(breaks) + 1)
+        if((per_line != n - 1).any()): return None
+
+        starts = np.concatenate([[0], breaks + 1])
+        ends = np.concatenate([breaks, [len(arr)]])
+        full = ends > starts
+        edges = np.concatenate([arr[starts[full]], arr[ends[full] - 1]])
+        if(np.isin(edges, BLANKS).any()): return None
+
+        delim = chr(self.__delimbyte__)
+        values = block.decode('ascii').replace('\n', delim).split(delim)
+        return [values[j::n] for j in range(n)]
+
+    def __split__(self, text, n):
+        lines = text.split('\n')
+        delim, pad = self.delim, ['']*n
+        rows = [(line.strip().split(delim) + pad)[:n] for line in lines]
+        return [list(column) for column in zip(*rows)] if rows else [[] for _ in range(n)]
@@ -0,0 +1,177 @@
+#/roxrec/frequencytable.py
+'''
+## ========================================================================== ##
+- FrequencyTable holds the word and gram counts generated on universe upload
+   in memory, so building metadata for a record does not require a round
+   trip to MongoDB for every word and every gram.
+- Counts for each field stored as a sorted array of 64 bit hashed ids with a
+   parallel array of counts, rather than a dict of strings. Grams are keyed
+   by their integer gram id (shingles.py) so gram_counts looks up ids from
+   the shingling kernel directly, without building gram strings.
+- Lazy tables skip the full load and instead look up each (field, elem)
+   on first use, keeping results in a bounded LRU cache.
+- Tables check the version stamp written by PreprocessPiper.__update_count__
+   at most once every refresh_interval seconds and reload when it changes.
+- One table per database/table kept for the whole process, get with
+   get_frequencytable. Forked children drop the inherited connections.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import os
+import time
+import threading
+
+## Package
+import __init__
+from general import *
+from metrics import get_metrics
+from shingles import gram_id, gram_string
+
+## Additional
+import numpy as np
+from xxhash import xxh64 as h64
+
+COUNT_TYPES = ('wordcount', 'gramcount')
+
+__frequencytables__ = {}
+__registry_lock__ = threading.Lock()
+def get_frequencytable(pipeline, lazy = False):
+    key = (pipeline.database, pipeline.table)
+    with __registry_lock__:
+        try: table = __frequencytables__[key]
+        except KeyError:
+            table = __frequencytables__[key] = FrequencyTable(pipeline, lazy = lazy)
+    table.check()
+    return table
+
+def __afterfork__():
+    #Clients are not fork safe, tables inherited by a forked child reconnect on first use
+    for table in __frequencytables__.values(): table.p.__client__ = None
+
+if(hasattr(os, 'register_at_fork')): os.register_at_fork(after_in_child = __afterfork__)
+
+def version_table(pipeline):
+    return pipeline.collection('{}_meta_countversion'.format(pipeline.table))
+
+def bump_version(pipeline):
+    version_table(pipeline).update_one({'_id':'counts'}, {'$inc':{'version':1}}, upsert = True)
+    #Tables in this process check again on next use instead of waiting out refresh_interval
+    try: __frequencytables__[(pipeline.database, pipeline.table)].expire()
+    except KeyError: pass
+
+def hashelem(elem):
+    return h64(elem.encode(FrequencyTable.encoding)).intdigest()
+
+def gramkey(elem):
+    return gram_id(elem) if len(elem) == 3 else hashelem(elem)
+
+__keyfuncs__ = {'wordcount':hashelem, 'gramcount':gramkey}
+
+class FrequencyTable():
+
+    encoding = 'UTF-8'
+    refresh_interval = 30 #seconds between version checks
+    cache_size = 1<<18 #entries kept by lazy tables
+
+    def __init__(self, pipeline, lazy = False):
+        self.p = pipeline.clone()
+        self.lazy = lazy
+
+        self.version = None
+        self.__checked__ = 0
+        self.__lock__ = threading.Lock()
+
+        self.__counts__ = {}
+        self.__sizes__ = {}
+        self.__cache__ = LRUCache(FrequencyTable.cache_size)
+        get_metrics().register_cache('frequencytable.{}'.format(self.p.table), self.__cache__)
+
+    def __collection__(self, count_type):
+        return self.p.collection('{}_meta_{}'.format(self.p.table, count_type))
+
+    def __currentversion__(self):
+        rec = version_table(self.p).find_one({'_id':'counts'})
+        return rec['version'] if rec else 0
+
+    def check(self):
+        '''Reload when counts have been rewritten since last load, checked at most every refresh_interval seconds'''
+        now = time.time()
+        if(self.version is not None and now - self.__checked__ < FrequencyTable.refresh_interval): return
+        with self.__lock__:
+            if(self.version is not None and now - self.__checked__ < FrequencyTable.refresh_interval): return
+            version = self.__currentversion__()
+            if(version != self.version):
+                self.load()
+                self.version = version
+            self.__checked__ = now
+
+    def expire(self):
+        self.__checked__ = 0
+
+    def load(self):
+        self.__cache__.clear()
+        self.__sizes__ = {}
+        self.__counts__ = {}
+        if(self.lazy): return
+
+        for count_type in COUNT_TYPES:
+            keyfunc = __keyfuncs__[count_type]
+            hashed = {}
+            for rec in self.__collection__(count_type).find({}, {'_id':0, 'field':1, 'count':1, count_type:1}):
+                try: field = hashed[rec['field']]
+                except KeyError: field = hashed[rec['field']] = [{}, 0]
+                field[1] += 1
+                #Count tables may hold more than one document per elem, keep first like find_one
+                field[0].setdefault(keyfunc(str(rec[count_type])), rec.get('count',1))
+
+            for field in hashed:
+                counts = hashed[field][0]
+                keys = np.fromiter(counts.keys(), dtype=np.uint64, count=len(counts))
+                vals = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+                order = np.argsort(keys)
+                self.__counts__[(count_type, field)] = (keys[order], vals[order])
+                self.__sizes__[(count_type, field)] = hashed[field][1]
+
+    def size(self, count_type, field):
+        '''Number of count documents for field, same as count_documents({'field':field})'''
+        try: return self.__sizes__[(count_type, field)]
+        except KeyError:
+            if(not self.lazy): return 0
+            size = self.__sizes__[(count_type, field)] = self.__collection__(count_type).count_documents({'field':field})
+            return size
+
+    def counts(self, count_type, field, elems, default = 1):
+        '''Counts of each elem in field, default when elem never seen'''
+        if(self.lazy):
+            return [self.__lazycount__(count_type, field, elem, default) for elem in elems]
+
+        keys = np.fromiter(map(__keyfuncs__[count_type], elems), dtype=np.uint64, count=len(elems))
+        return self.__lookup__(count_type, field, keys, default)
+
+    def gram_counts(self, field, ids, default = 1):
+        '''Counts of each gram id in field, default when gram never seen'''
+        if(self.lazy):
+            return [self.__lazycount__('gramcount', field, gram_string(int(i)), default) for i in ids]
+        return self.__lookup__('gramcount', field, np.asarray(ids, dtype=np.uint64), default)
+
+    def __lookup__(self, count_type, field, keys, default):
+        try: table, vals = self.__counts__[(count_type, field)]
+        except KeyError: return [default]*len(keys)
+
+        idx = np.minimum(table.searchsorted(keys), len(table) - 1)
+        found = table[idx] == keys
+        return np.where(found, vals[idx], default).tolist()
+
+    def count(self, count_type, field, elem, default = 1):
+        return self.counts(count_type, field, [elem], default)[0]
+
+    def __lazycount__(self, count_type, field, elem, default):
+        key = (count_type, field, elem)
+        count = self.__cache__.get(key)
+        if(count is None):
+            rec = self.__collection__(count_type).find_one({'field':field, count_type:elem})
+            count = rec.get('count',1) if rec else None
+            self.__cache__[key] = count if count is not None else -1
+        elif(count == -1): count = None
+        return default if count is None else count
@@ -13,9 +13,10 @@ from math import sqrt
 
 ## Package
 import __init__
+from lrucache import LRUCache
+from wordsim import similarity
 
 ## Additional Packages
-from nltk import edit_distance
 from xxhash import xxh32 as h32
 
 ## List index functions
@@ -25,7 +26,7 @@ def last(L): return L[-1]
 
 ## String Similarity Functions
 def string_sim(s0,s1):
-    return 1 - (edit_distance(s0,s1) / max(len(s0),len(s1)))
+    return similarity(s0,s1)
 
 def cosine_sim(v0, v1):
     L = len(v0)
@@ -0,0 +1,80 @@
+#/roxrec/indexplanner.py
+'''
+## ========================================================================== ##
+- IndexPlanner creates only the indexes the queries roxrec issues need,
+   rather than one per combination of fields.
+- Each planned query is the set of fields it matches on by equality. An index
+   serves it when its leading keys are exactly those fields in any order, so
+   one compound index covers a query and every query on a prefix of it.
+   Queries already served by an existing or planned index add nothing.
+- Queries issued by the package:
+    universe exact match (RecordMatcher.match) on all fuzzy fields
+    universe filter (RecordLSH partitions, count_documents) on exact fields
+    count table lookups (frequency tables, vocabulary index) on field, elem
+    target queue claims on lease token and lease expiry
+- build creates planned indexes missing from the collection, called once
+   bulk loading is done so inserts are not slowed by index maintenance.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import threading
+
+## Package
+import __init__
+from general import *
+
+## Additional
+import pymongo
+
+class IndexPlanner():
+
+    def __init__(self, pipeline):
+        self.p = pipeline
+        self.planned = {}
+
+    def __collection__(self, table):
+        return self.p.collection(table)
+
+    def __existing__(self, table):
+        return [[key for key, _ in info['key']] for info in self.__collection__(table).index_information().values()]
+
+    def plan(self, table, fields):
+        '''Plan index for equality query on fields, order of fields kept for a new index'''
+        fields = list(fields)
+        if(not fields): return self
+        planned = self.planned.setdefault(table, [])
+        if(any(set(idx[:len(fields)]) == set(fields) for idx in planned)): return self
+        #Shorter planned indexes on a prefix of this one are served by it
+        planned[:] = [idx for idx in planned if set(fields[:len(idx)]) != set(idx)]
+        planned.append(fields)
+        return self
+
+    def universe(self, fields, exact = ()):
+        self.plan(self.p.table, fields)
+        self.plan(self.p.table, exact)
+        return self
+
+    def counts(self, count_type):
+        return self.plan('{}_meta_{}'.format(self.p.table, count_type), ['field', count_type])
+
+    def targets(self):
+        table = '{}_target'.format(self.p.table)
+        self.plan(table, ['_lease.token'])
+        self.plan(table, ['_lease.expires'])
+        return self
+
+    def build(self, background = False):
+        '''Create planned indexes not already served, background runs without blocking the caller'''
+        def create():
+            for table in self.planned:
+                existing = self.__existing__(table)
+                for fields in self.planned[table]:
+                    if(any(set(idx[:len(fields)]) == set(fields) for idx in existing)): continue
+                    self.__collection__(table).create_index([(field, pymongo.ASCENDING) for field in fields])
+                    existing.append(fields)
+        if(background):
+            thread = threading.Thread(target = create)
+            thread.start()
+            return thread
+        create()
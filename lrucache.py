@@ -0,0 +1,55 @@
+#/roxrec/lrucache.py
+'''
+## ========================================================================== ##
+- Bounded least recently used cache shared by record, count and similarity
+   lookups. Kept in its own module so lower level modules can use it
+   without importing general.
+- Hit and miss counts kept on every cache to measure hit rates
+## ========================================================================== ##
+'''
+
+## Built-ins
+import threading
+from collections import OrderedDict
+
+class LRUCache():
+    '''Bounded mapping, least recently used entry evicted once maxsize exceeded'''
+
+    def __init__(self, maxsize = 100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__data__ = OrderedDict()
+        self.__lock__ = threading.Lock()
+
+    def __getstate__(self):
+        #Locks cannot be serialized, copies start empty
+        return {'maxsize':self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def __len__(self): return len(self.__data__)
+    def __contains__(self, key): return key in self.__data__
+
+    def get(self, key, default = None):
+        with self.__lock__:
+            try:
+                val = self.__data__[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.__data__.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def __setitem__(self, key, val):
+        with self.__lock__:
+            self.__data__[key] = val
+            self.__data__.move_to_end(key)
+            if(len(self.__data__) > self.maxsize):
+                self.__data__.popitem(last = False)
+
+    def clear(self):
+        with self.__lock__:
+            self.__data__.clear()
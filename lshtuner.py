@@ -0,0 +1,170 @@
+#/roxrec/lshtuner.py
+'''
+## ========================================================================== ##
+- LSHTuner picks MinHash LSH parameters (threshold, num_perm and the b bands
+   of r rows they give) for each fuzzy field, in place of RecordLSH.threshold
+   and RecordLSH.num_perm for every field of every partition.
+- Tuning samples up to sample_size universe records (ids are uniform hashes,
+   so records with the smallest ids are a random sample) and queries built
+   from query_size of them, each field edited once (a character dropped,
+   swapped or replaced, or a word dropped) so every query has a known true
+   record. Labeled [target record, universe _id] pairs can be given instead.
+- Each field and setting measured with the sample alone: signatures grouped
+   into band buckets with np.unique, canidates of each query the union over
+   bands of sample records sharing its bucket and its exact field values
+   (its filter partition). Recall is the share of queries whose true record
+   is a canidate, canidates per query scaled up to the universe size.
+- Picked setting has the fewest canidates among those reaching min_recall,
+   fewer permutations and higher threshold breaking ties, or the highest
+   recall when none reach it. Every setting measured kept in results.
+- save writes the picked parameters to {table}_meta_lshparams, RecordLSH
+   partitions built after read them with load_params and persist them.
+- RecordMatcher clears them with clear_params when a new universe file is
+   uploaded, they were picked for the records it had before.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import random
+import itertools
+
+## Package
+import __init__
+from general import *
+from minhasher import get_minhasher
+from recordhash import MASK63
+
+## Additional
+import numpy as np
+from datasketch import MinHashLSH
+
+PARAM_KEYS = ('threshold', 'num_perm', 'b', 'r')
+
+def params_table(pipeline):
+    return pipeline.collection('{}_meta_lshparams'.format(pipeline.table))
+
+def load_params(pipeline):
+    '''{field: {threshold, num_perm, b, r}} saved by LSHTuner.save, empty when never tuned'''
+    return dict((rec['_id'], dict((key, rec[key]) for key in PARAM_KEYS)) for rec in params_table(pipeline).find({}))
+
+def clear_params(pipeline):
+    '''Forget saved parameters, partitions built after use RecordLSH defaults until tuned again'''
+    params_table(pipeline).drop()
+
+def bands(threshold, num_perm):
+    '''(b, r) MinHashLSH picks for threshold and num_perm'''
+    lsh = MinHashLSH(threshold, num_perm)
+    return lsh.b, lsh.r
+
+def perturb(value, rng):
+    '''value with one edit, a character dropped, swapped or replaced or a word dropped'''
+    words = value.split()
+    if(len(words) > 1 and rng.random() < 0.25):
+        del words[rng.randrange(len(words))]
+        return ' '.join(words)
+    if(len(value) < 2): return value
+    i = rng.randrange(len(value) - 1)
+    kind = rng.randrange(3)
+    if(kind == 0): return value[:i] + value[i+1:]
+    if(kind == 1): return value[:i] + value[i+1] + value[i] + value[i+2:]
+    return value[:i] + rng.choice(value) + value[i+1:]
+
+class LSHTuner():
+
+    sample_size = 2000 #universe records sampled
+    query_size = 200 #queries measured per setting
+    num_perms = (64, 128, 256)
+    thresholds = (0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+    min_recall = 0.9
+
+    def __init__(self, pipeline, fields, exact = (), filter_ = {}, seed = 0):
+        self.p = pipeline
+        self.fields = fields
+        self.exact = list(exact)
+        self.filter_ = filter_
+        self.rng = random.Random(seed)
+        self.params = {}
+        self.results = {}
+
+    def __sample__(self, size):
+        db = self.p.collection()
+        total = db.count_documents(self.filter_)
+        if(not total): return [], 0
+        #Smallest ids of about size records, ids from record_hash are uniform over 63 bits
+        cutoff = int(MASK63 * min(1.0, 2.0 * size / total))
+        projection = dict.fromkeys(itertools.chain(self.fields, self.exact), 1)
+        query = dict(self.filter_, _id = {'$lte':cutoff})
+        sample = list(db.find(query, projection).limit(size))
+        if(len(sample) < min(size, total) // 2):
+            sample = list(db.find(self.filter_, projection).limit(size))
+        return sample, total
+
+    def tune(self, targets = None, sample_size = None, query_size = None, min_recall = None):
+        '''Measure every setting for each field, returns and keeps picked {field: {threshold, num_perm, b, r}}
+           targets are optional [target record, universe _id] pairs, self matched queries used otherwise'''
+        min_recall = LSHTuner.min_recall if min_recall is None else min_recall
+        sample, total = self.__sample__(sample_size or LSHTuner.sample_size)
+        if(targets):
+            ids = set(rec['_id'] for rec in sample)
+            wanted = [_id for _, _id in targets if _id not in ids]
+            projection = dict.fromkeys(itertools.chain(self.fields, self.exact), 1)
+            sample.extend(self.p.collection().find({'_id':{'$in':wanted}}, projection))
+            rows = dict((rec['_id'], i) for i, rec in enumerate(sample))
+            queries = [[target, rows[_id]] for target, _id in targets if _id in rows]
+        else:
+            rows = self.rng.sample(range(len(sample)), min(query_size or LSHTuner.query_size, len(sample)))
+            queries = [[dict((field, perturb(sample[i].get(field, ''), self.rng)) for field in self.fields), i] for i in rows]
+            for query, i in queries:
+                query.update((key, sample[i].get(key)) for key in self.exact)
+        if(len(sample) < 2 or not queries): return {}
+
+        truth = np.array([i for _, i in queries], dtype=np.int64)
+        #Canidates only counted within the query's own filter partition
+        partitions = {}
+        partition = lambda rec: partitions.setdefault(tuple(rec.get(key) for key in self.exact), len(partitions))
+        in_sample = np.array([partition(rec) for rec in sample])
+        same = np.array([partition(query) for query, _ in queries])[:, None] == in_sample[None, :]
+        scale = total / len(sample)
+
+        #Thresholds giving the same bands measured once, under the lowest of them
+        settings = {}
+        for num_perm in LSHTuner.num_perms:
+            for threshold in LSHTuner.thresholds:
+                settings.setdefault((num_perm,) + bands(threshold, num_perm), threshold)
+
+        for field in self.fields:
+            values = [rec.get(field, '') for rec in sample] + [query.get(field, '') for query, _ in queries]
+            measured = self.results[field] = []
+            for num_perm in LSHTuner.num_perms:
+                sigs = get_minhasher(num_perm).signatures(values)
+                for (n, b, r), threshold in settings.items():
+                    if(n != num_perm): continue
+                    canidates = self.__canidates__(sigs, len(sample), b, r) & same
+                    measured.append({'threshold':threshold, 'num_perm':num_perm, 'b':b, 'r':r,
+                                     'recall':float(canidates[np.arange(len(truth)), truth].mean()),
+                                     'canidates':float(canidates.sum(axis = 1).mean() * scale)})
+            self.params[field] = self.__pick__(measured, min_recall)
+        return self.params
+
+    def __canidates__(self, sigs, n, b, r):
+        '''Bool matrix, [j, i] when query j shares a band bucket with sample record i'''
+        canidates = np.zeros((len(sigs) - n, n), dtype=bool)
+        for band in range(b):
+            block = np.ascontiguousarray(sigs[:, band*r:(band+1)*r])
+            _, labels = np.unique(block.view(np.dtype((np.void, block.dtype.itemsize * r))).ravel(), return_inverse = True)
+            labels = labels.ravel()
+            canidates |= labels[n:, None] == labels[None, :n]
+        return canidates
+
+    def __pick__(self, measured, min_recall):
+        passing = [m for m in measured if m['recall'] >= min_recall]
+        if(passing): best = min(passing, key = lambda m: (m['canidates'], m['num_perm'], -m['threshold']))
+        else: best = max(measured, key = lambda m: (m['recall'], -m['canidates'], -m['num_perm']))
+        return dict((key, best[key]) for key in PARAM_KEYS)
+
+    def save(self):
+        '''Persist picked parameters for partitions built from now on, partitions already built keep theirs'''
+        table = params_table(self.p)
+        for field in self.params:
+            table.replace_one({'_id':field}, dict(self.params[field], _id = field), upsert = True)
+        return self
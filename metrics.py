@@ -0,0 +1,173 @@
+#/roxrec/metrics.py
+'''
+## ========================================================================== ##
+- Process wide counters and timing histograms for each stage of matching,
+   cheap enough to leave on (a lock and a perf_counter call per event).
+   Set ROXREC_METRICS=0 to turn them off.
+- with timer('stage'): ... records how long the block took in a histogram of
+   power of two microsecond buckets, incr('name', n) adds to a counter.
+- MongoDB round trips counted by a pymongo command listener, registered on
+   import so every client created afterwards reports every command.
+- LRU caches registered by name report their hit rates.
+- snapshot() is a plain dict that can cross process boundaries, merge() adds
+   one into this process, match_file workers send theirs back this way.
+- stats() adds per target rates, approximate timer percentiles and cache hit
+   rates to a snapshot.
+- set_profiler(hook) calls hook(stage, True) when a timed stage starts and
+   hook(stage, False) when it ends, to tag or toggle a sampling profiler.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import os
+import time
+import threading
+
+## Additional
+try:
+    import pymongo.monitoring
+except ImportError:
+    pymongo = None
+
+BUCKETS = 48
+
+class Metrics():
+
+    enabled = os.environ.get('ROXREC_METRICS', '1') != '0'
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.caches = {}
+        self.profiler = None
+        self.__lock__ = threading.Lock()
+
+    def incr(self, name, n = 1):
+        if(not Metrics.enabled): return
+        with self.__lock__:
+            try: self.counters[name] += n
+            except KeyError: self.counters[name] = n
+
+    def observe(self, name, seconds):
+        if(not Metrics.enabled): return
+        bucket = min(int(seconds * 1e6).bit_length(), BUCKETS - 1)
+        with self.__lock__:
+            try: t = self.timers[name]
+            except KeyError: t = self.timers[name] = {'count':0, 'total':0.0, 'max':0.0, 'buckets':[0]*BUCKETS}
+            t['count'] += 1
+            t['total'] += seconds
+            t['max'] = max(t['max'], seconds)
+            t['buckets'][bucket] += 1
+
+    def timer(self, name):
+        return Timer(self, name) if Metrics.enabled else __nulltimer__
+
+    def register_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def snapshot(self):
+        with self.__lock__:
+            snap = {'counters':dict(self.counters),
+                    'timers':dict((name, dict(t, buckets = list(t['buckets']))) for name, t in self.timers.items())}
+        for name, cache in self.caches.items():
+            snap['counters']['cache.{}.hits'.format(name)] = snap['counters'].get('cache.{}.hits'.format(name), 0) + cache.hits
+            snap['counters']['cache.{}.misses'.format(name)] = snap['counters'].get('cache.{}.misses'.format(name), 0) + cache.misses
+        return snap
+
+    def merge(self, snap):
+        '''Add a snapshot taken in another process'''
+        with self.__lock__:
+            for name, n in snap['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, other in snap['timers'].items():
+                try: t = self.timers[name]
+                except KeyError: t = self.timers[name] = {'count':0, 'total':0.0, 'max':0.0, 'buckets':[0]*BUCKETS}
+                t['count'] += other['count']
+                t['total'] += other['total']
+                t['max'] = max(t['max'], other['max'])
+                t['buckets'] = [a + b for a, b in zip(t['buckets'], other['buckets'])]
+
+    def reset(self):
+        with self.__lock__:
+            self.counters.clear()
+            self.timers.clear()
+        for cache in self.caches.values():
+            cache.hits, cache.misses = 0, 0
+
+    def stats(self):
+        '''Snapshot with per target rates, timer summaries and cache hit rates'''
+        snap = self.snapshot()
+        counters = snap['counters']
+        targets = counters.get('targets', 0)
+        out = {'counters':counters, 'timers':{}, 'per_target':{}, 'cache_hit_rate':{}}
+        for name, t in snap['timers'].items():
+            out['timers'][name] = {'count':t['count'], 'total_seconds':t['total'], 'max_seconds':t['max'],
+                                   'mean_seconds':t['total'] / max(t['count'], 1),
+                                   'p50_seconds':__percentile__(t, 0.5), 'p99_seconds':__percentile__(t, 0.99)}
+        if(targets):
+            for name in ('mongo.round_trips', 'canidates', 'fetch.records', 'bow_sim'):
+                out['per_target'][name] = counters.get(name, 0) / targets
+        for key in counters:
+            if(key.startswith('cache.') and key.endswith('.hits')):
+                name = key[len('cache.'):-len('.hits')]
+                total = counters[key] + counters.get('cache.{}.misses'.format(name), 0)
+                out['cache_hit_rate'][name] = counters[key] / total if total else None
+        return out
+
+class Timer():
+
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        if(self.metrics.profiler): self.metrics.profiler(self.name, True)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if(self.metrics.profiler): self.metrics.profiler(self.name, False)
+
+class __NullTimer__():
+    def __enter__(self): return self
+    def __exit__(self, *args): pass
+
+__nulltimer__ = __NullTimer__()
+
+def __percentile__(t, q):
+    '''Upper edge of the bucket holding the q-th observation'''
+    rank, seen = q * t['count'], 0
+    for i, n in enumerate(t['buckets']):
+        seen += n
+        if(n and seen >= rank): return min((1 << i) / 1e6, t['max'])
+    return t['max']
+
+__metrics__ = Metrics()
+
+def get_metrics(): return __metrics__
+def incr(name, n = 1): __metrics__.incr(name, n)
+def timer(name): return __metrics__.timer(name)
+def stats(): return __metrics__.stats()
+
+def set_profiler(hook):
+    __metrics__.profiler = hook
+
+if(pymongo is not None):
+    class MongoListener(pymongo.monitoring.CommandListener):
+        '''Counts every command sent to MongoDB, and its round trip time'''
+
+        def started(self, event): pass
+
+        def succeeded(self, event):
+            __metrics__.incr('mongo.round_trips')
+            __metrics__.incr('mongo.{}'.format(event.command_name))
+            __metrics__.observe('mongo', event.duration_micros / 1e6)
+
+        def failed(self, event):
+            __metrics__.incr('mongo.round_trips')
+            __metrics__.incr('mongo.failed')
+
+    pymongo.monitoring.register(MongoListener())
@@ -0,0 +1,163 @@
+#/roxrec/minhasher.py
+'''
+## ========================================================================== ##
+- MinHasher generates MinHash signatures for whole blocks of field values
+   at once, returning a NumPy signature matrix with one row per value.
+- Signatures are bit-compatible with datasketch MinHash objects built with
+   the same num_perm and seed, so indexes built with either can be queried
+   with the other.
+- Hash value of each shingle is memoized, shingles repeat heavily across
+   records so most of the SHA1 cost is only paid once per process.
+- Default shingles are tri gram ids from shingles.gram_ids, the block is
+   shingled in array operations and the memo keyed by id, so no shingle
+   strings are built except once per distinct gram for its SHA1. Hashes are
+   of the gram string so signatures match the string shingle path.
+- Permutations applied to every shingle of the block in one vectorized step
+   and reduced per value with np.minimum.reduceat.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import struct
+import hashlib
+
+## Package
+import __init__
+from shingles import gram_ids, gram_string
+
+## Additional
+import numpy as np
+from datasketch import MinHash, LeanMinHash
+
+_mersenne_prime = np.uint64((1 << 61) - 1)
+_max_hash = np.uint64((1 << 32) - 1)
+
+__minhashers__ = {}
+def get_minhasher(num_perm, seed = 1, scheme = None):
+    '''Process level registry, MinHasher holds permutations and hash memo that should not be rebuilt or pickled'''
+    key = (num_perm, seed, scheme)
+    try: return __minhashers__[key]
+    except KeyError:
+        __minhashers__[key] = MinHasher(num_perm, seed = seed, scheme = scheme)
+        return __minhashers__[key]
+
+def sha1_hash32(b):
+    return struct.unpack('<I', hashlib.sha1(b).digest()[:4])[0]
+
+def fmix32(hv):
+    hv = hv ^ (hv >> np.uint32(16))
+    hv = hv * np.uint32(0x85EBCA6B)
+    hv = hv ^ (hv >> np.uint32(13))
+    hv = hv * np.uint32(0xC2B2AE35)
+    return hv ^ (hv >> np.uint32(16))
+
+class MinHasher():
+
+    encoding = 'UTF-8'
+    max_memo = 1<<20 #distinct shingles kept in hash memo before it is reset
+    block_rows = 1<<16 #max shingle rows permuted at once, bounds temporary matrix size
+
+    def __init__(self, num_perm = 128, seed = 1, scheme = None):
+        #Prototype used so permutations and scheme always match what MinHash(num_perm) produces on this install
+        proto = MinHash(num_perm, seed = seed) if scheme is None else MinHash(num_perm, seed = seed, scheme = scheme)
+
+        self.num_perm = num_perm
+        self.seed = seed
+        self.scheme = getattr(proto, 'scheme', 'legacy')
+        if(self.scheme not in ('legacy', 'affine32')):
+            raise ValueError('Unsupported MinHash scheme {}'.format(self.scheme))
+
+        self.a, self.b = proto.permutations
+        self.empty = proto.hashvalues.copy()
+        self.dtype = self.empty.dtype
+        self.__memo__ = {}
+        self.__idmemo__ = {}
+
+    def hashes(self, shingles):
+        memo = self.__memo__
+        if(len(memo) > MinHasher.max_memo): memo.clear()
+        hvs = []
+        for s in shingles:
+            try: hvs.append(memo[s])
+            except KeyError:
+                hv = memo[s] = sha1_hash32(s.encode(MinHasher.encoding))
+                hvs.append(hv)
+        return hvs
+
+    def gram_hashes(self, ids):
+        '''SHA1 hash values of gram ids as uint64 array, each distinct id looked up once'''
+        memo = self.__idmemo__
+        if(len(memo) > MinHasher.max_memo): memo.clear()
+        uniq, inverse = np.unique(ids, return_inverse = True)
+        hvs = []
+        for i in uniq.tolist():
+            try: hvs.append(memo[i])
+            except KeyError:
+                hv = memo[i] = sha1_hash32(gram_string(i).encode(MinHasher.encoding))
+                hvs.append(hv)
+        return np.fromiter(hvs, dtype=np.uint64, count=len(hvs))[inverse]
+
+    def __permute__(self, hv):
+        if(self.scheme == 'legacy'):
+            hv = hv.astype(np.uint64).reshape(-1,1)
+            return np.bitwise_and((self.a * hv + self.b) % _mersenne_prime, _max_hash)
+        hv = fmix32(hv.astype(np.uint32)).reshape(-1,1)
+        return self.a * hv + self.b
+
+    def signatures(self, values, shingle = None):
+        '''Signature matrix (len(values) x num_perm) for values, tri gram ids of each value unless
+           shingle maps value to iterable of string shingles'''
+        if(shingle is not None): return self.__stringsignatures__(values, shingle)
+        sigs = np.tile(self.empty, (len(values), 1))
+
+        ids, offsets = gram_ids(values, distinct = False)
+        if(not len(ids)): return sigs
+        hv = self.gram_hashes(ids)
+        rows = np.nonzero(offsets[1:] > offsets[:-1])[0]
+        starts, ends = offsets[rows], offsets[rows+1]
+
+        #Blocks of whole values up to block_rows shingles, a longer value on its own
+        i = 0
+        while(i < len(rows)):
+            lo = starts[i]
+            j = max(i+1, int(np.searchsorted(ends, lo + MinHasher.block_rows, side = 'right')))
+            phv = self.__permute__(hv[lo:ends[j-1]])
+            sigs[rows[i:j]] = np.minimum.reduceat(phv, starts[i:j] - lo, axis=0)
+            i = j
+        return sigs
+
+    def __stringsignatures__(self, values, shingle):
+        sigs = np.tile(self.empty, (len(values), 1))
+
+        rows, offsets, hvs = [], [], []
+        total = 0
+
+        def flush():
+            if(not rows): return
+            phv = self.__permute__(np.fromiter(hvs, dtype=np.uint64, count=total))
+            sigs[rows] = np.minimum.reduceat(phv, offsets, axis=0)
+
+        for i, val in enumerate(values):
+            h = self.hashes(shingle(val))
+            if(not h): continue
+            if(total + len(h) > MinHasher.block_rows and rows):
+                flush()
+                rows, offsets, hvs = [], [], []
+                total = 0
+            rows.append(i)
+            offsets.append(total)
+            hvs.extend(h)
+            total += len(h)
+        flush()
+        return sigs
+
+    def signature(self, val, shingle = None):
+        return self.signatures([val], shingle)[0]
+
+    def lean(self, hashvalues):
+        '''Wrap signature row so it can be inserted into or used to query a MinHashLSH'''
+        try:
+            return LeanMinHash(seed = self.seed, hashvalues = hashvalues, scheme = self.scheme)
+        except TypeError:
+            #datasketch < 2.0 has no scheme, always legacy
+            return LeanMinHash(seed = self.seed, hashvalues = hashvalues)
@@ -0,0 +1,179 @@
+#/roxrec/packedlsh.py
+'''
+## ========================================================================== ##
+- PackedLSH is a read only MinHashLSH held in flat numpy arrays. Every band
+   bucket of a MinHashLSH becomes (xxh64 of band bytes, member key) pairs,
+   sorted by hash within each band, queried with searchsorted.
+- Blob format used to persist RecordLSH partitions:
+   magic, header length, JSON header, then 8 byte aligned arrays.
+   Header holds num_perm, threshold, b, r, fields, filter, field weights and
+   the offset, dtype and shape of every array.
+- Blobs read with frombuffer (bytes from MongoDB/GridFS) or memmap (file on
+   disk), so arrays are used in place without unpickling an object graph.
+- Partitions with keys that can not be packed as int64 still persisted with
+   dill by Broker.upload_obj.
+- update inserts and removes keys by rebuilding the sorted band arrays, so a
+   small delta costs one sort per band rather than minhashing every record.
+- query_counts also returns how many bands each member collided in, used to
+   rank canidates before any are fetched (see RecordLSH.canidate_scores).
+## ========================================================================== ##
+'''
+
+## Built-ins
+import json
+import struct
+
+## Package
+import __init__
+from general import *
+
+## Additional
+import numpy as np
+from xxhash import xxh64
+
+MAGIC = b'RXLSH\x00\x00\x01'
+ALIGN = 8
+
+def __bandhash__(hs):
+    #Same band bytes MinHashLSH uses as bucket key, reduced to 64 bits
+    return xxh64(bytes(np.asarray(hs).byteswap().data)).intdigest()
+
+class PackedLSH():
+
+    def __init__(self, num_perm, threshold, b, r, offsets, hashes, members):
+        self.h = num_perm
+        self.threshold = threshold
+        self.b, self.r = b, r
+        self.hashranges = [(i * r, (i + 1) * r) for i in range(b)]
+        self.offsets = offsets
+        self.hashes = hashes
+        self.members = members
+
+    @classmethod
+    def from_lsh(cls, lsh, threshold = None):
+        '''Pack a dict storage MinHashLSH, buckets keyed by band bytes become sorted xxh64 runs'''
+        offsets, hashes, members = [0], [], []
+        for table in lsh.hashtables:
+            pairs = sorted((xxh64(H).intdigest(), key) for H in table.keys() for key in table.get(H))
+            hashes.extend(map(first, pairs))
+            members.extend(map(second, pairs))
+            offsets.append(len(hashes))
+        return cls(lsh.h, threshold, lsh.b, lsh.r, np.array(offsets, dtype=np.int64),
+                   np.array(hashes, dtype=np.uint64), np.array(members, dtype=np.int64))
+
+    def __len__(self):
+        return len(np.unique(self.members))
+
+    def update(self, keys, hashvalues, removed = ()):
+        '''Insert keys with their MinHash hashvalues and drop removed keys, each band re-sorted in place of the old arrays'''
+        removed = np.array(list(removed), dtype=np.int64)
+        keys = np.array(list(keys), dtype=np.int64)
+        offsets, hashes, members = [0], [], []
+        for i, (start, end) in enumerate(self.hashranges):
+            lo, hi = self.offsets[i], self.offsets[i+1]
+            h, m = self.hashes[lo:hi], self.members[lo:hi]
+            if(len(removed)):
+                keep = ~np.isin(m, removed)
+                h, m = h[keep], m[keep]
+            added = np.fromiter((__bandhash__(hv[start:end]) for hv in hashvalues), dtype=np.uint64, count=len(keys))
+            h, m = np.concatenate([h, added]), np.concatenate([m, keys])
+            order = np.lexsort((m, h))
+            hashes.append(h[order])
+            members.append(m[order])
+            offsets.append(offsets[-1] + len(order))
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.hashes = np.concatenate(hashes).astype(np.uint64)
+        self.members = np.concatenate(members).astype(np.int64)
+
+    def query(self, minhash):
+        canidates = set()
+        hv = minhash.hashvalues
+        for i, (start, end) in enumerate(self.hashranges):
+            lo, hi = self.offsets[i], self.offsets[i+1]
+            band = self.hashes[lo:hi]
+            h = np.uint64(__bandhash__(hv[start:end]))
+            left = np.searchsorted(band, h, side='left')
+            right = np.searchsorted(band, h, side='right')
+            canidates.update(self.members[lo+left:lo+right].tolist())
+        return list(canidates)
+
+    def query_counts(self, minhash):
+        '''(members, bands each member collided with minhash in), members sorted'''
+        hv = minhash.hashvalues
+        runs = []
+        for i, (start, end) in enumerate(self.hashranges):
+            lo, hi = self.offsets[i], self.offsets[i+1]
+            band = self.hashes[lo:hi]
+            h = np.uint64(__bandhash__(hv[start:end]))
+            left = np.searchsorted(band, h, side='left')
+            right = np.searchsorted(band, h, side='right')
+            if(right > left): runs.append(self.members[lo+left:lo+right])
+        if(not runs): return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(runs), return_counts = True)
+
+    def arrays(self, prefix):
+        return {'{}.offsets'.format(prefix):self.offsets, '{}.hashes'.format(prefix):self.hashes,
+                '{}.members'.format(prefix):self.members}
+
+class PackedKeys():
+    '''LSH key -> universe _id, backed by int64 array, returns python ints so ids can be used in queries'''
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def __getitem__(self, i): return int(self.ids[i])
+    def extend(self, ids):
+        self.ids = np.concatenate([self.ids, np.array(ids, dtype=np.int64)])
+    def __len__(self): return len(self.ids)
+    def __iter__(self): return iter(range(len(self.ids)))
+    def values(self): return self.ids.tolist()
+    def items(self): return enumerate(self.ids.tolist())
+
+def pack_ids(keys):
+    '''int64 array of keys[0..n), TypeError when any id is not an int64'''
+    ids = [keys[i] for i in range(len(keys))]
+    if(not all(type(_id) is int for _id in ids)):
+        raise TypeError('Only integer ids can be packed')
+    return np.array(ids, dtype=np.int64)
+
+def dumps(header, arrays):
+    '''Blob of header and named arrays'''
+    header = dict(header)
+    header['arrays'] = {}
+    offset = 0
+    for name in arrays:
+        arr = np.ascontiguousarray(arrays[name])
+        header['arrays'][name] = [offset, arr.dtype.str, list(arr.shape)]
+        offset += -(-arr.nbytes // ALIGN) * ALIGN
+    raw = json.dumps(header).encode()
+    raw += b' ' * (-(len(MAGIC) + 8 + len(raw)) % ALIGN)
+
+    out = bytearray(MAGIC)
+    out += struct.pack('<Q', len(raw))
+    out += raw
+    for name in arrays:
+        data = np.ascontiguousarray(arrays[name]).tobytes()
+        out += data
+        out += b'\x00' * (-len(data) % ALIGN)
+    return bytes(out)
+
+def loads(buf):
+    '''(header, arrays) from blob bytes, a memoryview or a uint8 memmap, arrays are views into buf'''
+    if(bytes(buf[:len(MAGIC)]) != MAGIC):
+        raise ValueError('Not a packed LSH blob')
+    size = struct.unpack('<Q', bytes(buf[len(MAGIC):len(MAGIC)+8]))[0]
+    start = len(MAGIC) + 8
+    header = json.loads(bytes(buf[start:start+size]).decode())
+    start += size
+    arrays = {}
+    for name, (offset, dtype, shape) in header['arrays'].items():
+        count = int(np.prod(shape)) if shape else 1
+        arrays[name] = np.frombuffer(buf, dtype=np.dtype(dtype), count=count, offset=start+offset).reshape(shape)
+    return header, arrays
+
+def load(path):
+    '''(header, arrays) from blob file, arrays memory mapped'''
+    return loads(np.memmap(path, dtype=np.uint8, mode='r'))
+
+def is_packed(buf):
+    return bytes(buf[:len(MAGIC)]) == MAGIC
@@ -5,28 +5,46 @@
    and standardizes preprocessing and hashing functions that need to be
    consistent across all other classes.
 - Pipeline provides additional functions to preform standard operations
-  on MongoDB, such as generating collection indices by relevant fields.
+  on MongoDB, such as generating collection indices by relevant fields
+  (planned by IndexPlanner).
+- Record ids from recordhash.record_hash, 63 bit and field order aware.
+   Pipeline.legacy_hash = True keeps the earlier summed 32 bit hashes, for
+   adding to tables uploaded with them.
+- Collections and blobs reached through collection() and blobs(), storage
+   backend picked by Pipeline.__storage__ url (see storage.py), MongoDB on
+   localhost when unset.
 ## Author: Michael Pavlak
 ## ========================================================================== ##
 '''
 
 ## Built-ins
-from itertools import combinations
+import os
 
 ## Local
 import __init__
 from general import *
+from indexplanner import IndexPlanner
+from storage import StorageBackend, connect
+from recordhash import record_hash
+from shingles import word_gram_ids, gram_string
 
 ## Additioanl
+import gridfs
 import pymongo
 import pymongo.errors
-from nltk import ngrams
 
 
 class Pipeline():
     '''Co-ordination class to store meta data for pipe line static functions and connection to external data sources'''
 
+    #Ids as summed 32 bit hashes of values, as tables uploaded before record_hash have
+    legacy_hash = False
+
+    #mongodb://host:port, memory or sqlite:///path
+    __storage__ = os.environ.get('ROXREC_STORAGE')
+
     def __connect__(host='localhost',port=27017):
+        if(Pipeline.__storage__): return connect(Pipeline.__storage__)
         return pymongo.MongoClient('mongodb://{}:{}'.format(host,port))
 
     __database__ = 'temp'
@@ -44,6 +62,12 @@ class Pipeline():
 
         self.__replacementtable__ = replacementtable if replacementtable else Pipeline.__replacementtable__
 
+    def __getstate__(self):
+        #Client connections cannot be serialized, unpickled pipeline reconnects on first use
+        state = dict(self.__dict__)
+        state['__client__'] = None
+        return state
+
     def clone(self):
         try:
             self.client.close()
@@ -60,28 +84,35 @@ class Pipeline():
         if(not self.__client__):
             self.__client__ = Pipeline.__connect__()
 
+    def collection(self, table = None):
+        '''Collection table (default this pipeline's table) of this pipeline's database'''
+        return self.client()[self.database][table or self.table]
+
+    def blobs(self):
+        '''Large object store, GridFS on MongoDB'''
+        client = self.client()
+        if(isinstance(client, StorageBackend)): return client.blobs(self.database)
+        return gridfs.GridFS(client[self.database])
+
+    def shared(self):
+        '''Whether writes made in one process are seen by the others'''
+        client = self.client()
+        return client.shared if isinstance(client, StorageBackend) else True
+
     def clean(self, s):
         return s.translate(self.__replacementtable__).strip()
 
     def hashrec(self, record):
+        if(not Pipeline.legacy_hash): return record_hash(record.values())
         return sum(int.from_bytes(h32(b).digest(),byteorder='little') for b in map(str,record.values()))
 
     def get_tri_grams(self,word):
-        L = len(word)
-        if(L == 1):
-            yield ''.join((word[0], word[0], word[0]))
-        elif(L == 2):
-            yield ''.join((word[0], word[0], word[1]))
-            yield ''.join((word[0], word[1], word[1]))
-        else:
-            for gram in set(ngrams(word, 3)):
-                yield ''.join(gram)
+        #Strings of the integer grams, see shingles.py
+        return map(gram_string, word_gram_ids(word))
+
+    def get_tri_gram_ids(self,word):
+        return word_gram_ids(word)
 
     def build_index(self, table, fields):
-        e_idx = list(map(lambda x: x['key'], self.client()[self.database][table].index_information().values()))
-        for i in range(1, len(fields)):
-            for combo in combinations(fields, i):
-                idx = []
-                for c in combo:
-                    idx.append((c, pymongo.ASCENDING))
-                if(idx not in e_idx): self.client()[self.database][table].create_index(idx)   
+        #Single compound index serving equality queries on fields, see indexplanner.py
+        IndexPlanner(self).plan(table, fields).build()
@@ -7,17 +7,30 @@
   potentially be mapped to and generates index for fields to be matched.
 - Preprocesses and uploads list of target records that will be matched to
   best match in universe collection
+- Repeated rows dropped on read, first of each kept, with a NumPy hash set of
+  record ids (see recordhash.py). Streamed uploads can use a Bloom filter
+  instead, dedupe_error_rate being the share of distinct rows it may drop
 ## Author: Michael Pavlak
 ## ========================================================================== ##
 '''
 
 ##Built-ins
+import os
+import time
+import queue
+import itertools
 import threading
 
 ## Package
 import __init__
 from general import *
 from pipeline import Pipeline
+from frequencytable import get_frequencytable, bump_version
+from indexplanner import IndexPlanner
+from metrics import timer
+from recordhash import get_deduper
+from fileparser import FileParser
+from shingles import gram_string
 
 ## Additional Packages
 import pymongo
@@ -29,99 +42,89 @@ class PreprocessPiper():
         self.wc = None #word count, will either be generated from universe or pulled from DB
         self.gc = None #gram count, will either be generated from universe or pulled from DB
 
-    def __readuniversefile__(self, filepath, build_meta = False, delim = '\t'):
-        '''Read universe file and build wordcount and gramcount dictionaries in place from each line in file'''
-        clean = self.p.clean #define clean on local score to avoid multiple lookups on self.p.cleans
-        hashrec = self.p.hashrec
-
-        recs = []
-        with open(filepath,mode='r',encoding='UTF-8',errors='ignore') as r:
-            header = clean(r.readline()).split(delim)
+    def __countrecord__(self, rec, word_count, gram_count, build_meta):
+        '''Add words and grams of rec to running counts, returns per field word/gram counts for _meta'''
+        meta_field = {}
+        for key in rec:
+            field_val = rec[key]
+           
+            try: word_count[key]
+            except KeyError: word_count[key] = {}
 
-            word_count = {}
-            gram_count = {}
+            try: gram_count[key]
+            except KeyError: gram_count[key] = {}
+            
+            words = {}
+            for word in field_val.split():
+                try: word_count[key][word] += 1
+                except: word_count[key][word] = 1
 
-            rec_count = 0
-            rec_hashes = set()
+                try: words[word]['count'] += 1
+                except KeyError: words[word] = {'count' : 1}                               
 
-            print(header)
+                for gram in self.p.get_tri_grams(word):
+                    try: gram_count[key][gram] += 1
+                    except KeyError: gram_count[key][gram] = 1
 
-            for line in r.readlines():
-                
-                cline = clean(line).split(delim)
-                cline = cline + ['']*(len(header)-len(cline))
-                rec = dict(zip(header,cline))
-                _hash = hashrec(rec)
+                    try: words[word][gram]['count'] += 1
+                    except KeyError: words[word][gram] = {'count' : 1}
+            if(build_meta):
+                try: meta_field[key][field_val] = words
+                except KeyError: meta_field[key] = {field_val : words}
+        return meta_field
+
+    def __setfreq__(self, rec, word_count, gram_count):
+        '''Fill freq into rec['_meta'] once counts over the whole universe are known'''
+        for key in rec:
+            if(key[0] == '_'): continue
+            field_val = rec[key]
+                                
+            for word in field_val.split():
                 
-                if(_hash in rec_hashes): continue
+                rec['_meta'][key][field_val][word]['freq'] = word_count[key][word]/len(word_count[key])
+
+                #((len(word_count[key])/word_count[key][word])/recs[i]['_meta'][key][field_val][word]['count'])/len(word_count[key])
 
-                meta_field = {}
-                for key in rec:
-                    field_val = rec[key]
-                   
-                    try: word_count[key]
-                    except KeyError: word_count[key] = {}
+                for gram in rec['_meta'][key][field_val][word]:
+                    if(len(gram) != 3): continue
 
-                    try: gram_count[key]
-                    except KeyError: gram_count[key] = {}
+                    L = len(gram_count[key])
+                    g = gram_count[key][gram]
                     
-                    words = {}
-                    for word in field_val.split():
-                        try: word_count[key][word] += 1
-                        except: word_count[key][word] = 1
+                    rec['_meta'][key][field_val][word][gram]['freq'] = g/L
+
+    def __readuniversefile__(self, filepath, build_meta = False, delim = '\t'):
+        '''Read universe file and build wordcount and gramcount dictionaries in place from each line in file'''
+        hashrec = self.p.hashrec
 
-                        try: words[word]['count'] += 1
-                        except KeyError: words[word] = {'count' : 1}                               
+        recs = []
+        batches = FileParser(self.p, delim).parse(filepath)
+        header = next(batches)
 
-                        for gram in self.p.get_tri_grams(word):
-                            try: gram_count[key][gram] += 1
-                            except KeyError: gram_count[key][gram] = 1
+        word_count = {}
+        gram_count = {}
 
-                            try: words[word][gram]['count'] += 1
-                            except KeyError: words[word][gram] = {'count' : 1}
-                    if(build_meta):
-                        try: meta_field[key][field_val] = words
-                        except KeyError: meta_field[key] = {field_val : words}              
+        print(header)
 
-                rec['_id'] = _hash
-                if(build_meta):
-                    rec['_meta'] = meta_field
+        rows = [rec for batch in batches for rec in batch.records()]
+        hashes = [hashrec(rec) for rec in rows]
 
-                recs.append(rec)
-                rec_count +=1
-           
+        for rec, _hash, first in zip(rows, hashes, get_deduper(len(rows)).add_many(hashes)):
+            
+            if(not first): continue
+
+            meta_field = self.__countrecord__(rec, word_count, gram_count, build_meta)
+
+            rec['_id'] = _hash
             if(build_meta):
-                print("BUILDING META")
-                rec_count = 0
-                for i in range(len(recs)):
-                   
-                    for key in rec:
-                        if(key[0] == '_'): continue
-
-                        try:
-                            field_val = recs[i][key]
-                        except Exception:
-                            print(key)
-                            print(recs[i].keys())
-                            print(recs[i])
-                            
-                            raise
-                                            
-                        for word in field_val.split():
-                            
-                            recs[i]['_meta'][key][field_val][word]['freq'] = word_count[key][word]/len(word_count[key])
-
-                            #((len(word_count[key])/word_count[key][word])/recs[i]['_meta'][key][field_val][word]['count'])/len(word_count[key])
-
-                            for gram in recs[i]['_meta'][key][field_val][word]:
-                                if(len(gram) != 3): continue
-
-                                L = len(gram_count[key])
-                                g = gram_count[key][gram]
-                                #s = recs[i]['_meta'][key][field_val][word][gram]['count']
-                                
-                                recs[i]['_meta'][key][field_val][word][gram]['freq'] = g/L
-                    rec_count += 1
+                rec['_meta'] = meta_field
+
+            recs.append(rec)
+       
+        if(build_meta):
+            print("BUILDING META")
+            for rec in recs:
+                self.__setfreq__(rec, word_count, gram_count)
 
         self.__update_count__(word_count, 'wordcount')
         self.__update_count__(gram_count, 'gramcount')
@@ -140,11 +143,14 @@ class PreprocessPiper():
         return count
 
     def __buildmetadata__(self, record, fields):
+        with timer('buildmetadata'):
+            self.__buildrecordmeta__(record, fields)
+
+    def __buildrecordmeta__(self, record, fields):
         meta = {}
 
-        c = self.p.client()
-        _wc = c[self.p.database]['{}_meta_wordcount'.format(self.p.table)]
-        _gc = c[self.p.database]['{}_meta_gramcount'.format(self.p.table)]
+        #Counts read from in memory table rather than one find_one per word and gram
+        ft = get_frequencytable(self.p)
         
         for field in fields:
             try:
@@ -152,59 +158,54 @@ class PreprocessPiper():
             except KeyError: continue
             meta[field] = {field_val : {}}
 
-            global_wc_len = _wc.count_documents({'field':field})#len(wc[field])
-            global_gc_len = _gc.count_documents({'field':field})#len(gc[field])
+            global_wc_len = ft.size('wordcount', field)
+            global_gc_len = ft.size('gramcount', field)
 
-            for word in field_val.split():
-                _ = _wc.find_one({'field':field, 'wordcount':word})
-                word_count = _.get('count',1) if _ else 1
-                #word_count = wc[field].get(word, 1)
+            words = field_val.split()
+            grams = [self.p.get_tri_gram_ids(word) for word in words]
+            word_counts = ft.counts('wordcount', field, words)
+            gram_counts = iter(ft.gram_counts(field, list(itertools.chain(*grams))))
 
+            for word, word_count, word_grams in zip(words, word_counts, grams):
                 try: meta[field][field_val][word]['count'] += 1
                 except KeyError:
                     meta[field][field_val][word] = {'count':1, 'freq':word_count/global_wc_len}
 
-                for gram in self.p.get_tri_grams(word):
-                    _ = _gc.find_one({'field':field, 'gramcount':gram})
-                    gram_count = _.get('count',1) if _ else 1
-                    #gram_count = gc[field].get(gram,1)
+                for gram in map(gram_string, word_grams):
+                    gram_count = next(gram_counts)
 
                     try: meta[field][field_val][word][gram]['count'] += 1
                     except KeyError:
                         meta[field][field_val][word][gram] = {'count':1, 'freq':gram_count/global_gc_len}
         record['_meta'] = meta
-        del c
 
     def __readtargetfile__(self, filepath, build_meta = False, delim='\t', name_remappings = {}):
-        clean = self.p.clean
         hashrec = self.p.hashrec
 
         recs = []
 
-        fields = self.p.client()[self.p.database][self.p.table].find_one({},{'_id':0,'_meta':0}).keys()
-
-        rec_hashes = set()
-        with open(filepath,mode='r',encoding='UTF-8',errors='ignore') as r:
-            header = clean(r.readline()).split(delim)
-            for line in r.readlines():
-                cline = clean(line).split(delim)
-                cline = cline + ['']*(len(header)-len(cline))
-                rec = dict(zip(header,cline))
-
-                for key in name_remappings:
-                    try:
-                        rec[key] = rec[name_remappings[key]]
-                        del rec[name_remappings[key]]
-                    except KeyError: continue
-
-                _hash = hashrec(rec)
-                if(_hash in rec_hashes): continue
-                rec['_id'] = _hash
-
-                if(build_meta):
-                    self.__buildmetadata__(rec, fields)
-                recs.append(rec)
-        
+        fields = self.p.collection().find_one({},{'_id':0,'_meta':0}).keys()
+
+        batches = FileParser(self.p, delim).parse(filepath)
+        header = next(batches)
+        rows = [rec for batch in batches for rec in batch.records()]
+
+        for rec in rows:
+            for key in name_remappings:
+                try:
+                    rec[key] = rec[name_remappings[key]]
+                    del rec[name_remappings[key]]
+                except KeyError: continue
+
+        hashes = [hashrec(rec) for rec in rows]
+        for rec, _hash, first in zip(rows, hashes, get_deduper(len(rows)).add_many(hashes)):
+            if(not first): continue
+            rec['_id'] = _hash
+
+            if(build_meta):
+                self.__buildmetadata__(rec, fields)
+            recs.append(rec)
+    
         return recs
 
     def upload_target_file(self, filepath, build_meta = False, delim='\t', name_remappings = {}):
@@ -213,12 +214,109 @@ class PreprocessPiper():
         tbl_name = '{}_target'.format(self.p.table)
         if(len(recs) > 0):
             try:
-                self.p.client()[self.p.database][tbl_name].insert_many(recs, ordered=False)
+                self.p.collection(tbl_name).insert_many(recs, ordered=False)
             except pymongo.errors.BulkWriteError: pass
      
-    def upload_universe_file(self, filepath, build_meta = False, delim='\t'):
-        recs = self.__readuniversefile__(filepath, build_meta = build_meta,delim='\t')
-        self.p.client()[self.p.database][self.p.table].insert_many(recs, ordered=False)
+    def upload_universe_file(self, filepath, build_meta = False, delim='\t', stream = False,
+                             batch_size = 5000, chunk_bytes = 1<<24, dedupe_error_rate = None):
+        '''Preprocess and upload universe file
+           stream = True reads the file twice in chunks, once for counts and once to build and upload records,
+           so memory is bounded by chunk_bytes and batch_size rather than file size
+           dedupe_error_rate = streamed rows deduped with a Bloom filter of that error rate rather than exactly'''
+        if(stream):
+            return self.__streamuniversefile__(filepath, build_meta = build_meta, delim = delim,
+                                               batch_size = batch_size, chunk_bytes = chunk_bytes,
+                                               dedupe_error_rate = dedupe_error_rate)
+        recs = self.__readuniversefile__(filepath, build_meta = build_meta,delim=delim)
+        self.p.collection().insert_many(recs, ordered=False)
+
+    def __readchunks__(self, filepath, delim, chunk_bytes):
+        '''Yields header then lists of parsed records, about chunk_bytes of file at a time'''
+        batches = FileParser(self.p, delim, chunk_bytes).parse(filepath)
+        yield next(batches)
+        for batch in batches:
+            yield batch.records()
+
+    def __dedupechunks__(self, filepath, delim, chunk_bytes, error_rate):
+        '''Yields header then lists of [record, id] for rows not seen earlier in the file'''
+        hashrec = self.p.hashrec
+        chunks = self.__readchunks__(filepath, delim, chunk_bytes)
+        yield next(chunks)
+        seen = None
+        for chunk in chunks:
+            if(seen is None):
+                #Rows in file estimated from the first chunk, Bloom filters are sized for it up front
+                seen = get_deduper(len(chunk) * max(1, os.path.getsize(filepath) / chunk_bytes), error_rate)
+            hashes = [hashrec(rec) for rec in chunk]
+            yield [[rec, _hash] for rec, _hash, first in zip(chunk, hashes, seen.add_many(hashes)) if first]
+
+    def __streamuniversefile__(self, filepath, build_meta = False, delim = '\t', batch_size = 5000, chunk_bytes = 1<<24,
+                               dedupe_error_rate = None):
+        start = time.time()
+
+        #First pass only keeps word and gram counts, bounded by vocabulary rather than record count
+        word_count = {}
+        gram_count = {}
+        chunks = self.__dedupechunks__(filepath, delim, chunk_bytes, dedupe_error_rate)
+        print(next(chunks))
+        for chunk in chunks:
+            for rec, _ in chunk:
+                self.__countrecord__(rec, word_count, gram_count, False)
+
+        self.__update_count__(word_count, 'wordcount')
+        self.__update_count__(gram_count, 'gramcount')
+
+        #Second pass builds records and hands bounded batches to writer thread, parsing overlaps network I/O
+        db = self.p.collection()
+        batches = queue.Queue(maxsize = 2)
+        errors = []
+        def writer():
+            while(True):
+                batch = batches.get()
+                if(batch is None): return
+                #After a failed write keep draining so producer never blocks on a full queue
+                if(errors and not isinstance(errors[-1], pymongo.errors.BulkWriteError)): continue
+                try:
+                    db.insert_many(batch, ordered=False)
+                except Exception as e:
+                    #Duplicates rejected by BulkWriteError, rest of batch still written
+                    errors.append(e)
+        thread = threading.Thread(target = writer)
+        thread.start()
+
+        def put(batch):
+            batches.put(batch)
+            return len(batch)
+
+        rec_count = 0
+        batch = []
+        #Same rows kept as in the first pass, deduper decisions depend only on the file
+        chunks = self.__dedupechunks__(filepath, delim, chunk_bytes, dedupe_error_rate)
+        next(chunks)
+        try:
+            for chunk in chunks:
+                for rec, _hash in chunk:
+                    meta_field = self.__countrecord__(rec, {}, {}, build_meta)
+                    rec['_id'] = _hash
+                    if(build_meta):
+                        rec['_meta'] = meta_field
+                        self.__setfreq__(rec, word_count, gram_count)
+                    batch.append(rec)
+                    if(len(batch) >= batch_size):
+                        rec_count += put(batch)
+                        batch = []
+                print('{} rows read ({:.0f} rows/sec)'.format(rec_count, rec_count/max(time.time()-start, 1e-9)))
+            if(batch):
+                rec_count += put(batch)
+        finally:
+            batches.put(None)
+            thread.join()
+
+        print('{} rows uploaded ({:.0f} rows/sec)'.format(rec_count, rec_count/max(time.time()-start, 1e-9)))
+        for e in errors:
+            if(not isinstance(e, pymongo.errors.BulkWriteError)): raise e
+        if(errors): raise errors[0]
+        return rec_count
 
     def __update_count__(self, additional_counts, count_type):
         hashrec = self.p.hashrec
@@ -235,6 +333,14 @@ class PreprocessPiper():
                     r['_id'] = _hash
                     d.append(r)
 
+        def upload():
+            try:
+                self.p.collection(count_table).insert_many(d, ordered=False)
+            finally:
+                #Version stamp lets in memory frequency tables know to reload
+                bump_version(self.p)
+                #Index for (field, elem) lookups built once counts are loaded
+                IndexPlanner(self.p).counts(count_type).build()
+
         #Spawn new thread, let Mongo handle concurrency, make client call non-blocking                 
-        threading.Thread(target = lambda: self.p.client()[self.p.database][count_table].insert_many(d, ordered=False)).start()
-        threading.Thread(target = lambda: self.p.build_index(count_table,['field','count',count_type])).start()
+        threading.Thread(target = upload).start()
@@ -12,17 +12,37 @@
    (smallest edit distance) when counting the appearence of each word
    in the combine word set. This results in slightly better accuracy and less
    varability than if exact match required (or stemmed match).
+- Canidates ranked by collision score, the share of each field's bands they
+   collide with the target in, weighted by field weight. Only canidates
+   scoring at least min_collision_score, at most max_canidates of them best
+   first, are fetched and scored, so common values (THE HOSPITAL) can not
+   make a target fetch and score most of its partition.
 - Filter field used to limit the records in hash family to those who fields
    exactly match the filter
 - Field Weights used to give varabile significance to different fields. When
    field weights not provided, all fields in the fileds attribute given equal
    weight of one. Field weight not taken into consideration when pooling from
    individual field LSH functions.
+- Partition also keeps a sparse count*(1-freq) vector per record and field
+   (see tfidf.py). Matching with scoring='tfidf' scores the whole canidate
+   pool against these in one product per field, only fetching the records
+   that pass the threshold.
+- update applies universe inserts and deletes to a built partition in place
+   of a rebuild, re-persisting it with its version bumped.
+- Query, fetch and scoring stages timed and counted in metrics.py.
+- LSH threshold, num_perm and bands set per field, from params or those
+   saved by lshtuner.LSHTuner, else threshold and num_perm of the class.
+   Kept in the partition header so a partition is always queried with the
+   parameters it was built with.
+- Hash tables packed into sorted arrays once built. Partition persisted as a
+   single packed blob of arrays (see packedlsh.py) loaded without unpickling,
+   dill kept for partitions whose ids can not be packed and for older ones.
 ## Author: Michael Pavlak
 ## ========================================================================== ##
 '''
 
 ##Built-ins
+import heapq
 import itertools
 
 ## Package
@@ -31,9 +51,19 @@ from general import *
 from broker import Broker
 from pipeline import Pipeline
 from preprocesspiper import PreprocessPiper
+from minhasher import get_minhasher
+from wordsim import best_match
+from vocabindex import get_vocabindex
+from frequencytable import get_frequencytable
+from indexplanner import IndexPlanner
+from tfidf import FieldVectors
+from lshtuner import load_params
+from metrics import incr, timer
+import packedlsh
+from packedlsh import PackedLSH, PackedKeys, pack_ids, is_packed
 
 ## Additional
-from sortedcontainers import SortedList
+import numpy as np
 from datasketch import MinHash, MinHashLSH
 
 def __LSHName__(fields, filter_):
@@ -50,7 +80,12 @@ def RecordLSHFactory(pipeline, fields, filter_={}, field_weights = None):
     name = __LSHName__(fields, filter_)
     broker = Broker(pipeline)
     try:
-        i = broker.download_obj(name)
+        blob = broker.download_blob(name, mmap = True)
+        if(is_packed(blob)):
+            return RecordLSH.__unpack__(blob, pipeline)
+
+        #Partitions saved before packed format, or with ids that could not be packed
+        i = broker.loads(blob)
         i.LSH = {}
         for key in i.fields:
             i.LSH[key] = broker.download_obj('{}_{}'.format(name,key))
@@ -59,13 +94,22 @@ def RecordLSHFactory(pipeline, fields, filter_={}, field_weights = None):
     except AssertionError:
         return RecordLSH(pipeline, fields, filter_=filter_, field_weights = field_weights)
 
+def build_partition(table, database, fields, filter_, field_weights = None, params = None):
+    '''Process pool entry point, builds and persists a single filter partition and hands it back to the parent'''
+    return RecordLSH(Pipeline(table, database = database), fields, filter_=filter_, field_weights = field_weights, params = params)
+
 class RecordLSH():
 
     threshold = 0.6
     num_perm = 128
     encoding = 'UTF-8'
+    build_block_size = 10000 #records per signature block when building hash tables
+    fetch_chunk_size = 500 #max ids per $in query when fetching canidates
+    neighbor_distance = 2 #edit distance budget when resolving target words against field vocabulary
+    max_canidates = 500 #canidates per target fetched and scored, highest collision score first, None keeps all
+    min_collision_score = 0.0 #least weighted share of colliding bands a canidate is kept with
 
-    def __init__(self, pipeline, fields, filter_={}, field_weights = None):
+    def __init__(self, pipeline, fields, filter_={}, field_weights = None, params = None):
 
         self.fields = fields
         self.filter_ = filter_
@@ -85,21 +129,33 @@ class RecordLSH():
 
             self.LSH = {}
             self.keys = {}
+            self.vectors = {}
+            self.removed = set()
+            self.version = 0
             self.field_weights = field_weights or dict(zip(fields, [1]*len(fields)))
             self.__totalweight__ = sum(self.field_weights.values())
+            self.params = self.__fieldparams__(load_params(self.p) if params is None else params)
 
             self.__build_index__()
             
-            #Computationally expensive preprocssing to build hash table            
-            for i, record in enumerate(self.p.client()[self.p.database][self.p.table].find(filter_,dict(zip(fields,[1]*len(fields))))):
+            #Computationally expensive preprocssing to build hash table
+            #Signatures generated for a block of records at a time rather than one MinHash per record
+            block = []
+            cursor = self.p.collection().find(filter_,dict(zip(fields,[1]*len(fields))))
+            for i, record in enumerate(cursor):
                 self.keys[i] = record['_id']
-                for field in fields:
-                    minhash = self.get_minhash(record.get(field,''))#[field])
-                    try:
-                        self.LSH[field].insert(i,minhash)
-                    except KeyError:
-                        self.LSH[field] = MinHashLSH(RecordLSH.threshold,RecordLSH.num_perm)
-                        self.LSH[field].insert(i,minhash)
+                block.append(record)
+                if(len(block) >= RecordLSH.build_block_size):
+                    self.__insert_block__(i - len(block) + 1, block)
+                    block = []
+            if(block):
+                self.__insert_block__(len(self.keys) - len(block), block)
+            for field in self.vectors:
+                self.vectors[field].finalize(len(self.keys))
+            #Hash tables only queried from here on, flat sorted arrays instead of dicts of sets
+            for field in self.LSH:
+                self.LSH[field] = PackedLSH.from_lsh(self.LSH[field], self.__param__(field, 'threshold'))
+                self.params[field].update(b = self.LSH[field].b, r = self.LSH[field].r)
 
             self.p = self.p.clone()
 ##            print('LSH keys = {}'.format(self.LSH))
@@ -108,9 +164,97 @@ class RecordLSH():
     def __save__(self):
         broker = Broker(self.p)
 ##        print('SAVING OBJ AS {}'.format(self.__getname__()))
-        broker.upload_obj(self,self.__getname__())
-        for key in self.LSH:
-            broker.upload_obj(self.LSH[key], '{}_{}'.format(self.__getname__(),key)) 
+        try:
+            broker.upload_blob(self.__pack__(), self.__getname__())
+        except TypeError:
+            broker.upload_obj(self,self.__getname__())
+            for key in self.LSH:
+                broker.upload_obj(self.LSH[key], '{}_{}'.format(self.__getname__(),key)) 
+
+    def update(self):
+        '''Insert universe records added to the partition's filter since it was built and remove deleted ones,
+           then persist under the same name with version bumped. Returns (inserted, removed) counts
+           Removed rows stay in keys but leave the hash tables and vectors. Partitions saved before
+           packing or vectors existed are rebuilt instead'''
+        if(not getattr(self, 'vectors', None) or not all(isinstance(self.LSH[f], PackedLSH) for f in self.fields)):
+            RecordLSH.__init__(self, self.p, self.fields, self.filter_, self.field_weights)
+            return len(self.keys), 0
+
+        db = self.p.collection()
+        removed = getattr(self, 'removed', set())
+        live = dict((self.keys[i], i) for i in range(len(self.keys)) if i not in removed)
+        current = set(rec['_id'] for rec in db.find(self.filter_, {'_id':1}))
+        gone = sorted(live[_id] for _id in live if _id not in current)
+        added = sorted(_id for _id in current if _id not in live)
+        if(not gone and not added): return 0, 0
+
+        for field in self.fields:
+            self.LSH[field].update([], [], gone)
+            self.vectors[field].remove(gone)
+
+        projection = dict(zip(self.fields,[1]*len(self.fields)))
+        for i in range(0, len(added), RecordLSH.build_block_size):
+            ids = added[i:i+RecordLSH.build_block_size]
+            found = dict((rec['_id'], rec) for rec in db.find({'_id':{'$in':ids}}, projection))
+            block = [found[_id] for _id in ids if _id in found]
+            start = len(self.keys)
+            if(isinstance(self.keys, PackedKeys)): self.keys.extend([rec['_id'] for rec in block])
+            else:
+                for j, rec in enumerate(block): self.keys[start + j] = rec['_id']
+            rows = range(start, start + len(block))
+            for field in self.fields:
+                minhasher = self.__minhasher__(field)
+                vals = [rec.get(field,'') for rec in block]
+                sigs = minhasher.signatures(vals)
+                self.LSH[field].update(rows, [minhasher.lean(sig).hashvalues for sig in sigs])
+                for j, weights in enumerate(self.__weights__(field, vals)):
+                    self.vectors[field].add(start + j, weights)
+
+        for field in self.fields:
+            self.vectors[field].finalize(len(self.keys))
+        self.removed = removed | set(gone)
+        self.version = getattr(self, 'version', 0) + 1
+        self.__save__()
+        return len(added), len(gone)
+
+    def __pack__(self):
+        '''Partition as packed blob (see packedlsh.py), TypeError when it can not be packed'''
+        arrays = {'keys':pack_ids(self.keys), 'removed':np.array(sorted(getattr(self, 'removed', ())), dtype=np.int64)}
+        for field in self.fields:
+            arrays.update(self.LSH[field].arrays('LSH.{}'.format(field)))
+            arrays.update(self.vectors[field].arrays('vectors.{}'.format(field)))
+        header = {'num_perm':RecordLSH.num_perm, 'threshold':RecordLSH.threshold,
+                  'bands':dict((field, [self.LSH[field].b, self.LSH[field].r]) for field in self.fields),
+                  'params':dict((field, [self.__param__(field, 'threshold'), self.__param__(field, 'num_perm')]) for field in self.fields),
+                  'fields':self.fields, 'filter':self.filter_, 'field_weights':self.field_weights,
+                  'version':getattr(self, 'version', 0)}
+        return packedlsh.dumps(header, arrays)
+
+    @classmethod
+    def __unpack__(cls, blob, pipeline):
+        '''Partition from packed blob or memmap, arrays used in place'''
+        header, arrays = packedlsh.loads(blob) if not isinstance(blob, str) else packedlsh.load(blob)
+        i = cls.__new__(cls)
+        i.fields = header['fields']
+        i.filter_ = header['filter']
+        i.field_weights = header['field_weights']
+        i.__totalweight__ = sum(i.field_weights.values())
+        i.p = pipeline.clone()
+        i.wc, i.gc, i.pp = None, None, None
+        i.keys = PackedKeys(arrays['keys'])
+        i.removed = set(arrays['removed'].tolist()) if 'removed' in arrays else set()
+        i.version = header.get('version', 0)
+        i.LSH, i.vectors, i.params = {}, {}, {}
+        for field in i.fields:
+            b, r = header['bands'][field]
+            #Partitions packed before per field parameters share the header's
+            threshold, num_perm = header.get('params', {}).get(field, [header['threshold'], header['num_perm']])
+            i.params[field] = {'threshold':threshold, 'num_perm':num_perm, 'b':b, 'r':r}
+            prefix = 'LSH.{}'.format(field)
+            i.LSH[field] = PackedLSH(num_perm, threshold, b, r, arrays['{}.offsets'.format(prefix)],
+                                     arrays['{}.hashes'.format(prefix)], arrays['{}.members'.format(prefix)])
+            i.vectors[field] = FieldVectors.from_arrays(arrays, 'vectors.{}'.format(field))
+        return i
     
     def __getname__(self):
         filter_tags = []
@@ -121,66 +265,183 @@ class RecordLSH():
         return 'RecordLSH_{}_by_{}'.format('_'.join(self.fields),
                                            '_'.join(filter_tags) if len(filter_tags) > 0 else '')
     def __build_index__(self):
-        field_keys = set(self.field_weights.keys())
-        try:
-            field_keys.remove('_id')
-        except KeyError: pass
-        self.p.build_index(self.p.table, field_keys)       
+        #Partition records read with a query on the filter fields only
+        field_keys = [key for key in self.filter_ if key != '_id']
+        IndexPlanner(self.p).plan(self.p.table, field_keys).build()
+
+    def __fieldparams__(self, params):
+        '''{field: {threshold, num_perm, b, r}} for every field, class threshold and num_perm where params has none,
+           b and r None until MinHashLSH picks them'''
+        out = {}
+        for field in self.fields:
+            p = params.get(field) or {}
+            out[field] = {'threshold':p.get('threshold', RecordLSH.threshold), 'num_perm':p.get('num_perm', RecordLSH.num_perm),
+                          'b':p.get('b'), 'r':p.get('r')}
+        return out
 
-    def get_minhash(self, val):
-        minhash = MinHash(RecordLSH.num_perm)
-        for d in self.p.get_tri_grams(val):
-            minhash.update(d.encode(RecordLSH.encoding))
-        return minhash
+    def __param__(self, field, key):
+        #Partitions unpickled from before per field parameters use the class ones
+        try: return self.params[field][key]
+        except (AttributeError, KeyError):
+            return {'threshold':RecordLSH.threshold, 'num_perm':RecordLSH.num_perm}.get(key)
 
-    def match_by_field(self, other, field):
-        return self.LSH[field].query(self.get_minhash(other[field]))
+    def __minhasher__(self, field = None):
+        return get_minhasher(self.__param__(field, 'num_perm'))
 
-    def get_canidate_matches(self, other):
-        canidates = set()
+    def __insert_block__(self, start, block):
         for field in self.fields:
-            for canidate in self.match_by_field(other, field):
-                canidates.add(canidate)
-        for canidate in canidates:
-            yield self.p.client()[self.p.database][self.p.table].find_one({'_id':self.keys[canidate]})
-                
-    def bow_sim(self, field, r0, r1):
+            minhasher = self.__minhasher__(field)
+            sigs = minhasher.signatures([record.get(field,'') for record in block])
+            try:
+                lsh = self.LSH[field]
+            except KeyError:
+                b, r = self.__param__(field, 'b'), self.__param__(field, 'r')
+                lsh = self.LSH[field] = MinHashLSH(self.__param__(field, 'threshold'), self.__param__(field, 'num_perm'),
+                                                   params = (b, r) if b and r else None)
+            with lsh.insertion_session() as session:
+                for j in range(len(block)):
+                    session.insert(start + j, minhasher.lean(sigs[j]))
 
-        def get_meta(rec):
-            try: return rec['_meta'][field]
+            try:
+                vectors = self.vectors[field]
             except KeyError:
+                vectors = self.vectors[field] = FieldVectors()
+            for j, weights in enumerate(self.__weights__(field, [record.get(field,'') for record in block])):
+                vectors.add(start + j, weights)
+
+    def __weights__(self, field, vals):
+        '''count*(1-freq) weight of each word in each of vals, freq from universe word counts'''
+        ft = get_frequencytable(self.p)
+        size = ft.size('wordcount', field) or 1
+        counts = []
+        for val in vals:
+            c = {}
+            for word in val.split():
+                try: c[word] += 1
+                except KeyError: c[word] = 1
+            counts.append(c)
+        words = list(set(itertools.chain(*counts)))
+        freq = dict(zip(words, ft.counts('wordcount', field, words)))
+        return [dict((word, c[word]*(1-freq[word]/size)) for word in c) for c in counts]
+
+    def get_minhash(self, val, field = None):
+        minhasher = self.__minhasher__(field)
+        return minhasher.lean(minhasher.signature(val))
+
+    def match_by_field(self, other, field):
+        return self.LSH[field].query(self.get_minhash(other[field], field))
+
+    def __collisions__(self, field, minhash):
+        '''(rows, bands collided in) of field's hash table'''
+        lsh = self.LSH[field]
+        if(isinstance(lsh, PackedLSH)): return lsh.query_counts(minhash)
+        #Partitions unpickled from before packing, every canidate counted as one band
+        rows = np.array(sorted(lsh.query(minhash)), dtype=np.int64)
+        return rows, np.ones(len(rows), dtype=np.int64)
+
+    def __rank__(self, hits):
+        '''Rows kept from hits ([field, rows, counts] per field) best collision score first, with their scores'''
+        if(not hits): return [], np.zeros(0)
+        share = lambda field: self.field_weights.get(field, 0) / (self.__totalweight__ or 1) / self.LSH[field].b
+        rows, inverse = np.unique(np.concatenate([rows for _, rows, _ in hits]), return_inverse = True)
+        weights = np.concatenate([counts * share(field) for field, _, counts in hits])
+        scores = np.bincount(inverse.ravel(), weights = weights, minlength = len(rows))
+
+        #Stable on rows in ascending order, ties kept in universe order
+        order = np.argsort(-scores, kind = 'stable')
+        order = order[scores[order] >= RecordLSH.min_collision_score][:RecordLSH.max_canidates]
+        incr('canidates', len(order))
+        incr('canidates.dropped', len(rows) - len(order))
+        return rows[order].tolist(), scores[order]
+
+    def canidate_scores(self, other):
+        '''Canidate rows of other best collision score first, and their scores'''
+        with timer('lsh.query'):
+            hits = [[field] + list(self.__collisions__(field, self.get_minhash(other[field], field))) for field in self.fields]
+            return self.__rank__(hits)
+
+    def canidate_keys(self, other):
+        return self.canidate_scores(other)[0]
+
+    def get_canidate_matches(self, other, record_cache = None):
+        return self.fetch_records([self.keys[c] for c in self.canidate_keys(other)], record_cache)
+
+    def fetch_records(self, ids, record_cache = None):
+        '''Universe records by _id, one $in query per chunk of ids not already held in record_cache'''
+        found = {}
+        missing = []
+        for _id in ids:
+            rec = record_cache.get(_id) if record_cache is not None else None
+            if(rec is None): missing.append(_id)
+            else: found[_id] = rec
+
+        projection = dict.fromkeys(itertools.chain(self.fields, self.filter_, ['_meta']), 1)
+        db = self.p.collection()
+        incr('fetch.records', len(missing))
+        with timer('fetch'):
+            for i in range(0, len(missing), RecordLSH.fetch_chunk_size):
+                for rec in db.find({'_id':{'$in':missing[i:i+RecordLSH.fetch_chunk_size]}}, projection):
+                    found[rec['_id']] = rec
+                    if(record_cache is not None): record_cache[rec['_id']] = rec
+
+        for _id in ids:
+            try: yield found[_id]
+            except KeyError: continue
+                
+    def __neighbors__(self, other):
+        '''Vocabulary words within neighbor_distance of each word in other, by field, resolved once per target
+           fwd maps target word -> {vocab word: distance}, rev maps vocab word -> {target word: distance}'''
+        neighbors = {}
+        for field in self.fields:
+            index = get_vocabindex(self.p, field)
+            fwd, rev = {}, {}
+            for word in set(other.get(field,'').split()):
+                fwd[word] = dict(index.query(word, RecordLSH.neighbor_distance))
+                for vocab_word in fwd[word]:
+                    try: rev[vocab_word][word] = fwd[word][vocab_word]
+                    except KeyError: rev[vocab_word] = {word : fwd[word][vocab_word]}
+            neighbors[field] = (fwd, rev)
+        return neighbors
+
+    def __getmeta__(self, rec, field):
+        try: return rec['_meta'][field]
+        except KeyError:
 
-                if(not self.pp):
-                    self.pp = PreprocessPiper(self.p)
-##                if(not self.pp.wc):
-##                    self.pp.wc = self.pp.__downloadcount__('wordcount')
-##                if(not self.pp.gc):
-##                    self.pp.gc = self.pp.__downloadcount__('gramcount')
+            if(not self.pp):
+                self.pp = PreprocessPiper(self.p)
 
-                self.pp.__buildmetadata__(rec, self.fields)#, self.pp.wc, self.pp.gc)
+            #Counts come from the process wide frequency table, see frequencytable.py
+            self.pp.__buildmetadata__(rec, self.fields)
 
-                return rec['_meta'][field]
-                print('_meta' in r0)
-                print('_meta' in r1)
-                raise Exception()
-                pass
+            return rec['_meta'][field]
+
+    def bow_sim(self, field, r0, r1, neighbors = None):
+        '''neighbors is the (fwd, rev) pair from __neighbors__(r0) for field, when given the known distances
+           seed the search for each word's next highest discounted word'''
 
         recs = (r0,r1)
-        meta = list(map(get_meta, recs))          
+        meta = list(map(lambda rec: self.__getmeta__(rec, field), recs))          
         words = set(itertools.chain(*[[word for word in rec[field].split()] for rec in recs]))
 
         v0, v1 = [[],[]]
         val_words0 = meta[0][recs[0][field]]
         val_words1 = meta[1][recs[1][field]]
+        fwd, rev = neighbors or ({}, {})
+
+        def floor(word, vals, near):
+            best = None
+            for other, d in near.get(word, {}).items():
+                if(other in vals):
+                    sim = 1 - (d / max(len(word), len(other)))
+                    if(best is None or sim > best): best = sim
+            return best
 
         for word in words:
-            def _sim(x): return [x, string_sim(word, x)]
-           
-            key0 = [word,1] if word in val_words0.keys() else max(map(_sim,val_words0.keys()),key=second)
+            key0 = [word,1] if word in val_words0 else best_match(word, val_words0, floor(word, val_words0, rev))
 
             def _m():
                 try:
-                    return max(map(_sim,val_words1.keys()),key=second)
+                    return best_match(word, val_words1, floor(word, val_words1, fwd))
                 except ValueError: return [word, 0]
                
             key1 = [word,1] if word in val_words1.keys() else _m()
@@ -193,17 +454,95 @@ class RecordLSH():
         return cosine_sim(v0,v1) 
 
    
-    def match(self, other, thresh=0.0):
-        canidates = list(self.get_canidate_matches(other))
-        scored_recs = SortedList([],key=lambda x: -x[0])
+    def vector_sims(self, other, rows, neighbors):
+        '''Weighted similarity of other to each of rows using the precomputed partition vectors'''
+        total_weight = sum(self.field_weights.values())
+        scores = np.zeros(len(rows))
+        for field in self.field_weights:
+            meta = self.__getmeta__(other, field)[other[field]]
+            weights = dict((word, meta[word]['count']*(1-meta[word]['freq'])) for word in meta)
+            vectors = self.vectors[field]
+            target = vectors.target(weights, neighbors[field][0])
+            scores += (self.field_weights[field]/total_weight) * vectors.score(rows, target)
+        return scores
+
+    def __match_vectors__(self, other, thresh, record_cache, top_k, keys = None):
+        rows = np.array(sorted(self.canidate_keys(other) if keys is None else keys), dtype=np.int64)
+        if(len(rows) == 0): return iter([])
+        with timer('score'):
+            scores = self.vector_sims(other, rows, self.__neighbors__(other))
+
+        keep = [i for i in np.argsort(-scores, kind='stable') if scores[i] > thresh][:top_k]
+        recs = dict((rec['_id'], rec) for rec in self.fetch_records([self.keys[rows[i]] for i in keep], record_cache))
+        return iter([[float(scores[i]), recs[self.keys[rows[i]]]] for i in keep if self.keys[rows[i]] in recs])
+
+    def match(self, other, thresh=0.0, record_cache = None, scoring = 'bow', top_k = None):
+        '''Canidates scoring above thresh, best first, as [score, record]
+           scoring = 'bow' scores each canidate with bow_sim, 'tfidf' scores the whole canidate set
+           against the partition's precomputed vectors
+           top_k keeps only the k best in a bounded heap, canidates are dropped part way through scoring
+           once their best possible score can no longer beat thresh or the current k-th best'''
+        if(scoring == 'tfidf' and getattr(self, 'vectors', None)):
+            return self.__match_vectors__(other, thresh, record_cache, top_k)
+
+        return self.__score__(other, list(self.get_canidate_matches(other, record_cache)), thresh, top_k)
+
+    def match_batch(self, others, thresh=0.0, record_cache = None, scoring = 'bow', top_k = None):
+        '''match for each of others, signatures computed for the whole batch in one pass per field
+           and canidates of the whole batch fetched together'''
+        hits = [[] for _ in others]
+        with timer('lsh.query'):
+            for field in self.fields:
+                minhasher = self.__minhasher__(field)
+                sigs = minhasher.signatures([other.get(field,'') for other in others])
+                for j in range(len(others)):
+                    hits[j].append([field] + list(self.__collisions__(field, minhasher.lean(sigs[j]))))
+            keys = [self.__rank__(h)[0] for h in hits]
+
+        if(scoring == 'tfidf' and getattr(self, 'vectors', None)):
+            return [self.__match_vectors__(other, thresh, record_cache, top_k, keys[j]) for j, other in enumerate(others)]
+
+        ids = list(dict.fromkeys(self.keys[c] for c in itertools.chain(*keys)))
+        recs = dict((rec['_id'], rec) for rec in self.fetch_records(ids, record_cache))
+        return [self.__score__(other, [recs[self.keys[c]] for c in keys[j] if self.keys[c] in recs], thresh, top_k)
+                for j, other in enumerate(others)]
+
+    def __score__(self, other, canidates, thresh, top_k):
+        with timer('score'):
+            return self.__scorecanidates__(other, canidates, thresh, top_k)
+
+    def __scorecanidates__(self, other, canidates, thresh, top_k):
+        neighbors = self.__neighbors__(other) if canidates else {}
         
         total_weight = sum(self.field_weights.values()) #normalize weight to be percent between 0-1
-        def score_canidate(crec):
-            field_sims = dict(zip(self.fields, map(lambda field: self.bow_sim(field, other, crec), self.fields)))
-            score = sum(map(lambda field: ((self.field_weights[field]/total_weight)*field_sims[field]), self.field_weights)) 
+        share = dict((field, self.field_weights[field]/total_weight) for field in self.field_weights)
+
+        #Heaviest field scored first, remaining[k] is the most the fields after the k-th can still add
+        order = sorted(self.field_weights, key = lambda field: -share[field])
+        remaining = [sum(share[field] for field in order[k+1:]) for k in range(len(order))]
 
-            if(score > thresh):
-                scored_recs.add([score,crec])
+        scored_recs = []
+        sims = 0
+        for seq, crec in enumerate(canidates):
+            field_sims = {}
+            for k, field in enumerate(order):
+                field_sims[field] = self.bow_sim(field, other, crec, neighbors.get(field))
+                sims += 1
+                #Similarities are at most 1, small slack so float rounding never prunes a canidate that ties
+                bound = sum(share[f]*field_sims[f] for f in field_sims) + remaining[k] + 1e-9
+                if(bound <= thresh or (top_k and len(scored_recs) >= top_k and bound <= scored_recs[0][0])):
+                    break
+            else:
+                score = sum(map(lambda field: share[field]*field_sims[field], self.field_weights))
+                if(score <= thresh): continue
+                if(not top_k):
+                    scored_recs.append([score, -seq, crec])
+                elif(len(scored_recs) < top_k):
+                    heapq.heappush(scored_recs, [score, -seq, crec])
+                elif(score > scored_recs[0][0]):
+                    heapq.heapreplace(scored_recs, [score, -seq, crec])
+        incr('bow_sim', sims)
 
-        [score_canidate(crec) for crec in canidates]
-        return scored_recs.__iter__()
+        #Equal scores keep canidate order, same as sorting with a stable key on score
+        scored_recs.sort(key = lambda x: (-x[0], -x[1]))
+        return iter([[score, crec] for score, _, crec in scored_recs])
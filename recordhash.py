@@ -0,0 +1,167 @@
+#/roxrec/recordhash.py
+'''
+## ========================================================================== ##
+- Record ids and duplicate detection on ingest.
+- record_hash is a 64 bit xxhash over the cleaned field values in field order,
+   joined by the unit separator (removed from values by Pipeline.clean), so
+   reordered or shifted fields hash differently. Masked to 63 bits so ids fit
+   signed 64 bit integers in MongoDB and SQLite.
+- HashSet holds 64 bit hashes in a NumPy open addressing table with linear
+   probing, 8 bytes a slot at most max_load full, in place of a Python set of
+   ints (about 60 bytes a member). add_many inserts a whole batch with array
+   operations and reports which hashes were new.
+- BloomFilter is the approximate alternative for files whose distinct rows do
+   not fit even a HashSet, about 1.44*log2(1/error_rate) bits a row (29 bits
+   at the default 1e-6, 100M rows in about 360MB). No false negatives, but
+   error_rate of new rows may be reported as seen and so skipped.
+- get_deduper gives a HashSet, or a BloomFilter sized for capacity rows when
+   error_rate is given.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import math
+
+## Additional
+import numpy as np
+from xxhash import xxh64 as h64
+
+SEPARATOR = '\x1f'
+MASK63 = (1<<63) - 1
+#Fibonacci hashing multiplier, spreads hashes whose low bits are not uniform across the table
+GOLDEN = 0x9E3779B97F4A7C15
+MASK64 = (1<<64) - 1
+
+def record_hash(values):
+    '''63 bit order aware hash of field values'''
+    return h64(SEPARATOR.join(map(str, values)).encode('UTF-8')).intdigest() & MASK63
+
+class HashSet():
+
+    max_load = 0.75
+
+    def __init__(self, capacity = 1024):
+        self.__count__ = 0
+        self.__zero__ = False #0 marks empty slots, kept apart
+        self.__allocate__(capacity)
+
+    def __allocate__(self, capacity):
+        bits = max(4, int(math.ceil(capacity / HashSet.max_load)).bit_length())
+        self.__table__ = np.zeros(1<<bits, dtype=np.uint64)
+        self.__shift__ = 64 - bits
+        self.__mask__ = (1<<bits) - 1
+
+    def __len__(self): return self.__count__ + self.__zero__
+
+    @property
+    def nbytes(self): return self.__table__.nbytes
+
+    def __slot__(self, h): return ((h * GOLDEN) & MASK64) >> self.__shift__
+
+    def __reserve__(self, n):
+        if(n <= HashSet.max_load * len(self.__table__)): return
+        keys = self.__table__[self.__table__ != 0]
+        self.__allocate__(n)
+        self.__count__ = 0
+        self.__insert__(keys, np.arange(len(keys)), np.zeros(len(keys), dtype=bool))
+
+    def __contains__(self, h):
+        h = int(h)
+        if(h == 0): return self.__zero__
+        table, i = self.__table__, self.__slot__(h)
+        while(True):
+            cur = int(table[i])
+            if(cur == h): return True
+            if(cur == 0): return False
+            i = (i + 1) & self.__mask__
+
+    def add(self, h):
+        '''True when h was not already held'''
+        h = int(h)
+        if(h == 0):
+            new, self.__zero__ = not self.__zero__, True
+            return new
+        self.__reserve__(self.__count__ + 1)
+        table, i = self.__table__, self.__slot__(h)
+        while(True):
+            cur = int(table[i])
+            if(cur == h): return False
+            if(cur == 0):
+                table[i] = h
+                self.__count__ += 1
+                return True
+            i = (i + 1) & self.__mask__
+
+    def add_many(self, hashes):
+        '''Bool mask of hashes not held before, only the first of repeats within hashes counts as new'''
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        new = np.zeros(len(hashes), dtype=bool)
+        if(not len(hashes)): return new
+        _, first = np.unique(hashes, return_index = True)
+        zero = first[hashes[first] == 0]
+        if(len(zero)):
+            new[zero[0]], self.__zero__ = not self.__zero__, True
+        pending = first[hashes[first] != 0]
+        self.__reserve__(self.__count__ + len(pending))
+        self.__insert__(hashes, pending, new)
+        return new
+
+    def __insert__(self, hashes, pending, new):
+        '''Probe all pending (distinct, non zero) hashes a slot at a time'''
+        table, mask = self.__table__, np.uint64(self.__mask__)
+        slots = (hashes[pending] * np.uint64(GOLDEN)) >> np.uint64(self.__shift__)
+        while(len(pending)):
+            keys = hashes[pending]
+            cur = table[slots]
+            empty = cur == 0
+            #Several hashes may reach the same empty slot, one write lands and the rest probe on
+            table[slots[empty]] = keys[empty]
+            won = empty & (table[slots] == keys)
+            new[pending[won]] = True
+            self.__count__ += int(won.sum())
+            keep = ~((cur == keys) | won)
+            slots = np.where(empty, slots, (slots + np.uint64(1)) & mask)[keep]
+            pending = pending[keep]
+
+class BloomFilter():
+
+    error_rate = 1e-6
+
+    def __init__(self, capacity, error_rate = None):
+        self.error_rate = error_rate or BloomFilter.error_rate
+        capacity = max(int(capacity), 1)
+        self.__m__ = int(math.ceil(-capacity * math.log(self.error_rate) / math.log(2)**2))
+        self.__k__ = max(1, int(round(self.__m__ / capacity * math.log(2))))
+        self.__bits__ = np.zeros((self.__m__ + 7) // 8, dtype=np.uint8)
+
+    @property
+    def nbytes(self): return self.__bits__.nbytes
+
+    def __positions__(self, hashes):
+        #k positions from two halves of each hash (Kirsch-Mitzenmacher)
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        return (h1[:, None] + np.arange(self.__k__, dtype=np.uint64)[None, :] * h2[:, None]) % np.uint64(self.__m__)
+
+    def __contains__(self, h):
+        return not self.add_many([h], insert = False)[0]
+
+    def add(self, h):
+        return bool(self.add_many([h])[0])
+
+    def add_many(self, hashes, insert = True):
+        '''Bool mask of hashes not seen before (up to error_rate reported seen), repeats within hashes seen after the first'''
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        new = np.zeros(len(hashes), dtype=bool)
+        if(not len(hashes)): return new
+        _, first = np.unique(hashes, return_index = True)
+        pos = self.__positions__(hashes[first])
+        byte, bit = pos >> np.uint64(3), (np.uint64(1) << (pos & np.uint64(7))).astype(np.uint8)
+        new[first] = ~np.all(self.__bits__[byte] & bit, axis = 1)
+        if(insert): np.bitwise_or.at(self.__bits__, byte.ravel(), bit.ravel())
+        return new
+
+def get_deduper(capacity = 1024, error_rate = None):
+    '''Exact HashSet, or BloomFilter for capacity rows when error_rate given'''
+    if(error_rate): return BloomFilter(capacity, error_rate)
+    return HashSet(capacity)
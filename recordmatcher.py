@@ -12,18 +12,41 @@
  .exact = list of field names that are required to match exactly,
    the more fields in exact, the more filitered the universe collection can be,
    resulting in both higher accuracy and faster runtime
+ .record_cache_size = number of universe records each process keeps in memory between
+   match calls, 0 disables the cache
+ .stream_universe = upload universe file in bounded memory chunks rather than reading it whole
+ .scoring = 'bow' scores each canidate with RecordLSH.bow_sim, 'tfidf' scores all canidates
+   at once against vectors precomputed with the LSH partition
+ .tune_lsh = pick LSH threshold, num_perm and bands of each field on a sample of the universe
+   (see lshtuner.py) before partitions are first built, saved for every later build until a
+   new universe file is uploaded
 - Match function will preform fuzzy matching on single record, using only a single process
 - Matching by file will generate multiple processes to match records until target collection
    has been exhauseted. Matching by file significantly faster when doing bulk operations
+- When a new universe file is uploaded, partitions built earlier are updated with the added
+   records (RecordLSH.update) rather than left stale or rebuilt
+- match_file loads every LSH partition once then forks worker_count workers sharing them
+   copy on write (spawned copies where fork is unavailable). Parent leases target records in
+   batches through TargetQueue and feeds them to workers over a queue, acknowledging each
+   batch once a worker reports it done, so each target is matched by exactly one worker.
+   Batches of a worker that fails are released and matched in the parent after the others
+- Matches streamed to a result sink as they are made, out_format of match_file picks
+   tsv, csv, jsonl or parquet (default from outfile extension, else tsv) or 'collection'
+   to bulk insert into {name}_results. Worker part files kept in a temporary directory
+   and merged into outfile when all workers finish
+- Counters and stage timings of this process (see metrics.py) returned by stats(),
+   match_file workers send theirs back to the parent when they finish
 ## Author: Michael Pavlak
 ## ========================================================================== ##
 '''
 
 ## Built-ins
 import os
-import sys
-import subprocess
-import threading
+import gc
+import shutil
+import tempfile
+import multiprocessing
+from queue import Empty, Full
 
 import time
 
@@ -33,17 +56,23 @@ from general import *
 from broker import Broker
 from pipeline import Pipeline
 from preprocesspiper import PreprocessPiper
-from recordLSH import __LSHName__, RecordLSHFactory
+from recordLSH import __LSHName__, RecordLSHFactory, build_partition
+from targetqueue import TargetQueue
+from lshtuner import LSHTuner, load_params, clear_params
+from indexplanner import IndexPlanner
+from resultsink import CollectionSink, __sinks__, sink_format, get_sink
+from metrics import get_metrics, incr, timer
 
 ## Additional
 import pymongo.errors
 from multiprocessing import cpu_count
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 class RecordMatcher():
 
     def __init__(self, name, fields, universe_file = None, field_rename_map = {},
-                 build_meta = False, fuzzy_thresh = 0.75, field_weights = None, exact = [],udelim='\t'):
+                 build_meta = False, fuzzy_thresh = 0.75, field_weights = None, exact = [],udelim='\t',
+                 record_cache_size = 0, scoring = 'bow', stream_universe = False, tune_lsh = False):
 
         self.name = name
         
@@ -58,31 +87,49 @@ class RecordMatcher():
         self.field_weights = field_weights
         self.exact = exact
 
+        #Universe records shared between match calls, popular canidates only fetched once per process
+        self.record_cache_size = record_cache_size
+        self.record_cache = LRUCache(record_cache_size) if record_cache_size else None
+        if(self.record_cache is not None): get_metrics().register_cache('record', self.record_cache)
+        self.scoring = scoring
+
         self.__pipeline__ = Pipeline(name)
         self.__preprocessor__ = PreprocessPiper(self.__pipeline__)
         
+        updated = False
         if(universe_file and os.path.exists(universe_file)):
             self.__pipeline__.connect()
-            if(not self.__pipeline__.__client__[Pipeline.__database__]['meta_{}'.format(name)].find_one({'sha1':sha1_file(universe_file)})):
+            if(not self.__pipeline__.collection('meta_{}'.format(name)).find_one({'sha1':sha1_file(universe_file)})):
+                updated = True
                 try:
-                    self.__preprocessor__.upload_universe_file(universe_file, build_meta = build_meta, delim=udelim)
-                    self.__pipeline__.__client__[Pipeline.__database__]['meta_{}'.format(name)].insert_one(
+                    self.__preprocessor__.upload_universe_file(universe_file, build_meta = build_meta, delim=udelim,
+                                                               stream = stream_universe)
+                    self.__pipeline__.collection('meta_{}'.format(name)).insert_one(
                         {'sha1':sha1_file(universe_file),'source':universe_file})
                 except pymongo.errors.BulkWriteError:
                     ##File might have changed, still uploads new records, does not upload duplicates
                     ##Throws error when any duplicates, any new records still get uploaded
                     pass
+                #Parameters tuned on the universe as it was no longer hold, tuned again when tune_lsh
+                clear_params(self.__pipeline__)
        
-        self.filters = self.__getfilters__()
+        #Exact match and filter queries indexed once universe is loaded
+        IndexPlanner(self.__pipeline__).universe(self.fields, self.exact).build()
+
+        if(tune_lsh and not load_params(self.__pipeline__)):
+            tuner = LSHTuner(self.__pipeline__, self.fields, exact = self.exact)
+            with timer('tune'):
+                tuner.tune()
+            tuner.save()
+            print('LSH parameters: {}'.format(tuner.params))
 
-        for exit_status in self.__buildfilters__():
-            if(exit_status[1] != 0):
-                raise RuntimeError('When building {obj}, exit code returned non-zero ({code})'.format(
-                    obj = exit_status[0], code = exit_status[1]))
+        self.filters = self.__getfilters__()
+        built = self.__buildfilters__()
+        if(updated): self.__updatefilters__(built)
         
     def __getfilters__(self, max_domain_size = 100, min_domain_size = 2):
         
-        db = self.__pipeline__.client()[Pipeline.__database__][self.__pipeline__.table]
+        db = self.__pipeline__.collection()
         def _get(e = self.exact):
             f = dict(zip(e, map(lambda x: '${}'.format(x), e)))
             return [i['_id'] for i in db.aggregate([{'$group': {'_id':f}}])]
@@ -102,33 +149,77 @@ class RecordMatcher():
      
         
     def __buildfilters__(self, worker_count = cpu_count()):
+        with timer('build'):
+            return self.__buildpending__(worker_count)
+
+    def __buildpending__(self, worker_count):
 
         start = time.time()
 
-        threads = []
-        db = self.__pipeline__.__client__[Pipeline.__database__]['{name}_meta_broker'.format(name = self.name)]
-        with ThreadPoolExecutor(worker_count) as e:        
-            for f in self.filters:                
-                if(db.find_one({'_id' : hashstring(__LSHName__(self.fields, f))}, {'_id':1})): continue
-                args = 'RecordLSHFactory(Pipeline("{}"), {}, filter_= {}, field_weights = {})'.format(
-                    self.name, self.fields, f, self.field_weights)
-                threads.append(e.submit(child_process, args=args))
+        db = self.__pipeline__.collection('{name}_meta_broker'.format(name = self.name))
+        universe = self.__pipeline__.collection()
+
+        pending = []
+        for f in self.filters:
+            if(db.find_one({'_id' : hashstring(__LSHName__(self.fields, f))}, {'_id':1})): continue
+            pending.append([universe.count_documents(f), f])
+
+        #Largest partitions scheduled first so the longest build is not left running alone at the end
+        pending.sort(key = lambda x: -x[0])
+
+        built = []
+        if(pending):
+            #Partitions persisted by a pool process are only seen here when storage is shared across processes
+            if(self.__pipeline__.shared()): pool = ProcessPoolExecutor(min(worker_count, len(pending)))
+            else: pool = ThreadPoolExecutor(1)
+            with pool as e:
+                futures = [[f, e.submit(build_partition, self.name, Pipeline.__database__,
+                                        self.fields, f, self.field_weights)] for _, f in pending]
+                for f, future in futures:
+                    name = __LSHName__(self.fields, f)
+                    try:
+                        self.LSH[hashstring(name)] = future.result()
+                    except Exception as err:
+                        raise RuntimeError('When building {obj}, build failed ({err})'.format(obj = name, err = repr(err))) from err
+                    built.append(name)
 
         end = time.time()
         print('Total time elapsed: {} (seconds)'.format(end-start))
 
-        return map(lambda i: [__LSHName__(self.fields, self.filters[i]), threads[i].result()], range(len(threads)))
+        return built
+
+
+    def __updatefilters__(self, skip = ()):
+        '''Apply universe changes to partitions built before them, skip names just built'''
+        for f in self.filters:
+            name = __LSHName__(self.fields, f)
+            if(name in skip): continue
+            h = hashstring(name)
+            if(h not in self.LSH):
+                self.LSH[h] = RecordLSHFactory(self.__pipeline__, self.fields, f, self.field_weights)
+            inserted, removed = self.LSH[h].update()
+            if(inserted or removed):
+                print('{}: {} inserted, {} removed'.format(name, inserted, removed))
 
+    def stats(self):
+        '''Counters, stage timings, per target rates and cache hit rates, see metrics.Metrics.stats'''
+        return get_metrics().stats()
 
     def match(self, record):
+        incr('targets')
+        with timer('match'):
+            return self.__match__(record)
+
+    def __match__(self, record):
 
         for key in self.field_rename_map:
-            rec[key] = rec[self.field_rename_map[key]]
+            record[key] = record[self.field_rename_map[key]]
         
-        exact_match = self.__pipeline__.__client__[Pipeline.__database__][self.name].find_one(
+        exact_match = self.__pipeline__.collection().find_one(
             dict(zip(self.fields, map(lambda x: record[x], self.fields))))
 
         if(exact_match):
+            incr('match.exact')
             try:
                 del exact_match['_meta']
             except KeyError: pass
@@ -142,6 +233,56 @@ class RecordMatcher():
             assert '_meta' in record
             return self.__fuzzymatch__(record)
 
+    def match_batch(self, records):
+        '''match for each of records, {} where no match found. Exact matches looked up with one query,
+           the rest matched together per filter partition (see RecordLSH.match_batch)'''
+        incr('targets', len(records))
+        with timer('match_batch'):
+            return self.__matchbatch__(records)
+
+    def __matchbatch__(self, records):
+        for record in records:
+            for key in self.field_rename_map:
+                record[key] = record[self.field_rename_map[key]]
+
+        db = self.__pipeline__.collection()
+        exact = {}
+        if(records):
+            queries = [dict(zip(self.fields, map(lambda x: record[x], self.fields))) for record in records]
+            for rec in db.find({'$or':queries}, {'_meta':0}):
+                exact.setdefault(tuple(rec.get(x) for x in self.fields), rec)
+
+        results = [{} for _ in records]
+        partitions = {}
+        for j, record in enumerate(records):
+            exact_match = exact.get(tuple(record[x] for x in self.fields))
+            if(exact_match):
+                incr('match.exact')
+                results[j] = dict(exact_match, MATCH_RATE = 1)
+                continue
+            if('_meta' not in record):
+                self.__preprocessor__.__buildmetadata__(record, self.fields)
+            lsh = self.__getfilteredLSH__(record)
+            partitions.setdefault(id(lsh), [lsh, []])[1].append(j)
+
+        winners = {}
+        for lsh, rows in partitions.values():
+            matches = lsh.match_batch([records[j] for j in rows], record_cache = self.record_cache, scoring = self.scoring, top_k = 1)
+            for j, i in zip(rows, matches):
+                best_match = next(i, None)
+                if(best_match is not None): winners[j] = best_match
+
+        #Full records of every winner pulled together, see __fuzzymatch__
+        full = dict((rec['_id'], rec) for rec in db.find({'_id':{'$in':[w[1]['_id'] for w in winners.values()]}}, {'_meta':0}))
+        for j, (score, crec) in winners.items():
+            best = dict(full.get(crec['_id']) or crec)
+            best['MATCH_RATE'] = score
+            for key in tuple(best.keys()):
+                if(key[0] == '_'):
+                    del best[key]
+            results[j] = best
+        return results
+
     def __getfilteredLSH__(self, record):
         filter_ = {}
         for key in self.exact:
@@ -160,146 +301,180 @@ class RecordMatcher():
         if('_meta' not in record.keys()):
             self.__preprocessor__.__buildmetadata__(record, self.fields)
         
-        i = self.__getfilteredLSH__(record).match(record)
+        i = self.__getfilteredLSH__(record).match(record, record_cache = self.record_cache, scoring = self.scoring, top_k = 1)
         
         best_match = next(i)
-        best_match[1]['MATCH_RATE'] = best_match[0]       
 
-        for key in tuple(best_match[1].keys()):
+        #Canidates fetched with only match fields, pull full record for the winner,
+        #copy either way since canidate may be shared through record cache
+        full = self.__pipeline__.collection().find_one({'_id':best_match[1]['_id']}, {'_meta':0})
+        best = dict(full or best_match[1])
+        best['MATCH_RATE'] = best_match[0]
+
+        for key in tuple(best.keys()):
             if(key[0] == '_'):
-                del best_match[1][key]
+                del best[key]
 
-        return best_match[1]
+        return best
 
     def match_file(self, target_file, outfile = None, name_remappings = {},
-                   build_meta = False, delim='\t', worker_count = cpu_count()):
+                   build_meta = False, delim='\t', worker_count = cpu_count(), out_format = None):
+        fmt = 'collection' if out_format == 'collection' else sink_format(outfile, out_format)
         outfile = outfile or '{}{}'.format(os.path.join(os.path.split(target_file)[0],
                                                         os.path.basename(target_file).split(os.path.extsep)[0]),
-                                                        os.path.extsep.join(['_OUT','txt']))
+                                                        os.path.extsep.join(['_OUT',out_format and fmt or 'txt']))
         
         self.__preprocessor__.upload_target_file(target_file, build_meta = build_meta, delim=delim, name_remappings=name_remappings)
+        IndexPlanner(self.__pipeline__).targets().build()
+
+        #Each worker streams its results into its own part file in a private temporary directory
+        tmpdir = tempfile.mkdtemp(prefix = '{}_'.format(self.name))
+
+        #Results written by workers to storage not shared across processes would be lost, matched here instead
+        if(fmt == 'collection' and not self.__pipeline__.shared()): worker_count = 0
+
+        #Every partition loaded once here, forked workers share them copy on write.
+        #Freezing keeps the collector from writing to (and so copying) the shared pages
+        self.__loadfilters__()
+        gc.collect()
+        gc.freeze()
+
+        ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+        tasks, done = ctx.Queue(2*worker_count), ctx.Queue()
+        workers = [ctx.Process(target = __matchworker__, args = (self, tasks, done, os.path.join(tmpdir, 'out_{}{ext}part'.format(i, ext = os.path.extsep)), fmt))
+                   for i in range(worker_count)]
+        for worker in workers: worker.start()
+        gc.unfreeze()
+
+        #Parent holds the leases, workers pull claimed batches and report back ids of finished ones
+        queue = TargetQueue(self.__pipeline__)
+        outstanding = 0
+        batch = queue.claim() if workers else []
+        while(batch or outstanding):
+            while(batch and outstanding < 2*worker_count):
+                tasks.put(batch)
+                outstanding += 1
+                batch = queue.claim()
+            try:
+                queue.ack_ids(*done.get(timeout = 1))
+                outstanding -= 1
+            except Empty:
+                #Batch of a failed worker never comes back, stop handing out work
+                if(any(worker.exitcode for worker in workers)): break
+
+        for _ in workers:
+            while(any(worker.is_alive() for worker in workers)):
+                try:
+                    tasks.put(None, timeout = 1)
+                    break
+                except Full: continue
+        #Results and worker metrics still reported while workers finish what was queued
+        while(any(worker.is_alive() for worker in workers) or not done.empty()):
+            try: report = done.get(timeout = 1)
+            except Empty: continue
+            if(isinstance(report, dict)): get_metrics().merge(report)
+            else: queue.ack_ids(*report)
+        for worker in workers: worker.join()
+
+        #Parquet rows are held until a row group fills, a killed worker lost rows of batches already acknowledged
+        failed = [worker.exitcode for worker in workers if worker.exitcode]
+        if(fmt == 'parquet' and any(code < 0 for code in failed)):
+            shutil.rmtree(tmpdir, ignore_errors = True)
+            raise RuntimeError('Workers killed with exit codes {}, parquet results lost'.format(failed))
+
+        #Batches lost with a failed worker are released, whatever is left is matched here
+        if(queue.release()):
+            self.__proceesstargets__(__partfile__(tmpdir), queue, fmt)
 
-        workers = []
-        def spawn_worker():
-            init_args = '"{name}", {fields}, universe_file=None, field_rename_map={frm}, fuzzy_thresh={thresh}, field_weights={weights}, exact={e}'.format(
-                name=self.__pipeline__.table, fields=self.fields, frm=self.field_rename_map, thresh=self.threshold, weights=self.field_weights, e=self.exact)
-            i = 'RecordMatcher({args})'.format(args=init_args)     
-            workers.append(child_process(i))
-
-        threads = []
-        for _ in range(worker_count): threads.append(threading.Thread(target=spawn_worker))
-        for thread in threads: thread.start()
-        for thread in threads: thread.join()
-
-        ids = set()
-
-        files = list(filter(lambda x: self.name in x, os.listdir(os.environ['TEMP'])))
-        with open(outfile, mode='w',encoding='UTF-8',errors='ignore') as w:
-            for file in files:
-                file = os.path.join(os.environ['TEMP'], file)
-                with open(file, mode='r',encoding='UTF-8',errors='ignore') as r:
-                    for line in r.readlines():
-
-                        #Mongo not consistent on concurrent find_and_remove_one calls
-                        #Less strict consistency requirements allows Mongo speed up,
-                        #Just check for duplicate records on merge
-                        _id = line.split(delim)[0]
-                        if(_id in ids): continue
-                        else: ids.add(_id) 
-
-                        w.write(line)
-        
-        for file in files:
-            pass
-            #print(file)
-            try: os.remove(os.path.join(os.environ['TEMP'], file))
-            except FileNotFoundError: continue
-
-        assert all(map(lambda x: x==0, workers)), 'Some workers exited with errors'
+        try:
+            if(fmt == 'collection'):
+                outfile = CollectionSink(self.__pipeline__).path
+            else:
+                parts = sorted(os.path.join(tmpdir, file) for file in os.listdir(tmpdir))
+                __sinks__[fmt].merge(parts, outfile)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors = True)
+
+        #Every target matched once recovered, a failed worker only reported
+        if(failed):
+            incr('workers.failed', len(failed))
+            print('Workers exited with codes {}, their unfinished batches were matched here'.format(failed))
         return outfile
- 
-    def __proceesstargets__(self, out = None):
 
-        m = []      
-        if(not out):
-            out = os.path.join(os.environ['TEMP'], 'out_{}{pid}{ext}txt'.format(r.name, pid=os.getpid(), ext = os.path.extsep))
+    def __matchtarget__(self, rec):
+        try:
+            rec_match = self.match(rec)
+        except StopIteration: rec_match = {}
 
-        rec = self.__pipeline__.client()[Pipeline.__database__]['{}_target'.format(self.name)].find_one_and_delete({})
-        while(rec):
-            try:
-                rec_match = self.match(rec)
-            except StopIteration: rec_match = {}
+        try: del rec['_meta']
+        except KeyError: pass
 
-            try: del rec['_meta']
-            except KeyError: pass
+        try: del rec_match['_meta']
+        except KeyError: pass
 
-            try: del rec_match['_meta']
-            except KeyError: pass
-        
-            if(rec_match != {}):
-                m.append({'init':rec, 'match': rec_match})  
-            rec = self.__pipeline__.__client__[Pipeline.__database__]['{}_target'.format(self.name)].find_one_and_delete({})
+        #can log non-matched recs here if want
+        if(rec_match.get('MATCH_RATE',0) > 0):
+            return rec, rec_match
 
-        with open(out,mode='w',encoding='UTF-8',errors='ignore') as w:
+    def __matchtargets__(self, batch, sink):
+        #Nothing written until the whole batch is matched, a batch failing part way is left to be matched again
+        results = [self.__matchtarget__(rec) for rec in batch]
+        for result in results:
+            if(result): sink.write(*result)
+ 
+    def __proceesstargets__(self, out = None, queue = None, out_format = 'tsv'):
 
-            try:
-               m0 = max(m,key=lambda x: -len(x.keys()))
-               w.write('{}\t===\t{}\t@@@\t{}\n'.format('\t'.join(m0['init'].keys()),
-                                                         '\t'.join(filter(lambda x: x!='MATCH_RATE', m0['match'].keys())),
-                                                         'MATCH_RATE'))
-
-           
-               
-               for match in m:
-                   if(match['match'].get('MATCH_RATE',0) <= 0):
-                       continue
-                   
-                   init = '\t'.join(map(str,match['init'].values()))
-                   mrec = '\t'.join(map(lambda x: str(match['match'][x]), filter(lambda key: key!='MATCH_RATE', match['match'].keys())))
-                   try:
-                       w.write('{}\t===\t{}\t@@@\t{}\n'.format(init, mrec, match['match']['MATCH_RATE']))
-                   except KeyError:
-                       #can log non-matched recs here if want
-                       continue
-            #When no matches found, do nothing
-            except ValueError: pass
+        if(not out):
+            out = __partfile__(tempfile.gettempdir(), self.name)
+
+        #Targets leased in batches, removed from queue only once the whole batch is matched
+        queue = queue or TargetQueue(self.__pipeline__)
+        with __getsink__(self, out, out_format) as sink:
+            batch = queue.claim()
+            while(batch):
+                self.__matchtargets__(batch, sink)
+                queue.ack(batch)
+                batch = queue.claim()
         
         return out
 
+    def __loadfilters__(self):
+        for f in self.filters:
+            h = hashstring(__LSHName__(self.fields, f))
+            if(h not in self.LSH):
+                self.LSH[h] = RecordLSHFactory(self.__pipeline__, self.fields, f, self.field_weights)
+
     def __purge__(self):
         tables = ['{}'.format(self.name),'{}_target'.format(self.name),
                   '{}_meta_wordcount'.format(self.name),'{}_meta_gramcount'.format(self.name),
-                  '{}_meta_broker'.format(self.name),'meta_{}'.format(self.name),'fs.chunks','fs.files']
-        for table in tables: self.__pipeline__.__client__[Pipeline.__database__][table].drop()
-
-
-BELOW_NORMAL_PRIORITY_CLASS = 0x00004000
-SW_MINIMIZE = 6
-info = subprocess.STARTUPINFO()
-info.dwFlags = subprocess.STARTF_USESHOWWINDOW
-info.wShowWindow = SW_MINIMIZE
-
-# Can change to windowless when done debugging
-def child_process(args):
-    return subprocess.call(['python',__file__, args],
-                           startupinfo = info, creationflags = BELOW_NORMAL_PRIORITY_CLASS)
-
-### ========================================================================================= ###
-### FORK PROCESS AND DO FUNCTION CALL
-### ========================================================================================= ###
-
-if(__name__ == '__main__'):
-    try:
-        arg = sys.argv[1]
-        if(arg[0:16] == 'RecordLSHFactory'):
-            eval(arg)
-            sys.exit(0)
-        if(arg[0:13] == 'RecordMatcher'):
-            r = eval(arg)
-            r.__proceesstargets__()
-            sys.exit(0)
-    except IndexError:
-        pass
+                  '{}_meta_broker'.format(self.name),'{}_meta_countversion'.format(self.name),
+                  '{}_results'.format(self.name),'{}_meta_lshparams'.format(self.name),
+                  'meta_{}'.format(self.name),'fs.chunks','fs.files']
+        for table in tables: self.__pipeline__.collection(table).drop()
+
+
+def __partfile__(directory, prefix = 'out'):
+    return os.path.join(directory, '{}_{pid}{ext}part'.format(prefix, pid=os.getpid(), ext = os.path.extsep))
+
+def __getsink__(matcher, out, out_format):
+    #Matches written to sink as they are made, nothing held past the current batch
+    if(out_format == 'collection'): return CollectionSink(matcher.__pipeline__)
+    return get_sink(out, out_format)
+
+def __matchworker__(matcher, tasks, done, out, out_format):
+    #Connections are not shared across a fork, every pipeline gets its own
+    matcher.__pipeline__.__client__ = None
+    matcher.__pipeline__.connect()
+    for lsh in matcher.LSH.values(): lsh.p.__client__ = None
+    #Forked copy of parent's metrics, only this worker's own sent back
+    get_metrics().reset()
+
+    with __getsink__(matcher, out, out_format) as sink:
+        for batch in iter(tasks.get, None):
+            matcher.__matchtargets__(batch, sink)
+            sink.flush()
+            done.put(([rec['_id'] for rec in batch], batch.token))
+    done.put(get_metrics().snapshot())
 
 
 ## Example Usage
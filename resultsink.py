@@ -0,0 +1,216 @@
+#/roxrec/resultsink.py
+'''
+## ========================================================================== ##
+- Result sinks receive (target record, matched record) pairs as matches are
+   made, so match workers never hold their results in memory.
+- DelimitedSink writes TSV/CSV rows in the match_file layout
+   (target fields, ===, matched fields, @@@, MATCH_RATE), header taken from
+   the first result written.
+- JSONLinesSink writes one {"init":..., "match":...} object per line.
+- ParquetSink buffers row_group_size results then writes them as one row
+   group, columns prefixed init./match. Requires pyarrow.
+- CollectionSink bulk inserts results into {table}_results.
+- File sinks merge per worker part files into one output file by streaming
+   copy, keeping only the first header.
+- get_sink picks the file sink from format name or outfile extension.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import os
+import csv
+import json
+import shutil
+
+## Package
+import __init__
+from general import *
+
+## Additional
+import pymongo.errors
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+class ResultSink():
+    '''Base sink, subclasses implement __write__ and optionally __close__'''
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+    def write(self, init, match):
+        self.__write__(init, match)
+        self.count += 1
+
+    def flush(self):
+        self.__flush__()
+
+    def close(self):
+        self.__close__()
+
+    def __flush__(self): pass
+    def __close__(self): pass
+
+    @classmethod
+    def merge(cls, parts, outfile):
+        '''Concatenate part files in order into outfile, returns outfile'''
+        with open(outfile, mode='wb') as w:
+            for part in parts:
+                with open(part, mode='rb') as r:
+                    shutil.copyfileobj(r, w, 1<<20)
+        return outfile
+
+class DelimitedSink(ResultSink):
+
+    def __init__(self, path, delim = '\t'):
+        super().__init__(path)
+        self.delim = delim
+        self.__file__ = open(path, mode='w', encoding='UTF-8', errors='ignore', newline='')
+        self.__writer__ = csv.writer(self.__file__, delimiter=delim, lineterminator='\n')
+
+    def __write__(self, init, match):
+        fields = [key for key in match.keys() if key != 'MATCH_RATE']
+        if(self.count == 0):
+            self.__writer__.writerow(list(init.keys()) + ['==='] + fields + ['@@@', 'MATCH_RATE'])
+        self.__writer__.writerow(list(map(str, init.values())) + ['==='] +
+                                 [str(match[key]) for key in fields] + ['@@@', match['MATCH_RATE']])
+
+    def __flush__(self):
+        self.__file__.flush()
+
+    def __close__(self):
+        self.__file__.close()
+
+    @classmethod
+    def merge(cls, parts, outfile):
+        header = None
+        with open(outfile, mode='w', encoding='UTF-8', errors='ignore', newline='') as w:
+            for part in parts:
+                with open(part, mode='r', encoding='UTF-8', errors='ignore', newline='') as r:
+                    #Every part starts with its own header, keep only the first
+                    line = r.readline()
+                    if(not line): continue
+                    if(header is None):
+                        header = line
+                        w.write(line)
+                    shutil.copyfileobj(r, w, 1<<20)
+        return outfile
+
+class JSONLinesSink(ResultSink):
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.__file__ = open(path, mode='w', encoding='UTF-8', errors='ignore')
+
+    def __write__(self, init, match):
+        self.__file__.write(json.dumps({'init':init, 'match':match}, default=str))
+        self.__file__.write('\n')
+
+    def __flush__(self):
+        self.__file__.flush()
+
+    def __close__(self):
+        self.__file__.close()
+
+class ParquetSink(ResultSink):
+
+    row_group_size = 10000
+
+    def __init__(self, path, row_group_size = None):
+        if(pyarrow is None):
+            raise ImportError('ParquetSink requires pyarrow')
+        super().__init__(path)
+        self.row_group_size = row_group_size or ParquetSink.row_group_size
+        self.__rows__ = []
+        self.__writer__ = None
+
+    def __write__(self, init, match):
+        row = dict(('init.{}'.format(key), str(init[key])) for key in init)
+        for key in match:
+            if(key != 'MATCH_RATE'): row['match.{}'.format(key)] = str(match[key])
+        row['MATCH_RATE'] = float(match['MATCH_RATE'])
+        self.__rows__.append(row)
+        if(len(self.__rows__) >= self.row_group_size): self.__flush__()
+
+    def flush(self):
+        #Row groups only written once full, small groups would make the file slow to read
+        pass
+
+    def __flush__(self):
+        if(not self.__rows__): return
+        if(self.__writer__ is None):
+            table = pyarrow.Table.from_pylist(self.__rows__)
+            self.__writer__ = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        else:
+            table = pyarrow.Table.from_pylist(self.__rows__, schema = self.__writer__.schema)
+        self.__writer__.write_table(table)
+        self.__rows__ = []
+
+    def __close__(self):
+        self.__flush__()
+        if(self.__writer__ is not None): self.__writer__.close()
+
+    @classmethod
+    def merge(cls, parts, outfile):
+        writer = None
+        for part in parts:
+            #Workers without results never create their part file
+            if(not os.path.exists(part)): continue
+            f = pyarrow.parquet.ParquetFile(part)
+            for i in range(f.num_row_groups):
+                table = f.read_row_group(i)
+                if(writer is None):
+                    writer = pyarrow.parquet.ParquetWriter(outfile, table.schema)
+                writer.write_table(table.select(writer.schema.names))
+        if(writer is not None): writer.close()
+        return outfile
+
+class CollectionSink(ResultSink):
+
+    batch_size = 1000
+
+    def __init__(self, pipeline, collection = None, batch_size = None):
+        #path is the collection name for this sink
+        super().__init__(collection or '{}_results'.format(pipeline.table))
+        self.p = pipeline
+        self.batch_size = batch_size or CollectionSink.batch_size
+        self.__docs__ = []
+
+    def __write__(self, init, match):
+        doc = {'init':dict(init), 'match':dict(match)}
+        try: doc['_id'] = doc['init'].pop('_id')
+        except KeyError: pass
+        self.__docs__.append(doc)
+        if(len(self.__docs__) >= self.batch_size): self.__flush__()
+
+    def __flush__(self):
+        if(not self.__docs__): return
+        try:
+            self.p.collection(self.path).insert_many(self.__docs__, ordered = False)
+        except pymongo.errors.BulkWriteError:
+            #Target matched again after its lease expired, first result kept
+            pass
+        self.__docs__ = []
+
+    def __close__(self):
+        self.__flush__()
+
+__sinks__ = {'tsv':DelimitedSink, 'txt':DelimitedSink, 'csv':DelimitedSink,
+             'jsonl':JSONLinesSink, 'json':JSONLinesSink, 'parquet':ParquetSink}
+
+def sink_format(outfile, out_format = None):
+    '''Format name given explicitly or taken from outfile extension, tsv when unknown'''
+    fmt = (out_format or os.path.splitext(outfile or '')[1][1:] or 'tsv').lower()
+    return fmt if fmt in __sinks__ else 'tsv'
+
+def get_sink(path, out_format = 'tsv', delim = '\t'):
+    cls = __sinks__[out_format]
+    if(cls is DelimitedSink):
+        return DelimitedSink(path, ',' if out_format == 'csv' else delim)
+    return cls(path)
@@ -0,0 +1,91 @@
+#/roxrec/shingles.py
+'''
+## ========================================================================== ##
+- Tri gram shingling kernel shared by ingest counts, record metadata and
+   MinHash signatures.
+- Each gram is an integer id, its three code points packed 21 bits apiece
+   (every Unicode code point fits), so ids are exact, fit 63 bits and map
+   back to the gram string with gram_string.
+- Padding as Pipeline.get_tri_grams always had it: a one character word is
+   its character three times, a two character word ab gives aab and abb
+   (both, even when equal), longer words every distinct gram.
+- word_gram_ids shingles one word in plain Python, for per record paths.
+   gram_ids shingles a whole list of values with NumPy array operations,
+   returning ids of all values and offsets of each value's run, distinct
+   ids sorted within each run unless distinct = False.
+- gram_string memoized, count tables and _meta keep gram strings (MongoDB
+   keys are strings) but each distinct gram string is only built once.
+## ========================================================================== ##
+'''
+
+## Additional
+import numpy as np
+
+GRAM_BITS = 21
+__mask__ = (1<<GRAM_BITS) - 1
+
+def gram_id(gram):
+    '''Id of a three character gram'''
+    a, b, c = map(ord, gram)
+    return (a<<(2*GRAM_BITS)) | (b<<GRAM_BITS) | c
+
+max_memo = 1<<20 #distinct gram strings kept before memo is reset
+__strings__ = {}
+def gram_string(i):
+    try: return __strings__[i]
+    except KeyError:
+        if(len(__strings__) > max_memo): __strings__.clear()
+        s = __strings__[i] = ''.join((chr(i>>(2*GRAM_BITS)), chr((i>>GRAM_BITS) & __mask__), chr(i & __mask__)))
+        return s
+
+def word_gram_ids(word):
+    '''Gram ids of word, list'''
+    o = list(map(ord, word))
+    L = len(o)
+    if(L == 1):
+        a = o[0]
+        return [(a<<(2*GRAM_BITS)) | (a<<GRAM_BITS) | a]
+    if(L == 2):
+        a, b = o
+        return [(a<<(2*GRAM_BITS)) | (a<<GRAM_BITS) | b, (a<<(2*GRAM_BITS)) | (b<<GRAM_BITS) | b]
+    return list(set((a<<(2*GRAM_BITS)) | (b<<GRAM_BITS) | c for a, b, c in zip(o, o[1:], o[2:])))
+
+def gram_ids(values, distinct = True):
+    '''Gram ids of every value as one uint64 array, ids of values[j] at offsets[j]:offsets[j+1]
+       distinct = False keeps grams repeated within a value (as MinHash needs no more), skipping a sort'''
+    n = len(values)
+    lens = np.fromiter(map(len, values), dtype=np.int64, count=n)
+    if(not n or not lens.any()): return np.zeros(0, dtype=np.uint64), np.zeros(n+1, dtype=np.int64)
+    cps = np.frombuffer(''.join(values).encode('UTF-32-LE'), dtype=np.uint32).astype(np.uint64)
+    starts = np.concatenate([[0], np.cumsum(lens)[:-1]])
+    shift1, shift2 = np.uint64(GRAM_BITS), np.uint64(2*GRAM_BITS)
+
+    counts = np.where(lens >= 3, lens - 2, lens)
+    offsets = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    ids = np.empty(offsets[-1], dtype=np.uint64)
+
+    #Every window of three inside a value of three or more characters, written in place
+    spans = np.where(lens >= 3, counts, 0)
+    pos = np.repeat(offsets[:-1] - np.cumsum(spans) + spans, spans) + np.arange(spans.sum())
+    first = np.repeat(starts - offsets[:-1], spans) + pos
+    ids[pos] = (cps[first] << shift2) | (cps[first+1] << shift1) | cps[first+2]
+
+    #Padded grams of one and two character values
+    one = np.nonzero(lens == 1)[0]
+    a = cps[starts[one]]
+    ids[offsets[one]] = (a << shift2) | (a << shift1) | a
+    two = np.nonzero(lens == 2)[0]
+    b0, b1 = cps[starts[two]], cps[starts[two]+1]
+    ids[offsets[two]] = (b0 << shift2) | (b0 << shift1) | b1
+    ids[offsets[two]+1] = (b0 << shift2) | (b1 << shift1) | b1
+    if(not distinct): return ids, offsets
+
+    #Grams repeated within a longer value counted once, two character values keep both of theirs
+    owner = np.repeat(np.arange(n), counts)
+    order = np.lexsort((ids, owner))
+    owner, ids = owner[order], ids[order]
+    keep = np.ones(len(ids), dtype=bool)
+    keep[1:] = (ids[1:] != ids[:-1]) | (owner[1:] != owner[:-1]) | (lens[owner[1:]] == 2)
+    np.cumsum(np.bincount(owner[keep], minlength=n), out=offsets[1:])
+    return ids[keep], offsets
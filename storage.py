@@ -0,0 +1,678 @@
+#/roxrec/storage.py
+'''
+## ========================================================================== ##
+- Storage backends roxrec can run on in place of a MongoDB server. Every
+   module reaches records, target queue, count tables and broker metadata
+   through Pipeline.collection and blobs through Pipeline.blobs, so a backend
+   only has to look like a MongoClient: backend[database][collection] gives
+   a collection with the part of the pymongo API roxrec uses (find, find_one,
+   insert_one, insert_many, update_one, update_many, replace_one,
+   delete_one, delete_many, count_documents, distinct, aggregate with
+   $match/$group, create_index, index_information, drop).
+- Backends picked by url with connect(url), Pipeline uses Pipeline.__storage__
+   (default from ROXREC_STORAGE, unset for MongoDB on localhost)
+    mongodb://host:port  pymongo.MongoClient, blobs in GridFS
+    memory               MemoryBackend, one per process, nothing serialized
+    sqlite:///path       SQLiteBackend, single file shared by every process
+- Queries support equality (None also matching a missing field), $in, $nin,
+   $ne, $lt, $lte, $gt, $gte, $exists, $or, $and and dotted paths. Updates
+   support $set, $unset and $inc. Errors are the pymongo ones, so duplicate
+   inserts raise BulkWriteError and DuplicateKeyError as with MongoDB.
+- MemoryBackend keeps documents in dicts, indexes created with create_index
+   are hash lookups on every prefix of their keys. Documents are stored and
+   returned as shallow copies, nested values shared with the store are read
+   only. Writes made in a forked process are not seen by the parent
+   (shared = False), readers in forked match_file workers are fine.
+- SQLiteBackend stores documents as JSON (bytes base64 encoded) in one table
+   per collection, indexes are expression indexes on json_extract of their
+   keys. Equality on _id and indexed fields narrows queries in SQL, the rest
+   of a query is checked in Python. Each process opens its own connection,
+   writes run in IMMEDIATE transactions so concurrent workers stay atomic.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import io
+import os
+import json
+import uuid
+import base64
+import sqlite3
+import itertools
+import threading
+import contextlib
+
+## Additional
+import pymongo
+import pymongo.errors
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult
+
+__missing__ = object()
+
+def __getpath__(doc, path):
+    for key in path.split('.'):
+        if(not isinstance(doc, dict) or key not in doc): return __missing__
+        doc = doc[key]
+    return doc
+
+def __setpath__(doc, path, value = __missing__):
+    '''Copy of doc with path set (or removed when value missing), nested dicts copied on the way down'''
+    head, _, rest = path.partition('.')
+    doc = dict(doc)
+    if(rest):
+        child = doc.get(head)
+        if(not isinstance(child, dict)):
+            if(value is __missing__): return doc
+            child = {}
+        doc[head] = __setpath__(child, rest, value)
+    elif(value is __missing__): doc.pop(head, None)
+    else: doc[head] = value
+    return doc
+
+def __isops__(cond):
+    return isinstance(cond, dict) and len(cond) > 0 and all(key[:1] == '$' for key in cond)
+
+def __hashable__(val):
+    try:
+        hash(val)
+        return val
+    except TypeError:
+        return json.dumps(val, sort_keys = True, default = str)
+
+def __compare__(val, arg, op):
+    if(val is __missing__ or val is None or arg is None): return False
+    try: return op(val, arg)
+    except TypeError: return False
+
+__operators__ = {
+    '$eq' : lambda val, arg: (val is __missing__ or val is None) if arg is None else val == arg,
+    '$ne' : lambda val, arg: not __operators__['$eq'](val, arg),
+    '$in' : lambda val, arg: any(__operators__['$eq'](val, a) for a in arg),
+    '$nin': lambda val, arg: not __operators__['$in'](val, arg),
+    '$lt' : lambda val, arg: __compare__(val, arg, lambda a, b: a < b),
+    '$lte': lambda val, arg: __compare__(val, arg, lambda a, b: a <= b),
+    '$gt' : lambda val, arg: __compare__(val, arg, lambda a, b: a > b),
+    '$gte': lambda val, arg: __compare__(val, arg, lambda a, b: a >= b),
+    '$exists': lambda val, arg: (val is not __missing__) == bool(arg),
+    }
+
+def matches(doc, query):
+    '''Whether doc satisfies a MongoDB style query'''
+    for key, cond in query.items():
+        if(key == '$or'):
+            if(not any(matches(doc, q) for q in cond)): return False
+        elif(key == '$and'):
+            if(not all(matches(doc, q) for q in cond)): return False
+        elif(__isops__(cond)):
+            val = __getpath__(doc, key)
+            for op, arg in cond.items():
+                try: check = __operators__[op]
+                except KeyError: raise NotImplementedError('Query operator {} not supported'.format(op))
+                if(not check(val, arg)): return False
+        elif(not __operators__['$eq'](__getpath__(doc, key), cond)): return False
+    return True
+
+def project(doc, projection = None):
+    '''New top level dict of doc with projection applied, fields listed with 1 kept or listed with 0 dropped'''
+    if(not projection): return dict(doc)
+    include = [key for key, keep in projection.items() if keep and key != '_id']
+    if(include):
+        out = dict((key, doc[key]) for key in include if key in doc)
+        if(projection.get('_id', 1) and '_id' in doc): out['_id'] = doc['_id']
+        return out
+    return dict((key, val) for key, val in doc.items() if projection.get(key, 1))
+
+def apply_update(doc, update):
+    '''Copy of doc with $set, $unset and $inc applied'''
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            if(op == '$set'): doc = __setpath__(doc, path, arg)
+            elif(op == '$unset'): doc = __setpath__(doc, path)
+            elif(op == '$inc'):
+                val = __getpath__(doc, path)
+                doc = __setpath__(doc, path, arg if val is __missing__ else val + arg)
+            else: raise NotImplementedError('Update operator {} not supported'.format(op))
+    return doc
+
+def __upsertdoc__(query, update = None, replacement = None):
+    doc = dict((key, val) for key, val in query.items() if key[:1] != '$' and '.' not in key and not __isops__(val))
+    if(replacement is not None): doc = dict(replacement, **({'_id':doc['_id']} if '_id' in doc else {}))
+    elif(update): doc = apply_update(doc, update)
+    return doc
+
+def __expression__(doc, expr):
+    if(isinstance(expr, str) and expr[:1] == '$'):
+        val = __getpath__(doc, expr[1:])
+        return None if val is __missing__ else val
+    if(isinstance(expr, dict)):
+        out = {}
+        for key, sub in expr.items():
+            val = __expression__(doc, sub)
+            #Missing fields left out of grouped keys, as MongoDB does
+            if(not (isinstance(sub, str) and sub[:1] == '$' and __getpath__(doc, sub[1:]) is __missing__)):
+                out[key] = val
+        return out
+    return expr
+
+def __newid__(): return uuid.uuid4().hex
+
+def __indexname__(keys): return '_'.join('{}_{}'.format(field, direction) for field, direction in keys)
+
+def __indexkeys__(keys):
+    if(isinstance(keys, str)): return [(keys, pymongo.ASCENDING)]
+    return [(field, direction) for field, direction in keys]
+
+class Cursor():
+    '''Single pass over matching documents, limit(n) stops after n'''
+
+    def __init__(self, docs):
+        self.__docs__ = docs
+        self.__limit__ = 0
+
+    def limit(self, n):
+        self.__limit__ = n
+        return self
+
+    def __iter__(self):
+        return itertools.islice(self.__docs__, self.__limit__ or None)
+
+class Collection():
+    '''pymongo style collection over a backend's primitives
+       __matching__(query) documents satisfying query, natural order
+       __insert__(doc) False when _id already present, __write__(doc) replaces by _id, __remove__(_id)
+       __transaction__() holds writes to the collection atomic'''
+
+    def __init__(self, backend, database, name):
+        self.backend = backend
+        self.database = database
+        self.name = name
+        self.full_name = '{}.{}'.format(database, name)
+
+    def find(self, filter = None, projection = None):
+        query = filter or {}
+        return Cursor(project(doc, projection) for doc in self.__matching__(query))
+
+    def find_one(self, filter = None, projection = None):
+        return next(iter(self.find(filter, projection).limit(1)), None)
+
+    def count_documents(self, filter):
+        return sum(1 for _ in self.__matching__(filter))
+
+    def distinct(self, key):
+        found = {}
+        for doc in self.__matching__({}):
+            val = __getpath__(doc, key)
+            if(val is not __missing__): found.setdefault(__hashable__(val), val)
+        return list(found.values())
+
+    def aggregate(self, pipeline):
+        docs = self.__matching__({})
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if(op == '$match'):
+                docs = [doc for doc in docs if matches(doc, arg)]
+            elif(op == '$group' and set(arg) == {'_id'}):
+                groups = {}
+                for doc in docs:
+                    key = __expression__(doc, arg['_id'])
+                    groups.setdefault(__hashable__(key), key)
+                docs = [{'_id':key} for key in groups.values()]
+            else:
+                raise NotImplementedError('Aggregation stage {} not supported by {}'.format(op, type(self.backend).__name__))
+        return iter(list(docs))
+
+    def insert_one(self, document):
+        if('_id' not in document): document['_id'] = __newid__()
+        with self.__transaction__():
+            inserted = self.__insert__(document)
+        if(not inserted):
+            raise pymongo.errors.DuplicateKeyError('E11000 duplicate key error collection: {} dup key: {{ _id: {!r} }}'.format(self.full_name, document['_id']), 11000)
+        return InsertOneResult(document['_id'], True)
+
+    def insert_many(self, documents, ordered = True):
+        inserted, errors = [], []
+        with self.__transaction__():
+            for i, doc in enumerate(documents):
+                if('_id' not in doc): doc['_id'] = __newid__()
+                if(self.__insert__(doc)):
+                    inserted.append(doc['_id'])
+                    continue
+                errors.append({'index':i, 'code':11000, 'op':doc,
+                               'errmsg':'E11000 duplicate key error collection: {} dup key: {{ _id: {!r} }}'.format(self.full_name, doc['_id'])})
+                if(ordered): break
+        #Raised once the transaction is committed, every other document stays inserted as with MongoDB
+        if(errors):
+            raise pymongo.errors.BulkWriteError({'writeErrors':errors, 'writeConcernErrors':[], 'nInserted':len(inserted),
+                                                 'nUpserted':0, 'nMatched':0, 'nModified':0, 'nRemoved':0, 'upserted':[]})
+        return InsertManyResult(inserted, True)
+
+    def __update__(self, query, update = None, replacement = None, upsert = False, multi = False):
+        n, modified, upserted = 0, 0, None
+        with self.__transaction__():
+            for doc in list(self.__matching__(query)):
+                n += 1
+                new = apply_update(doc, update) if replacement is None else dict(replacement, _id = doc['_id'])
+                if(new != doc):
+                    self.__write__(new)
+                    modified += 1
+                if(not multi): break
+            if(not n and upsert):
+                new = __upsertdoc__(query, update, replacement)
+                if('_id' not in new): new['_id'] = __newid__()
+                self.__insert__(new)
+                upserted = new['_id']
+        raw = {'n':n or int(upserted is not None), 'nModified':modified, 'ok':1.0}
+        if(upserted is not None): raw['upserted'] = upserted
+        return UpdateResult(raw, True)
+
+    def update_one(self, filter, update, upsert = False):
+        return self.__update__(filter, update = update, upsert = upsert)
+
+    def update_many(self, filter, update, upsert = False):
+        return self.__update__(filter, update = update, upsert = upsert, multi = True)
+
+    def replace_one(self, filter, replacement, upsert = False):
+        return self.__update__(filter, replacement = replacement, upsert = upsert)
+
+    def __delete__(self, query, multi):
+        n = 0
+        with self.__transaction__():
+            for doc in list(self.__matching__(query)):
+                self.__remove__(doc['_id'])
+                n += 1
+                if(not multi): break
+        return DeleteResult({'n':n, 'ok':1.0}, True)
+
+    def delete_one(self, filter): return self.__delete__(filter, False)
+    def delete_many(self, filter): return self.__delete__(filter, True)
+
+    def drop(self):
+        self.backend.drop(self.database, self.name)
+
+class StorageBackend():
+    '''backend[database][collection] as with a MongoClient, blobs(database) in place of GridFS'''
+
+    #Whether writes made in one process are seen by the others
+    shared = True
+
+    def __getitem__(self, database):
+        return Database(self, database)
+
+    def close(self): pass
+
+class Database():
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def __getitem__(self, collection):
+        return self.backend.collection(self.name, collection)
+
+    def list_collection_names(self):
+        return self.backend.list_collection_names(self.name)
+
+    def drop_collection(self, collection):
+        self.backend.drop(self.name, collection)
+
+class MemoryBlobs():
+    '''put, get and delete of byte blobs by id, same calls as GridFS'''
+
+    def __init__(self):
+        self.__blobs__ = {}
+        self.__ids__ = itertools.count(1)
+
+    def put(self, data):
+        file_id = next(self.__ids__)
+        self.__blobs__[file_id] = bytes(data)
+        return file_id
+
+    def get(self, file_id):
+        try: return io.BytesIO(self.__blobs__[file_id])
+        except KeyError: raise KeyError('No blob {}'.format(file_id))
+
+    def delete(self, file_id):
+        self.__blobs__.pop(file_id, None)
+
+class MemoryCollection(Collection):
+
+    def __init__(self, backend, database, name):
+        super().__init__(backend, database, name)
+        self.__docs__ = {}
+        #index name -> [keys, lookup per prefix length of keys tuple -> {_id:None}]
+        self.__indexes__ = {}
+        self.__lock__ = threading.RLock()
+
+    def __transaction__(self): return self.__lock__
+
+    def __candidates__(self, query):
+        ids = None
+        cond = query.get('_id', __missing__)
+        if(cond is not __missing__):
+            if(__isops__(cond) and '$in' in cond): ids = cond['$in']
+            elif(not __isops__(cond)): ids = [cond]
+        if(ids is None):
+            best = None
+            for keys, levels in self.__indexes__.values():
+                k = 0
+                while(k < len(keys) and keys[k][0] in query and not __isops__(query[keys[k][0]])): k += 1
+                if(k and (best is None or k > best[0])): best = [k, keys, levels]
+            if(best is None): return list(self.__docs__.values())
+            k, keys, levels = best
+            ids = list(levels[k-1].get(tuple(__hashable__(query[field]) for field, _ in keys[:k]), ()))
+        docs = (self.__docs__.get(__hashable__(_id)) for _id in dict.fromkeys(map(__hashable__, ids)))
+        return [doc for doc in docs if doc is not None]
+
+    def __matching__(self, query):
+        with self.__lock__:
+            docs = self.__candidates__(query)
+        return (doc for doc in docs if matches(doc, query))
+
+    def count_documents(self, filter):
+        if(not filter): return len(self.__docs__)
+        return super().count_documents(filter)
+
+    def __indexkey__(self, keys, doc):
+        return tuple(__hashable__(None if val is __missing__ else val) for val in (__getpath__(doc, field) for field, _ in keys))
+
+    def __index__(self, doc, add = True):
+        for keys, levels in self.__indexes__.values():
+            key = self.__indexkey__(keys, doc)
+            for k in range(len(keys)):
+                if(add):
+                    levels[k].setdefault(key[:k+1], {})[doc['_id']] = None
+                else:
+                    found = levels[k].get(key[:k+1])
+                    if(found is None): continue
+                    found.pop(doc['_id'], None)
+                    if(not found): del levels[k][key[:k+1]]
+
+    def __insert__(self, doc):
+        if(__hashable__(doc['_id']) in self.__docs__): return False
+        doc = dict(doc)
+        self.__docs__[__hashable__(doc['_id'])] = doc
+        self.__index__(doc)
+        return True
+
+    def __write__(self, doc):
+        self.__index__(self.__docs__[__hashable__(doc['_id'])], add = False)
+        self.__docs__[__hashable__(doc['_id'])] = doc
+        self.__index__(doc)
+
+    def __remove__(self, _id):
+        doc = self.__docs__.pop(__hashable__(_id), None)
+        if(doc is not None): self.__index__(doc, add = False)
+
+    def create_index(self, keys, **kwargs):
+        keys = __indexkeys__(keys)
+        name = kwargs.get('name') or __indexname__(keys)
+        with self.__lock__:
+            if(name not in self.__indexes__):
+                self.__indexes__[name] = [keys, [{} for _ in keys]]
+                keys, levels = self.__indexes__[name]
+                for doc in self.__docs__.values():
+                    key = self.__indexkey__(keys, doc)
+                    for k in range(len(keys)):
+                        levels[k].setdefault(key[:k+1], {})[doc['_id']] = None
+        return name
+
+    def index_information(self):
+        info = {'_id_':{'key':[('_id', pymongo.ASCENDING)]}}
+        for name, (keys, _) in self.__indexes__.items():
+            info[name] = {'key':list(keys)}
+        return info
+
+class MemoryBackend(StorageBackend):
+    '''Collections held in this process, for single machine runs, tests and benchmarks'''
+
+    shared = False
+
+    def __init__(self):
+        self.__collections__ = {}
+        self.__blobs__ = {}
+        self.__lock__ = threading.Lock()
+
+    def collection(self, database, name):
+        with self.__lock__:
+            try: return self.__collections__[(database, name)]
+            except KeyError:
+                collection = self.__collections__[(database, name)] = MemoryCollection(self, database, name)
+                return collection
+
+    def list_collection_names(self, database):
+        return [name for (db, name), collection in list(self.__collections__.items())
+                if db == database and collection.__docs__]
+
+    def drop(self, database, name):
+        with self.__lock__:
+            collection = self.__collections__.pop((database, name), None)
+        #Holders of the dropped collection see it empty, as with MongoDB
+        if(collection is not None):
+            with collection.__lock__:
+                collection.__docs__ = {}
+                collection.__indexes__ = {}
+
+    def blobs(self, database):
+        with self.__lock__:
+            try: return self.__blobs__[database]
+            except KeyError:
+                blobs = self.__blobs__[database] = MemoryBlobs()
+                return blobs
+
+def __quote__(name): return '"{}"'.format(name.replace('"', '""'))
+
+def __jsonpath__(field):
+    return "'$.{}'".format('.'.join('"{}"'.format(key) for key in field.split('.')).replace("'", "''"))
+
+def __column__(field):
+    return '_id' if field == '_id' else 'json_extract(doc, {})'.format(__jsonpath__(field))
+
+def __encode__(val):
+    if(isinstance(val, (bytes, bytearray, memoryview))): return {'$binary':base64.b64encode(bytes(val)).decode('ascii')}
+    raise TypeError('{} can not be stored'.format(type(val).__name__))
+
+def __decode__(d):
+    if(len(d) == 1 and '$binary' in d): return base64.b64decode(d['$binary'])
+    return d
+
+def __scalar__(val):
+    return isinstance(val, (str, int, float)) and not isinstance(val, bool)
+
+class SQLiteBlobs():
+
+    def __init__(self, backend, database):
+        self.backend = backend
+        self.table = __quote__('{}.__blobs__'.format(database))
+
+    def put(self, data):
+        with self.backend.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY AUTOINCREMENT, data BLOB NOT NULL)'.format(self.table))
+            return conn.execute('INSERT INTO {} (data) VALUES (?)'.format(self.table), (bytes(data),)).lastrowid
+
+    def get(self, file_id):
+        with self.backend.transaction(write = False) as conn:
+            try: row = conn.execute('SELECT data FROM {} WHERE id = ?'.format(self.table), (file_id,)).fetchone()
+            except sqlite3.OperationalError: row = None
+        if(row is None): raise KeyError('No blob {}'.format(file_id))
+        return io.BytesIO(row[0])
+
+    def delete(self, file_id):
+        with self.backend.transaction() as conn:
+            try: conn.execute('DELETE FROM {} WHERE id = ?'.format(self.table), (file_id,))
+            except sqlite3.OperationalError: pass
+
+class SQLiteCollection(Collection):
+
+    page_size = 1000
+    #Bound variables per IN clause, below every SQLite build's limit
+    max_variables = 900
+    #Documents larger than MongoDB allows are refused the same way, Broker then moves them to blobs
+    max_document_size = 16<<20
+
+    def __init__(self, backend, database, name):
+        super().__init__(backend, database, name)
+        self.table = __quote__(self.full_name)
+
+    def __transaction__(self):
+        return self.backend.transaction()
+
+    def __create__(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS {} (_id NOT NULL UNIQUE, doc TEXT NOT NULL)'.format(self.table))
+
+    def __wheres__(self, query):
+        '''SQL conditions narrowing query, one per chunk of a long _id $in list'''
+        clauses, params, chunks = [], [], [None]
+        for key, cond in query.items():
+            if(key[:1] == '$'): continue
+            if(__isops__(cond)):
+                if(key == '_id' and set(cond) == {'$in'} and all(map(__scalar__, cond['$in']))):
+                    ids = list(cond['$in'])
+                    chunks = [ids[i:i+self.max_variables] for i in range(0, len(ids), self.max_variables)]
+                continue
+            if(__scalar__(cond)):
+                clauses.append('{} = ?'.format(__column__(key)))
+                params.append(cond)
+        for chunk in chunks:
+            if(chunk is None): yield clauses, params
+            else: yield clauses + ['_id IN ({})'.format(','.join('?'*len(chunk)))], params + chunk
+
+    def __matching__(self, query):
+        for clauses, params in self.__wheres__(query):
+            after = 0
+            while(True):
+                sql = 'SELECT rowid, doc FROM {} WHERE {} ORDER BY rowid LIMIT ?'.format(self.table, ' AND '.join(clauses + ['rowid > ?']))
+                with self.backend.transaction(write = False) as conn:
+                    try: rows = conn.execute(sql, params + [after, self.page_size]).fetchall()
+                    except sqlite3.OperationalError as e:
+                        if('no such table' in str(e)): return
+                        raise
+                for _, doc in rows:
+                    doc = json.loads(doc, object_hook = __decode__)
+                    if(matches(doc, query)): yield doc
+                if(len(rows) < self.page_size): break
+                after = rows[-1][0]
+
+    def count_documents(self, filter):
+        if(filter): return super().count_documents(filter)
+        with self.backend.transaction(write = False) as conn:
+            try: return conn.execute('SELECT COUNT(*) FROM {}'.format(self.table)).fetchone()[0]
+            except sqlite3.OperationalError: return 0
+
+    def __dumps__(self, doc):
+        s = json.dumps(doc, separators = (',', ':'), default = __encode__)
+        if(len(s) > self.max_document_size):
+            raise pymongo.errors.DocumentTooLarge('Document of {} bytes larger than {}'.format(len(s), self.max_document_size))
+        return s
+
+    def __insert__(self, doc):
+        with self.backend.transaction() as conn:
+            self.__create__(conn)
+            return conn.execute('INSERT OR IGNORE INTO {} (_id, doc) VALUES (?, ?)'.format(self.table),
+                                (doc['_id'], self.__dumps__(doc))).rowcount == 1
+
+    def __write__(self, doc):
+        with self.backend.transaction() as conn:
+            conn.execute('UPDATE {} SET doc = ? WHERE _id = ?'.format(self.table), (self.__dumps__(doc), doc['_id']))
+
+    def __remove__(self, _id):
+        with self.backend.transaction() as conn:
+            conn.execute('DELETE FROM {} WHERE _id = ?'.format(self.table), (_id,))
+
+    def create_index(self, keys, **kwargs):
+        keys = __indexkeys__(keys)
+        name = kwargs.get('name') or __indexname__(keys)
+        with self.backend.transaction() as conn:
+            self.__create__(conn)
+            conn.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(__quote__('{}.${}'.format(self.full_name, name)), self.table,
+                                                                          ', '.join(__column__(field) for field, _ in keys)))
+            conn.execute('INSERT OR REPLACE INTO __indexes__ (collection, name, keys) VALUES (?, ?, ?)',
+                         (self.full_name, name, json.dumps(keys)))
+        return name
+
+    def index_information(self):
+        info = {'_id_':{'key':[('_id', pymongo.ASCENDING)]}}
+        with self.backend.transaction(write = False) as conn:
+            for name, keys in conn.execute('SELECT name, keys FROM __indexes__ WHERE collection = ?', (self.full_name,)):
+                info[name] = {'key':[tuple(key) for key in json.loads(keys)]}
+        return info
+
+class SQLiteBackend(StorageBackend):
+    '''Collections in a single SQLite file, shared by every process that opens it'''
+
+    busy_timeout = 60 #seconds
+
+    def __init__(self, path):
+        self.path = path
+        self.__pid__ = None
+        self.__conn__ = None
+        self.__depth__ = 0
+        self.__lock__ = threading.RLock()
+
+    def connection(self):
+        #Connections are not shared across a fork, every process opens its own
+        if(self.__pid__ != os.getpid()):
+            self.__conn__ = sqlite3.connect(self.path, timeout = self.busy_timeout, check_same_thread = False, isolation_level = None)
+            self.__conn__.execute('PRAGMA journal_mode=WAL')
+            self.__conn__.execute('PRAGMA synchronous=NORMAL')
+            self.__conn__.execute('CREATE TABLE IF NOT EXISTS __indexes__ (collection TEXT, name TEXT, keys TEXT, PRIMARY KEY (collection, name))')
+            self.__pid__ = os.getpid()
+            self.__depth__ = 0
+        return self.__conn__
+
+    @contextlib.contextmanager
+    def transaction(self, write = True):
+        '''Outermost write transaction takes SQLite's write lock up front, nested ones join it'''
+        with self.__lock__:
+            conn = self.connection()
+            begin = write and self.__depth__ == 0
+            if(begin): conn.execute('BEGIN IMMEDIATE')
+            self.__depth__ += write
+            try:
+                yield conn
+            except BaseException:
+                self.__depth__ -= write
+                if(begin): conn.execute('ROLLBACK')
+                raise
+            self.__depth__ -= write
+            if(begin): conn.execute('COMMIT')
+
+    def collection(self, database, name):
+        return SQLiteCollection(self, database, name)
+
+    def list_collection_names(self, database):
+        prefix = '{}.'.format(database)
+        with self.transaction(write = False) as conn:
+            names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return [name[len(prefix):] for name in names if name.startswith(prefix) and not name.endswith('.__blobs__')]
+
+    def drop(self, database, name):
+        full_name = '{}.{}'.format(database, name)
+        with self.transaction() as conn:
+            conn.execute('DROP TABLE IF EXISTS {}'.format(__quote__(full_name)))
+            conn.execute('DELETE FROM __indexes__ WHERE collection = ?', (full_name,))
+
+    def blobs(self, database):
+        return SQLiteBlobs(self, database)
+
+    def close(self):
+        with self.__lock__:
+            if(self.__conn__ is not None and self.__pid__ == os.getpid()): self.__conn__.close()
+            self.__conn__, self.__pid__ = None, None
+
+__backends__ = {}
+__backends_lock__ = threading.Lock()
+def connect(url):
+    '''Client for storage url, memory and sqlite backends shared by every caller in the process'''
+    if(url.startswith('mongodb://') or url.startswith('mongodb+srv://')):
+        return pymongo.MongoClient(url)
+    with __backends_lock__:
+        try: return __backends__[url]
+        except KeyError: pass
+        if(url == 'memory' or url.startswith('memory://')):
+            backend = MemoryBackend()
+        elif(url.startswith('sqlite:///')):
+            backend = SQLiteBackend(url[len('sqlite:///'):])
+        else:
+            raise ValueError('Unknown storage {}, expected mongodb://, memory or sqlite:///'.format(url))
+        __backends__[url] = backend
+        return backend
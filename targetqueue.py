@@ -0,0 +1,83 @@
+#/roxrec/targetqueue.py
+'''
+## ========================================================================== ##
+- TargetQueue hands out target records from {table}_target to match workers
+   in batches, using leases rather than deleting records as they are read.
+- Claiming marks up to batch_size unleased (or lease expired) records with
+   a lease holding the worker id, a claim token and an expiry time, then
+   reads back only records carrying that token. A record can only be
+   holding one token at a time, so no two workers receive the same record.
+- claim returns a Batch, a list of the records carrying its claim token.
+   Records are deleted in bulk when the batch is acknowledged, only those
+   still holding its token, so a late acknowledgement of an expired lease
+   never removes records claimed again since (even by the same worker id).
+- Leases of a worker that died expire after lease_seconds and the records
+   become claimable again, release() expires every lease immediately once
+   it is known no worker is running.
+## ========================================================================== ##
+'''
+
+## Built-ins
+import os
+import time
+import uuid
+import socket
+
+## Package
+import __init__
+from general import *
+
+class Batch(list):
+    '''Records of one claim, token identifies the lease they are held under'''
+
+    def __init__(self, recs = (), token = None):
+        super().__init__(recs)
+        self.token = token
+
+class TargetQueue():
+
+    lease_seconds = 600
+    batch_size = 100
+
+    def __init__(self, pipeline, worker_id = None, batch_size = None, lease_seconds = None):
+        self.p = pipeline
+        self.worker_id = worker_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.batch_size = batch_size or TargetQueue.batch_size
+        self.lease_seconds = lease_seconds or TargetQueue.lease_seconds
+
+    def __collection__(self):
+        return self.p.collection('{}_target'.format(self.p.table))
+
+    def __available__(self, now):
+        return {'$or':[{'_lease':{'$exists':False}}, {'_lease':None}, {'_lease.expires':{'$lt':now}}]}
+
+    def claim(self, n = None):
+        '''Lease up to n records to this worker, returns Batch of leased records without lease field, empty when none left'''
+        db = self.__collection__()
+        now = time.time()
+        ids = [rec['_id'] for rec in db.find(self.__available__(now), {'_id':1}).limit(n or self.batch_size)]
+        if(not ids): return Batch()
+
+        token = uuid.uuid4().hex
+        query = self.__available__(now)
+        query['_id'] = {'$in':ids}
+        db.update_many(query, {'$set':{'_lease':{'worker':self.worker_id, 'token':token,
+                                                 'expires':now + self.lease_seconds}}})
+        #Other workers may have leased some of ids in between, only records with this token belong to us
+        recs = list(db.find({'_lease.token':token}, {'_lease':0}))
+        if(not recs): return self.claim(n)
+        return Batch(recs, token)
+
+    def ack(self, batch):
+        '''Remove processed records, only while still held under the claim of batch'''
+        self.ack_ids([rec['_id'] for rec in batch], batch.token)
+
+    def ack_ids(self, ids, token):
+        if(ids):
+            self.__collection__().delete_many({'_id':{'$in':ids}, '_lease.token':token})
+
+    def release(self):
+        '''Expire every lease, returns number of records left in queue'''
+        db = self.__collection__()
+        db.update_many({'_lease':{'$exists':True}}, {'$unset':{'_lease':''}})
+        return db.count_documents({})
@@ -0,0 +1,121 @@
+#/roxrec/tfidf.py
+'''
+## ========================================================================== ##
+- FieldVectors holds the bag of words vector of every record in a RecordLSH
+   partition for one field, as rows of a sparse CSR matrix keyed by
+   vocabulary id. Row i belongs to the record with LSH key i.
+- Word weight is the same count*(1-freq) used by RecordLSH.bow_sim, freq
+   taken from the universe word counts.
+- Built with the partition and persisted with it, so scoring a target
+   against its canidates needs no canidate records or _meta at all.
+   Packed as plain CSR arrays (see packedlsh.py).
+- Target vector remapped onto partition vocabulary before scoring, each
+   vocabulary word within edit distance of a target word gets the target
+   word's weight discounted by their similarity. Whole canidate set then
+   scored with one sparse matrix-vector product per field.
+## ========================================================================== ##
+'''
+
+## Package
+import __init__
+from general import *
+
+## Additional
+import numpy as np
+from scipy.sparse import csr_matrix
+
+class FieldVectors():
+
+    def __init__(self):
+        self.vocab = {}
+        self.matrix = None
+        self.norms = None
+        self.__rows__, self.__cols__, self.__vals__ = [], [], []
+        self.__removed__ = []
+
+    def __len__(self):
+        return 0 if self.matrix is None else self.matrix.shape[0]
+
+    def add(self, row, weights):
+        '''weights maps word -> weight for record at row, applied on next finalize'''
+        vocab = self.vocab
+        for word in weights:
+            try: col = vocab[word]
+            except KeyError: col = vocab[word] = len(vocab)
+            self.__rows__.append(row)
+            self.__cols__.append(col)
+            self.__vals__.append(weights[word])
+
+    def remove(self, rows):
+        '''Empty the vectors of rows on next finalize'''
+        self.__removed__.extend(rows)
+
+    def finalize(self, nrows):
+        shape = (nrows, max(len(self.vocab), 1))
+        added = csr_matrix((np.array(self.__vals__, dtype=np.float64),
+                            (np.array(self.__rows__, dtype=np.int64), np.array(self.__cols__, dtype=np.int64))), shape = shape)
+        if(self.matrix is not None):
+            #Copied since packed partitions hold read only views of their blob
+            old = self.matrix.copy()
+            old.resize(shape)
+            #Rows written again replace their earlier vector
+            rewritten = np.unique(added.nonzero()[0])
+            keep = np.ones(shape[0])
+            keep[rewritten] = 0
+            keep[np.array(self.__removed__, dtype=np.int64)] = 0
+            added = csr_matrix(old.multiply(keep.reshape(-1,1))) + added
+        self.matrix = added.tocsr()
+        self.matrix.eliminate_zeros()
+        self.norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel())
+        self.__rows__, self.__cols__, self.__vals__ = [], [], []
+        self.__removed__ = []
+
+    def arrays(self, prefix):
+        '''Named arrays for packing, vocabulary stored as newline joined words in column order'''
+        m = self.matrix
+        vocab = '\n'.join(sorted(self.vocab, key = self.vocab.get)).encode()
+        return {'{}.data'.format(prefix):m.data, '{}.indices'.format(prefix):m.indices,
+                '{}.indptr'.format(prefix):m.indptr, '{}.norms'.format(prefix):self.norms,
+                '{}.vocab'.format(prefix):np.frombuffer(vocab, dtype=np.uint8),
+                '{}.shape'.format(prefix):np.array(m.shape, dtype=np.int64)}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        v = cls()
+        words = bytes(arrays['{}.vocab'.format(prefix)]).decode()
+        v.vocab = dict((word, i) for i, word in enumerate(words.split('\n'))) if words else {}
+        v.matrix = csr_matrix((arrays['{}.data'.format(prefix)], arrays['{}.indices'.format(prefix)],
+                               arrays['{}.indptr'.format(prefix)]), shape = tuple(arrays['{}.shape'.format(prefix)].tolist()), copy = False)
+        v.norms = arrays['{}.norms'.format(prefix)]
+        return v
+
+    def target(self, weights, neighbors = None):
+        '''Remapped target vector as (ids, values) plus norm of the unmapped target vector
+           weights maps target word -> weight, neighbors maps target word -> {vocab word: distance}'''
+        remapped = {}
+        for word in weights:
+            near = dict((neighbors or {}).get(word, {}))
+            near[word] = 0
+            for other in near:
+                try: col = self.vocab[other]
+                except KeyError: continue
+                #Closest target word decides the weight of each vocabulary word
+                sim = 1 - (near[other] / max(len(word), len(other)))
+                if(col not in remapped or sim > remapped[col][0]):
+                    remapped[col] = (sim, weights[word]*sim)
+        norm = sqrt(sum(w*w for w in weights.values()))
+        return (np.fromiter(remapped.keys(), dtype=np.int64, count=len(remapped)),
+                np.fromiter(map(second, remapped.values()), dtype=np.float64, count=len(remapped)), norm)
+
+    def score(self, rows, target):
+        '''Cosine similarity between target and each row in rows'''
+        ids, vals, norm = target
+        rows = np.asarray(rows, dtype=np.int64)
+        if(len(rows) == 0 or len(ids) == 0 or norm == 0 or self.matrix is None):
+            return np.zeros(len(rows))
+        vec = csr_matrix((vals, (ids, np.zeros(len(ids), dtype=np.int64))), shape=(self.matrix.shape[1], 1))
+        dots = np.asarray((self.matrix[rows] @ vec).todense()).ravel()
+        denom = self.norms[rows] * norm
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims = np.where(denom > 0, dots / denom, 0)
+        return np.minimum(sims, 1)
@@ -0,0 +1,76 @@
+#/roxrec/vocabindex.py
+'''
+## ========================================================================== ##
+- VocabularyIndex is a BK-tree over every word seen in one field of the
+   universe, built from the {table}_meta_wordcount collection written by
+   PreprocessPiper.__update_count__
+- Query returns all vocabulary words within an edit distance budget of a
+   word, only visiting subtrees that the triangle inequality allows.
+- RecordLSH resolves the neighbors of each target word once per target,
+   the result is reused for every canidate in the target's canidate pool.
+- One index per database/table/field kept for the whole process, rebuilt
+   when the count tables are rewritten. Get with get_vocabindex
+## ========================================================================== ##
+'''
+
+## Built-ins
+import threading
+
+## Package
+import __init__
+from general import *
+from wordsim import levenshtein
+from frequencytable import get_frequencytable
+
+__vocabindexes__ = {}
+__registry_lock__ = threading.Lock()
+def get_vocabindex(pipeline, field):
+    key = (pipeline.database, pipeline.table, field)
+    version = get_frequencytable(pipeline).version
+    with __registry_lock__:
+        index = __vocabindexes__.get(key)
+        if(index is None or index.version != version):
+            db = pipeline.collection('{}_meta_wordcount'.format(pipeline.table))
+            index = __vocabindexes__[key] = VocabularyIndex(
+                (str(rec['wordcount']) for rec in db.find({'field':field}, {'_id':0, 'wordcount':1})))
+            index.version = version
+    return index
+
+class VocabularyIndex():
+
+    def __init__(self, words = ()):
+        self.root = None
+        self.size = 0
+        self.version = None
+        for word in words: self.add(word)
+
+    def __len__(self): return self.size
+
+    def add(self, word):
+        if(self.root is None):
+            self.root = [word, {}]
+            self.size += 1
+            return
+        node = self.root
+        while(True):
+            d = levenshtein(word, node[0])
+            if(d == 0): return
+            try: node = node[1][d]
+            except KeyError:
+                node[1][d] = [word, {}]
+                self.size += 1
+                return
+
+    def query(self, word, max_dist):
+        '''[[vocab word, distance]] for every vocab word within max_dist of word, closest first'''
+        found = []
+        if(self.root is None): return found
+        stack = [self.root]
+        while(stack):
+            node = stack.pop()
+            d = levenshtein(word, node[0])
+            if(d <= max_dist): found.append([node[0], d])
+            for child_d, child in node[1].items():
+                if(d - max_dist <= child_d <= d + max_dist): stack.append(child)
+        found.sort(key = second)
+        return found
@@ -0,0 +1,115 @@
+#/roxrec/wordsim.py
+'''
+## ========================================================================== ##
+- Word similarity kernel used when scoring bag of words between records
+- Levenshtein distance computed with Myers/Hyyro bit-parallel algorithm,
+   whole column of the DP table updated with a handful of integer ops per
+   character. Compiled backend (rapidfuzz) used instead when installed.
+- Distance can be bounded by max_dist, returning max_dist + 1 as soon as
+   the true distance is known to exceed it. Length difference checked first.
+- Distances memoized per (word, word) pair in bounded LRU cache, pairs that
+   exceeded a bound stored as a lower bound so they are not recomputed
+   under an equal or tighter bound.
+- best_match finds the most similar word in a collection, only candidates
+   that can still beat the current best are computed.
+- levenshtein is the unmemoized distance, for callers such as vocabulary
+   indexes that compare each word against many others only once.
+## ========================================================================== ##
+'''
+
+## Package
+import __init__
+from lrucache import LRUCache
+from metrics import get_metrics
+
+## Additional
+try:
+    from rapidfuzz.distance import Levenshtein as __compiled__
+except ImportError:
+    __compiled__ = None
+
+memo = LRUCache(1<<18)
+#Every distance call is a lookup here, misses are the distances actually computed
+get_metrics().register_cache('wordsim', memo)
+
+def myers(a, b, max_dist = None):
+    '''Levenshtein distance, bit-parallel over the longer word, stops once max_dist can no longer be met'''
+    if(len(a) < len(b)): a, b = b, a
+    m, n = len(a), len(b)
+    if(max_dist is not None and m - n > max_dist): return max_dist + 1
+    if(n == 0): return m
+
+    peq = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    full = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv, score = full, 0, m
+
+    for j, c in enumerate(b):
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if(ph & last): score += 1
+        elif(mh & last): score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+        #Each remaining character can lower the distance by at most one
+        if(max_dist is not None and score - (n - j - 1) > max_dist): return max_dist + 1
+    return score
+
+def levenshtein(a, b, max_dist = None):
+    '''Unmemoized distance, compiled backend when available'''
+    if(__compiled__ is not None):
+        return __compiled__.distance(a, b, score_cutoff = max_dist)
+    return myers(a, b, max_dist)
+
+def distance(a, b, max_dist = None):
+    '''Levenshtein distance between a and b, max_dist + 1 when distance is greater than max_dist'''
+    if(max_dist is not None and abs(len(a) - len(b)) > max_dist): return max_dist + 1
+
+    key = (a, b) if a <= b else (b, a)
+    d = memo.get(key)
+    if(d is not None):
+        if(d >= 0): return d if max_dist is None or d <= max_dist else max_dist + 1
+        #Negative entries are lower bounds from earlier bounded calls
+        if(max_dist is not None and -d > max_dist): return max_dist + 1
+
+    d = levenshtein(a, b, max_dist)
+    if(max_dist is not None and d > max_dist): memo[key] = -(max_dist + 1)
+    else: memo[key] = d
+    return d
+
+def similarity(s0, s1):
+    return 1 - (distance(s0, s1) / max(len(s0), len(s1)))
+
+def best_match(word, others, floor = None):
+    '''[other, similarity] for most similar word in others, first seen wins ties, ValueError when others empty
+       floor is a similarity known to be reached by some word in others, lets pruning start from the first word'''
+    best = None
+    L0 = len(word)
+    for other in others:
+        L = max(L0, len(other))
+        bound = best[1] if best is not None else floor
+        if(bound is not None):
+            #Distance is at least the length difference, skip when even that can not reach bound
+            ub = 1 - (abs(L0 - len(other)) / L)
+            if(ub < bound or (best is not None and ub == bound)): continue
+            d = distance(word, other, int((1 - bound) * L + 1e-9))
+        else:
+            d = distance(word, other)
+        sim = 1 - (d / L)
+        if(best is None):
+            if(floor is None or sim >= floor): best = [other, sim]
+        elif(sim > best[1]):
+            best = [other, sim]
+    if(best is None and floor is not None):
+        return best_match(word, others)
+    if(best is None):
+        raise ValueError('best_match() arg is an empty sequence')
+    return best